@@ -1,3 +1,5 @@
+import eventlet
+import six
 import subprocess
 import traceback
 
@@ -7,9 +9,37 @@ from networking_bambuk.rpc import bambuk_rpc
 
 from oslo_log import log
 
+from oslo_serialization import jsonutils
+
 
 LOG = log.getLogger(__name__)
 
+# entries written between two yields, to answer the other requests while
+# writing a large connect_db
+YIELD_EVERY = 100
+
+# share of the entries changing from which a full apply replaces the whole
+# database at once, when the driver can
+REPLACE_RATIO = 0.5
+
+# where the agent keeps the revision of its last apply
+META_TABLE = 'bambuk'
+REVISION_KEY = 'revision'
+# the tables written by the server
+TABLES = ('chassis', 'lport', 'lrouter', 'lswitch', 'secgroup')
+
+
+def _value(entry):
+    """Return the entry value as the JSON string stored in the DB.
+
+    JSON encoded messages carry the values as JSON strings while binary
+    encoded ones carry them as nested structures.
+    """
+    value = entry['value']
+    if value is None or isinstance(value, six.string_types):
+        return value
+    return jsonutils.dumps(value)
+
 
 class AgentDbDriver(bambuk_rpc.BambukRpc):
     """Bambuk Agent DB Driver for Dragonflow DB."""
@@ -50,25 +80,106 @@ class AgentDbDriver(bambuk_rpc.BambukRpc):
                     'enable_distributed_routing': True,
                 },
                 'agent_type': 'bambuk-agent',
-                'start_flag': True
+                'start_flag': True,
+                'revision': self._revision(),
             }
         except Exception:
             LOG.error(traceback.format_exc())
             return False
         return self.agent_state
 
+    def _revision(self):
+        try:
+            return int(self.get_key(META_TABLE, REVISION_KEY) or 0)
+        except Exception:
+            return 0
+
+    def _set_revision(self, revision):
+        self.set_key(META_TABLE, REVISION_KEY, str(revision),
+                     topic=None, sync=False)
+
+    def _missing(self, keys):
+        """Return the stored (table, key) not in keys."""
+        keys = set((table, key) for table, key in keys)
+        tables = set(TABLES) | set(table for table, _ in keys)
+        return [(table, key)
+                for table in tables
+                for key in self.get_all_keys(table)
+                if (table, key) not in keys]
+
+    def _changed(self, connect_db):
+        """Return the entries of connect_db differing from the stored ones."""
+        changed = []
+        for i, entry in enumerate(connect_db):
+            if i and not i % YIELD_EVERY:
+                eventlet.sleep(0)
+            if self.get_key(entry['table'], entry['key']) != _value(entry):
+                changed.append(entry)
+        return changed
+
+    def _replace(self, connect_db, revision):
+        """Replace the whole content of the database with connect_db.
+
+        :returns: False if the driver can not, the differences are then
+                  written entry by entry
+        """
+        return False
+
     @timefunc
-    def apply(self, connect_db):
-        """Add objects to the database."""
+    def apply(self, connect_db, keys=None, since=None):
+        """Replace the content of the database.
+
+        Only the entries differing from the stored ones are written and
+        the entries missing deleted, the database is never emptied while
+        the controller reads it. Applying the stored content writes
+        nothing.
+        :param connect_db: the entries to write
+        :param keys: the (table, key) of all the entries the database
+                     holds after the apply, None if connect_db has them
+                     all. The entries missing are deleted, the other ones
+                     are kept as is.
+        :param since: the revision connect_db holds the changes since, the
+                      apply is refused if the database is older
+        """
         try:
             LOG.info('apply(%s)', connect_db)
-            self.clear_all()
-            for entry in connect_db:
-                self.create_key(entry['table'],
-                                entry['key'],
-                                entry['value'],
-                                topic=None,
-                                sync=False)
+            current = self._revision()
+            if since is not None and current < since:
+                LOG.warning('apply since %s refused at revision %s' % (
+                    since, current))
+                return False
+            full = keys is None
+            if full:
+                revision = 0
+                keys = [(entry['table'], entry['key'])
+                        for entry in connect_db]
+            else:
+                revision = current
+            revision = max([revision] + [entry.get('revision') or 0
+                                         for entry in connect_db])
+            missing = self._missing(keys)
+            changed = self._changed(connect_db)
+            if (full and len(changed) + len(missing) >
+                    REPLACE_RATIO * len(connect_db) and
+                    self._replace(connect_db, revision)):
+                LOG.info('apply: %d entries replaced' % len(connect_db))
+                return True
+            for table, key in missing:
+                self.delete_key(table, key, topic=None, sync=False)
+            for i, entry in enumerate(changed):
+                if i and not i % YIELD_EVERY:
+                    eventlet.sleep(0)
+                self.set_key(entry['table'],
+                             entry['key'],
+                             _value(entry),
+                             topic=None,
+                             sync=False)
+            LOG.info('apply: %d entries written, %d deleted, %d unchanged' % (
+                len(changed), len(missing), len(connect_db) - len(changed)))
+            if not changed and not missing and revision == current:
+                return True
+            if revision != current:
+                self._set_revision(revision)
             self.sync()
         except Exception:
             LOG.error(traceback.format_exc())
@@ -86,7 +197,7 @@ class AgentDbDriver(bambuk_rpc.BambukRpc):
             for cdb_update in cdb_updates:
                 self.set_key(cdb_update['table'],
                              cdb_update['key'],
-                             cdb_update['value'],
+                             _value(cdb_update),
                              topic=None,
                              sync=False)
             self.sync()
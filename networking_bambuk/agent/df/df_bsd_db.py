@@ -1,4 +1,7 @@
+import eventlet
 import os
+import shutil
+import tempfile
 
 from bsddb3 import db                   # the Berkeley db data base
 
@@ -16,6 +19,24 @@ from oslo_utils import importutils
 
 LOG = log.getLogger(__name__)
 
+# link of db_dir to the directory of the current tables, swapped at once
+# by the full replaces
+TABLES_LINK = 'tables'
+SNAPSHOT_PREFIX = 'snapshot-'
+# directory of db_dir holding the environment regions and the transaction
+# log
+ENV_DIR = '.env'
+# log written, in kilobytes, from which a sync checkpoints the tables
+CHECKPOINT_KBYTES = 1024
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
 class BSDDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
     """BSD DB Driver for Dragonflow DB."""
@@ -23,6 +44,9 @@ class BSDDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
     def __init__(self):
         """Constructor."""
         super(BSDDbDriver, self).__init__()
+        # the directory of db_dir the tables were opened from
+        self._snapshot = None
+        self._env_obj = None
 
     ##########################################################################
     def initialize(self, db_ip, db_port, **args):
@@ -48,23 +72,105 @@ class BSDDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
             self._fl = open(lock_db, 'w')
             self._fl.write('0')
             self._fl.flush()
+            # the process writing the tables replays the log of the
+            # transactions committed before a crash
+            self._env_obj = self._open_env(recover=True)
             LOG.info('BSDDbDriver initializing bambuk receiver')
             self._bambuk_receiver = importutils.import_object(
                 config.receiver(), bambuk_agent=self)
 
         LOG.info('BSDDbDriver initialize - end')
 
+    def _open_env(self, recover=False):
+        env_dir = os.path.join(self._db_dir, ENV_DIR)
+        if not os.path.isdir(env_dir):
+            os.makedirs(env_dir)
+        env = db.DBEnv()
+        flags = (db.DB_CREATE | db.DB_INIT_LOCK | db.DB_INIT_LOG |
+                 db.DB_INIT_MPOOL | db.DB_INIT_TXN)
+        if recover:
+            flags |= db.DB_RECOVER
+        env.open(env_dir, flags)
+        # the log files no longer needed once checkpointed are removed
+        env.log_set_config(db.DB_LOG_AUTO_REMOVE, True)
+        return env
+
+    @property
+    def _env(self):
+        """The environment of the tables, with their transaction log."""
+        if self._env_obj is None:
+            self._env_obj = self._open_env()
+        return self._env_obj
+
+    def _commit(self, operation, sync):
+        """Run operation(txn) in a transaction.
+
+        Without sync, the commit is only written to the log buffer, the
+        next sync flushes the log of all the transactions at once.
+        """
+        txn = self._env.txn_begin()
+        try:
+            operation(txn)
+        except Exception:
+            txn.abort()
+            raise
+        txn.commit(0 if sync else db.DB_TXN_NOSYNC)
+
+    def _snapshot_dir(self):
+        """Return the directory of the current tables.
+
+        The tables opened from a directory replaced by another process
+        are closed, to be opened from the new one.
+        """
+        link = os.path.join(self._db_dir, TABLES_LINK)
+        try:
+            snapshot = os.readlink(link)
+        except OSError:
+            snapshot = self._create_snapshot_link(link)
+        if snapshot != self._snapshot:
+            if self._snapshot is not None:
+                LOG.info('tables replaced by %s' % snapshot)
+            self._close_tables()
+            self._snapshot = snapshot
+        return os.path.join(self._db_dir, snapshot)
+
+    def _create_snapshot_link(self, link):
+        """Move the tables of db_dir to their first snapshot directory."""
+        snapshot_dir = tempfile.mkdtemp(prefix=SNAPSHOT_PREFIX,
+                                        dir=self._db_dir)
+        for f in os.listdir(self._db_dir):
+            path = os.path.join(self._db_dir, f)
+            if not f.startswith('.') and os.path.isfile(path):
+                os.rename(path, os.path.join(snapshot_dir, f))
+        try:
+            os.symlink(os.path.basename(snapshot_dir), link)
+        except OSError:
+            # created by another process meanwhile
+            os.rmdir(snapshot_dir)
+        return os.readlink(link)
+
+    def _close_tables(self):
+        tables, self._tables = self._tables, {}
+        for tDB in tables.values():
+            tDB.close()
+
+    def _open(self, path):
+        """Open a table in the environment."""
+        tDB = db.DB(self._env)
+        tDB.open(path, None, db.DB_HASH, db.DB_CREATE | db.DB_AUTO_COMMIT)
+        return tDB
+
     def _get_db(self, table):
+        snapshot_dir = self._snapshot_dir()
         table = table.encode('utf8')
         if table in self._tables:
             return self._tables[table]
-        filename = os.path.join(self._db_dir, table)
-        tDB = db.DB()
-        tDB.open(filename, None, db.DB_HASH, db.DB_CREATE)
+        filename = os.path.join(snapshot_dir, table)
+        tDB = self._open(filename)
         self._tables[table] = tDB
         tDB.sync()
         return tDB
-        
+
     def create_table(self, table):
         """Create a table.
 
@@ -81,11 +187,11 @@ class BSDDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :type table:       string
         :returns:          None
         """
-        filename = os.path.join(self._db_dir, table)
+        filename = os.path.join(self._snapshot_dir(), table)
         if table in self._tables:
             self._tables[table].close()
             del self._tables[table]
-        os.remove(filename)
+        self._env.dbremove(filename, None, None, db.DB_AUTO_COMMIT)
 
     def get_key(self, table, key, topic=None):
         """Get the value of a specific key in a table.
@@ -120,9 +226,10 @@ class BSDDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :raises:           DragonflowException.DBKeyNotFound if key not found
         """
         _db = self._get_db(table)
-        _db.put(key.encode('utf8'), jsonutils.dumps(value))
-        if sync:
-            _db.sync()
+        self._commit(
+            lambda txn: _db.put(key.encode('utf8'), jsonutils.dumps(value),
+                                txn=txn),
+            sync)
 
     def create_key(self, table, key, value, topic=None, sync=True):
         """Create a specific key in a table with value.
@@ -138,9 +245,10 @@ class BSDDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :returns:          None
         """
         _db = self._get_db(table)
-        _db.put(key.encode('utf8'), jsonutils.dumps(value))
-        if sync:
-            _db.sync()
+        self._commit(
+            lambda txn: _db.put(key.encode('utf8'), jsonutils.dumps(value),
+                                txn=txn),
+            sync)
 
     def delete_key(self, table, key, topic=None, sync=True):
         """Delete a specific key from a table.
@@ -155,9 +263,8 @@ class BSDDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :raises:           DragonflowException.DBKeyNotFound if key not found
         """
         _db = self._get_db(table)
-        _db.delete(key.encode('utf8'))
-        if sync:
-            _db.sync()
+        self._commit(
+            lambda txn: _db.delete(key.encode('utf8'), txn=txn), sync)
 
     def get_all_entries(self, table, topic=None):
         """Return a list of all table entries values.
@@ -257,10 +364,122 @@ class BSDDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
 
     ##########################################################################
     def sync(self):
-        for table in self._tables:
-            self._tables[table].sync()
+        """Flush the log of the transactions committed without sync.
+
+        The tables themselves are written by the checkpoints, once enough
+        log was written since the last one.
+        """
+        self._env.log_flush()
+        self._env.txn_checkpoint(CHECKPOINT_KBYTES)
 
     def clear_all(self):
-        for f in os.listdir(self._db_dir):
+        for f in os.listdir(self._snapshot_dir()):
             self.delete_table(f)
+
+    def _replace(self, connect_db, revision):
+        """Write connect_db to new tables then swap them in at once.
+
+        The tables are written in the environment to a new directory of
+        db_dir, checkpointed to disk, then the tables link is replaced by
+        a link to it. The readers see the previous tables until the link
+        is renamed. The entries are committed in batches of YIELD_EVERY,
+        without sync, the checkpoint flushes them all at once.
+        """
+        previous = os.path.basename(self._snapshot_dir())
+        staging_dir = tempfile.mkdtemp(prefix=SNAPSHOT_PREFIX,
+                                       dir=self._db_dir)
+        staged = {}
+        txn = None
+        try:
+            for i, entry in enumerate(connect_db):
+                if i and not i % df_agent_db.YIELD_EVERY:
+                    txn.commit(db.DB_TXN_NOSYNC)
+                    txn = None
+                    eventlet.sleep(0)
+                if txn is None:
+                    txn = self._env.txn_begin()
+                table = entry['table'].encode('utf8')
+                if table not in staged:
+                    staged[table] = self._open(
+                        os.path.join(staging_dir, table))
+                staged[table].put(
+                    entry['key'].encode('utf8'),
+                    jsonutils.dumps(df_agent_db._value(entry)), txn=txn)
+            if txn is None:
+                txn = self._env.txn_begin()
+            meta = df_agent_db.META_TABLE.encode('utf8')
+            if meta not in staged:
+                staged[meta] = self._open(os.path.join(staging_dir, meta))
+            staged[meta].put(df_agent_db.REVISION_KEY.encode('utf8'),
+                             jsonutils.dumps(str(revision)), txn=txn)
+            txn.commit(db.DB_TXN_NOSYNC)
+            txn = None
+            self._env.log_flush()
+            self._env.txn_checkpoint(0, 0, db.DB_FORCE)
+            _fsync(staging_dir)
+
+            link = os.path.join(self._db_dir, TABLES_LINK)
+            link_tmp = link + '.tmp'
+            if os.path.lexists(link_tmp):
+                os.remove(link_tmp)
+            os.symlink(os.path.basename(staging_dir), link_tmp)
+            os.rename(link_tmp, link)
+        except Exception:
+            if txn is not None:
+                txn.abort()
+            for tDB in staged.values():
+                tDB.close()
+            self._remove_snapshot(os.path.basename(staging_dir))
+            raise
+
+        # the staged tables are the tables now, not to be removed whatever
+        # happens next
+        _fsync(self._db_dir)
+        tables, self._tables = self._tables, staged
+        self._snapshot = os.path.basename(staging_dir)
+        for tDB in tables.values():
+            tDB.close()
+        self._remove_snapshots(set([self._snapshot, previous]))
+        return True
+
+    def _remove_snapshots(self, keep):
+        """Remove the snapshot directories of db_dir but the ones of keep.
+
+        Besides the older tables, they are the staging directories of the
+        replaces interrupted by a crash. The previous tables are kept for
+        the readers which read the link before it was swapped. A table
+        still open by a reader holds its handle lock, its directory is
+        left to the next replace.
+        """
+        for f in os.listdir(self._db_dir):
+            if f.startswith(SNAPSHOT_PREFIX) and f not in keep:
+                self._remove_snapshot(f)
+
+    def _remove_snapshot(self, snapshot):
+        snapshot_dir = os.path.join(self._db_dir, snapshot)
+        try:
+            for table in os.listdir(snapshot_dir):
+                self._remove_table(os.path.join(snapshot_dir, table))
+        except (db.DBLockNotGrantedError, db.DBLockDeadlockError):
+            LOG.info('snapshot %s still open, kept' % snapshot)
+            return
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    def _remove_table(self, path):
+        """Remove the table of path from the environment, without waiting.
+
+        Raises DBLockNotGrantedError when the table is open.
+        """
+        txn = self._env.txn_begin(None, db.DB_TXN_NOWAIT)
+        try:
+            self._env.dbremove(path, None, txn)
+        except (db.DBLockNotGrantedError, db.DBLockDeadlockError):
+            txn.abort()
+            raise
+        except db.DBError as e:
+            # not a table, of a staging interrupted by a crash
+            txn.abort()
+            LOG.info('removing %s: %s' % (path, e))
+            return
+        txn.commit()
     ##########################################################################
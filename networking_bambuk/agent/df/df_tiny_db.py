@@ -1,4 +1,7 @@
+import json
 import os
+import sys
+import tempfile
 
 from dragonflow.db import db_api
 
@@ -9,18 +12,107 @@ from oslo_log import log
 
 from oslo_utils import importutils
 
-from tinydb import Query
+from tinydb import middlewares
+from tinydb import storages
 from tinydb import TinyDB
 
 LOG = log.getLogger(__name__)
 
 
+class AtomicJSONStorage(storages.Storage):
+    """Store the data in a JSON file replaced at once on every write.
+
+    The data is written to a temporary file of the same directory then
+    renamed over the file, a crash while writing leaves the previous
+    content. The file is kept open, the agents find the running receiver
+    by the processes having it open.
+    """
+
+    def __init__(self, path):
+        super(AtomicJSONStorage, self).__init__()
+        self._path = path
+        self._handle = open(path, 'a')
+        # the file read or written last
+        self._identity = None
+
+    def _current(self):
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def changed(self):
+        """Return whether another process replaced the file."""
+        return self._current() != self._identity
+
+    def read(self):
+        self._identity = self._current()
+        with open(self._path) as f:
+            content = f.read()
+        if not content:
+            return None
+        return json.loads(content)
+
+    def write(self, data):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self._path) or '.',
+            prefix='.%s.' % os.path.basename(self._path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self._identity = self._current()
+        self._handle.close()
+        self._handle = open(self._path, 'a')
+
+    def close(self):
+        self._handle.close()
+
+
+class SyncMiddleware(middlewares.CachingMiddleware):
+    """Read from memory and write only on flush.
+
+    The writes are kept in memory until the driver syncs. The file
+    replaced by another process, the one running the receiver, is read
+    again on the next refresh.
+    """
+
+    WRITE_CACHE_SIZE = sys.maxsize
+
+    def read(self):
+        if self.cache is None:
+            self.cache = self.storage.read()
+            self._cache_modified_count = 0
+        return self.cache
+
+    def refresh(self):
+        """Read the file again on the next read if it was replaced.
+
+        The driver refreshes once by operation, the reads of the
+        operation do not look at the file.
+        """
+        if self.cache is not None and self.storage.changed():
+            self.cache = None
+
+
 class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
     """Tiny DB Driver for Dragonflow DB."""
 
     def __init__(self):
         """Constructor."""
         super(TinyDbDriver, self).__init__()
+        # document id of each key by table, to not scan the tables
+        self._keys = {}
+        # next document id by table
+        self._next_ids = {}
+        # content of the storage the indexes were built from
+        self._indexed = None
 
     ##########################################################################
     def initialize(self, db_ip, db_port, **args):
@@ -50,10 +142,56 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
     @property
     def _db(self):
         if not hasattr(self, '_db_obj'):
-            # open json file with tinyDb
-            self._db_obj = TinyDB(self._file_db)
+            # open json file with tinyDb, written on sync
+            self._db_obj = TinyDB(self._file_db,
+                                  storage=SyncMiddleware(AtomicJSONStorage))
         return self._db_obj
-        
+
+    def _refresh(self):
+        """Check once by operation whether another process wrote the file."""
+        refresh = getattr(self._db._storage, 'refresh', None)
+        if refresh:
+            refresh()
+
+    def _index(self, table):
+        """Return the document id of each key of table.
+
+        The index of a table is read from the table on first use then kept
+        in step with its inserts and removes. The indexes are read again
+        once the storage content is reloaded, the file replaced by another
+        process.
+        """
+        data = self._db._storage.read()
+        if data is None or data is not self._indexed:
+            self._keys.clear()
+            self._next_ids.clear()
+            self._indexed = data
+        index = self._keys.get(table)
+        if index is None:
+            index = dict((doc['key'], doc.doc_id)
+                         for doc in self._db.table(table).all())
+            self._keys[table] = index
+            self._next_ids[table] = max(index.values() or [0]) + 1
+        return index
+
+    def _documents(self, table):
+        """Return the content of the storage and the documents of table.
+
+        The TinyDB tables copy all their documents on every operation, the
+        documents are read and written here by id on the storage.
+        """
+        data = self._db._storage.read() or {}
+        return data, data.setdefault(table, {})
+
+    @staticmethod
+    def _doc_key(documents, doc_id):
+        """Return the key of a document, a string once read from JSON."""
+        return str(doc_id) if str(doc_id) in documents else doc_id
+
+    def _write(self, table, data):
+        self._db._storage.write(data)
+        self._db.table(table).clear_cache()
+
     def create_table(self, table):
         """Create a table.
 
@@ -61,6 +199,7 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :type table:       string
         :returns:          None
         """
+        self._refresh()
         self._db.table(table)
 
     def delete_table(self, table):
@@ -70,7 +209,11 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :type table:       string
         :returns:          None
         """
+        self._refresh()
         self._db.purge_table(table)
+        self._keys.pop(table, None)
+        self._next_ids.pop(table, None)
+        self.sync()
 
     def get_key(self, table, key, topic=None):
         """Get the value of a specific key in a table.
@@ -84,8 +227,12 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :returns:          string - the key value
         :raises:           DragonflowException.DBKeyNotFound if key not found
         """
-        t_entries = self._db.table(table)
-        entry = t_entries.get(Query().key == key)
+        self._refresh()
+        doc_id = self._index(table).get(key)
+        if doc_id is None:
+            return None
+        _, documents = self._documents(table)
+        entry = documents.get(self._doc_key(documents, doc_id))
         if entry:
             return entry['value']
         else:
@@ -105,11 +252,20 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :returns:          None
         :raises:           DragonflowException.DBKeyNotFound if key not found
         """
-        t_entries = self._db.table(table)
-        if t_entries.get(Query().key == key):
-            t_entries.update({'value': value}, Query().key == key)
+        self._refresh()
+        self._set_key(table, key, value, sync)
+
+    def _set_key(self, table, key, value, sync):
+        doc_id = self._index(table).get(key)
+        if doc_id is not None:
+            data, documents = self._documents(table)
+            documents[self._doc_key(documents, doc_id)] = {
+                'key': key, 'value': value}
+            self._write(table, data)
+            if sync:
+                self.sync()
         else:
-            self.create_key(table, key, value, topic)
+            self._create_key(table, key, value, sync)
 
     def create_key(self, table, key, value, topic=None, sync=True):
         """Create a specific key in a table with value.
@@ -124,8 +280,22 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :type topic:       string
         :returns:          None
         """
-        t_entries = self._db.table(table)
-        t_entries.insert({'key': key, 'value': value})
+        self._refresh()
+        self._create_key(table, key, value, sync)
+
+    def _create_key(self, table, key, value, sync):
+        index = self._index(table)
+        if key in index:
+            self._set_key(table, key, value, sync)
+            return
+        doc_id = self._next_ids[table]
+        self._next_ids[table] = doc_id + 1
+        data, documents = self._documents(table)
+        documents[doc_id] = {'key': key, 'value': value}
+        self._write(table, data)
+        index[key] = doc_id
+        if sync:
+            self.sync()
 
     def delete_key(self, table, key, topic=None, sync=True):
         """Delete a specific key from a table.
@@ -139,8 +309,14 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :returns:          None
         :raises:           DragonflowException.DBKeyNotFound if key not found
         """
-        t_entries = self._db.table(table)
-        t_entries.remove(Query().key == key)
+        self._refresh()
+        doc_id = self._index(table).pop(key, None)
+        if doc_id is not None:
+            data, documents = self._documents(table)
+            documents.pop(self._doc_key(documents, doc_id), None)
+            self._write(table, data)
+            if sync:
+                self.sync()
 
     def get_all_entries(self, table, topic=None):
         """Return a list of all table entries values.
@@ -152,6 +328,7 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :returns:          list of values
         :raises:           DragonflowException.DBKeyNotFound if key not found
         """
+        self._refresh()
         t_entries = self._db.table(table)
         res = []
         for entry in t_entries.all():
@@ -168,6 +345,7 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
         :returns:          list of keys
         :raises:           DragonflowException.DBKeyNotFound if key not found
         """
+        self._refresh()
         t_entries = self._db.table(table)
         res = []
         for entry in t_entries.all():
@@ -246,8 +424,14 @@ class TinyDbDriver(db_api.DbApi, df_agent_db.AgentDbDriver):
 
     ##########################################################################
     def sync(self):
-        pass
+        """Write the buffered changes to the JSON file."""
+        flush = getattr(self._db._storage, 'flush', None)
+        if flush:
+            flush()
 
     def clear_all(self):
+        self._refresh()
         self._db.purge_tables()
+        self._keys.clear()
+        self._next_ids.clear()
     ##########################################################################
@@ -4,10 +4,16 @@ eventlet.monkey_patch()
 
 import sys
 
+from networking_bambuk.common import agent_cache
 from networking_bambuk.common import config
+from networking_bambuk.common import outbox
+from networking_bambuk.common import prober
+from networking_bambuk.common import topic_map
 from networking_bambuk.common import update_actions
+from networking_bambuk.common import zones
 from networking_bambuk.common.config import timefunc
 from networking_bambuk.rpc.bambuk_rpc import BambukAgentClient
+from networking_bambuk.rpc import zeromq_rpc
 
 from neutron.common import rpc as n_rpc
 from neutron import service as neutron_service
@@ -28,8 +34,35 @@ class LogAgentWorker(n_rpc.Service):
     def __init__(self):
         super(LogAgentWorker, self).__init__(config.host(), 'bambuk')
         self._bambuk_client = BambukAgentClient()
+        if config.outbox():
+            self._bambuk_client.outbox = outbox.Outbox(self._bambuk_client)
+        if config.agent_state_ttl():
+            self._bambuk_client.agents = agent_cache.AgentStateCache(
+                self._bambuk_client)
+        if config.publisher_address():
+            self._bambuk_client.publisher = zeromq_rpc.ZeroMQPublisher(
+                config.publisher_address())
+            self._bambuk_client.topic_map = topic_map.TopicMap()
+        if config.relay():
+            self._bambuk_client.zones = zones.ZoneMap()
+        self._prober = None
+        if config.probe_interval():
+            self._prober = prober.AgentProber(self._bambuk_client)
 #         self._lock = threading.Lock()
 
+    def start(self):
+        super(LogAgentWorker, self).start()
+        if self._bambuk_client.outbox:
+            self._bambuk_client.outbox.start()
+        if self._bambuk_client.agents is not None:
+            self._bambuk_client.agents.start()
+        if self._bambuk_client.zones is not None:
+            self._bambuk_client.zones.start()
+        if self._bambuk_client.topic_map is not None:
+            self._bambuk_client.topic_map.start()
+        if self._prober:
+            self._prober.start()
+
     def process_log(self, context, **kwargs):
 #         self._lock.acquire()
         update_log = kwargs['log']
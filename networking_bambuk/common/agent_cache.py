@@ -0,0 +1,180 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import copy
+import eventlet
+import time
+import traceback
+
+from networking_bambuk.common import config
+
+from neutron import context as n_context
+from neutron import manager
+
+from oslo_log import log
+
+
+LOG = log.getLogger(__name__)
+
+
+class AgentEntry(object):
+    """The last known state of the agent of a vm."""
+
+    def __init__(self, server_conf, state):
+        self.server_conf = server_conf
+        self.state = state
+        self.updated_at = time.time()
+        self.alive = True
+        # the agent is known by neutron, create_or_update_agent was called
+        self.registered = False
+
+    def age(self, now=None):
+        return (now or time.time()) - self.updated_at
+
+
+class AgentStateCache(object):
+    """States of the vm agents, reused by the port updates for a while.
+
+    A state is reused for agent_state_ttl seconds, as long as the vm is
+    alive and is asked the same server_conf. The states about to expire
+    are refreshed in the background, in batches of bulk_concurrency vms,
+    and the neutron agents of the registered ones are updated: their
+    heartbeat keeps going without a port update.
+    """
+
+    def __init__(self, bambuk_client):
+        self._bambuk_client = bambuk_client
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, vm):
+        return vm in self._entries
+
+    @property
+    def _plugin(self):
+        return manager.NeutronManager.get_plugin()
+
+    def _fresh(self, vm, server_conf):
+        entry = self._entries.get(vm)
+        if (entry and entry.alive and entry.server_conf == server_conf and
+                entry.age() < config.agent_state_ttl()):
+            return entry
+        return None
+
+    def state(self, server_conf, vm):
+        """Return a copy of the state of the agent of vm and its entry.
+
+        The vm is asked its state only on a cache miss, the entry is None
+        if the vm did not answer.
+        """
+        entry = self._fresh(vm, server_conf)
+        if entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = self._fetch(vm, server_conf)
+            if not entry:
+                return None, None
+        return copy.deepcopy(entry.state), entry
+
+    def _fetch(self, vm, server_conf):
+        try:
+            state = self._bambuk_client.state(server_conf, vm)
+        except Exception:
+            LOG.warning('no state from %s, %s' % (vm, traceback.format_exc()))
+            state = None
+        return self.update(vm, server_conf, state)
+
+    def update(self, vm, server_conf, state):
+        """Record the state vm answered, None if it did not answer."""
+        entry = self._entries.get(vm)
+        if not state:
+            if entry:
+                entry.alive = False
+            return None
+        if entry and entry.server_conf == server_conf:
+            # the agent is still registered
+            entry.state = state
+            entry.updated_at = time.time()
+            entry.alive = True
+        else:
+            entry = AgentEntry(server_conf, state)
+            self._entries[vm] = entry
+        return entry
+
+    def applied(self, vm, connect_db):
+        """Record the revision of the connect_db applied to vm."""
+        entry = self._entries.get(vm)
+        if entry and 'revision' in entry.state:
+            entry.state['revision'] = max(
+                [entry.state['revision']] +
+                [e.get('revision') or 0 for e in connect_db])
+
+    def invalidate(self, vm):
+        self._entries.pop(vm, None)
+
+    def refresh(self):
+        """Refresh the states past half of their ttl."""
+        now = time.time()
+        ttl = config.agent_state_ttl()
+        for vm, entry in list(self._entries.items()):
+            if not entry.alive and entry.age(now) > ttl:
+                LOG.info('forgetting the agent of %s, dead since %ds' % (
+                    vm, entry.age(now)))
+                del self._entries[vm]
+        stale = [(vm, entry.server_conf)
+                 for vm, entry in self._entries.items()
+                 if entry.age(now) > ttl / 2.0]
+        if not stale:
+            return
+        pool = eventlet.GreenPool(config.bulk_concurrency())
+        alive = [entry for entry in pool.imap(
+            lambda args: self._fetch(*args), stale) if entry]
+        registered = [entry for entry in alive if entry.registered]
+        if registered and config.l2_population():
+            ctx = n_context.get_admin_context()
+            for entry in registered:
+                state = copy.deepcopy(entry.state)
+                state.pop('revision', None)
+                self._plugin.create_or_update_agent(ctx, state)
+        LOG.info('%d agent states refreshed, %d alive' % (
+            len(stale), len(alive)))
+
+    def stats(self):
+        now = time.time()
+        ages = [entry.age(now) for entry in self._entries.values()]
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries),
+                'alive': len([e for e in self._entries.values()
+                              if e.alive]),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'max_age': max(ages) if ages else 0,
+                'mean_age': sum(ages) / len(ages) if ages else 0}
+
+    def start(self):
+        eventlet.spawn_n(self._run)
+
+    def _run(self):
+        while True:
+            eventlet.sleep(config.agent_state_refresh_interval())
+            try:
+                self.refresh()
+            except Exception:
+                LOG.error('agent state refresh failed %s' %
+                          traceback.format_exc())
+            LOG.info('agent state cache %s' % self.stats())
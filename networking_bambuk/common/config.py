@@ -27,10 +27,158 @@ LOG = log.getLogger(__name__)
 bambuk_opts = [
     cfg.StrOpt('sender_pool',
                default='networking_bambuk.rpc.zeromq_rpc.ZeroMQSenderPool',
-               help=_('The client agent pool class implementation')),
+               help=_('The client agent pool class implementation: '
+                      'networking_bambuk.rpc.zeromq_rpc.ZeroMQSenderPool, '
+                      'networking_bambuk.rpc.zeromq_rpc.'
+                      'ZeroMQDealerSenderPool, '
+                      'networking_bambuk.rpc.asynctcp_rpc.'
+                      'AsyncTCPSenderPool or '
+                      'networking_bambuk.rpc.asyncio_rpc.'
+                      'AsyncioSenderPool (Python 3 only)')),
     cfg.StrOpt('receiver',
                default='networking_bambuk.rpc.zeromq_rpc.ZeroMQReceiver',
-               help=_('The client agent pool class implementation')),
+               help=_('The agent receiver class implementation: '
+                      'networking_bambuk.rpc.zeromq_rpc.ZeroMQReceiver '
+                      '(for both ZeroMQ sender pools), '
+                      'networking_bambuk.rpc.asynctcp_rpc.'
+                      'AsyncTCPReceiver or '
+                      'networking_bambuk.rpc.asyncio_rpc.'
+                      'AsyncioReceiver (Python 3 only)')),
+    cfg.IntOpt('receiver_workers',
+               default=64,
+               help=_('Maximum number of requests processed concurrently '
+                      'by the ZeroMQReceiver')),
+    cfg.IntOpt('pipeline_depth',
+               default=16,
+               help=_('Maximum number of outstanding requests to a vm with '
+                      'the ZeroMQDealerSenderPool')),
+    cfg.IntOpt('sender_cache_size',
+               default=1024,
+               help=_('Maximum number of ZeroMQ senders (sockets) kept '
+                      'open, the least recently used is closed first')),
+    cfg.IntOpt('sender_idle_timeout',
+               default=600,
+               help=_('Seconds after which an unused ZeroMQ sender is '
+                      'closed')),
+    cfg.IntOpt('bulk_concurrency',
+               default=600,
+               help=_('Maximum number of destinations delivered '
+                      'concurrently by a bulk send, the concurrency adapts '
+                      'to the observed latency up to this limit')),
+    cfg.IntOpt('bulk_deadline',
+               default=60,
+               help=_('Seconds to deliver all the destinations of a bulk '
+                      'send, the remaining ones are reported timed out')),
+    cfg.IntOpt('retry_attempts',
+               default=10,
+               help=_('Maximum number of attempts to send a message')),
+    cfg.FloatOpt('retry_base_delay',
+                 default=0.5,
+                 help=_('Base delay in seconds of the exponential backoff '
+                        'between two attempts')),
+    cfg.FloatOpt('retry_max_delay',
+                 default=30,
+                 help=_('Maximum delay in seconds between two attempts')),
+    cfg.IntOpt('sync_attempts',
+               default=2,
+               help=_('Maximum number of attempts of a call waiting for the '
+                      'reply of an agent, the state, apply and bootstrap of '
+                      'a port update')),
+    cfg.FloatOpt('sync_deadline',
+                 default=10,
+                 help=_('Maximum seconds of all the attempts of a call '
+                        'waiting for the reply of an agent')),
+    cfg.IntOpt('breaker_failure_threshold',
+               default=5,
+               help=_('Number of consecutive failures after which the '
+                      'sends to a destination are rejected')),
+    cfg.IntOpt('breaker_reset_timeout',
+               default=60,
+               help=_('Seconds after which a rejected destination is '
+                      'tried again')),
+    cfg.IntOpt('rpc_timeout',
+               default=5,
+               help=_('Seconds to wait at least for the reply of an apply, '
+                      'most of it is spent writing the agent database')),
+    cfg.FloatOpt('rpc_timeout_min',
+                 default=0.5,
+                 help=_('Minimum seconds to wait for the reply of an agent, '
+                        'the timeout adapts to its round trip time')),
+    cfg.FloatOpt('rpc_timeout_max',
+                 default=30,
+                 help=_('Maximum seconds to wait for the reply of an agent, '
+                        'the timeout adapts to its round trip time')),
+    cfg.StrOpt('codec',
+               default='msgpack',
+               help=_('The preferred wire codec (json|msgpack), negotiated '
+                      'with each agent, json is used as fallback')),
+    cfg.StrOpt('compression',
+               default='zlib',
+               help=_('The compression (zlib|none) of the large messages, '
+                      'used only with the agents supporting it')),
+    cfg.IntOpt('compression_threshold',
+               default=16384,
+               help=_('Size in bytes from which the messages sent to the '
+                      'agents are compressed')),
+    cfg.IntOpt('connection_idle_timeout',
+               default=300,
+               help=_('Seconds after which an unused connection to an agent '
+                      'is closed')),
+    cfg.IntOpt('max_frame_size',
+               default=64 * 1024 * 1024,
+               help=_('Maximum size in bytes of a message received on a '
+                      'TCP connection, a peer announcing a larger one is '
+                      'disconnected')),
+    cfg.IntOpt('shadow_size',
+               default=10000,
+               help=_('Maximum number of vms whose content is tracked to '
+                      'send them only the mutations changing it, 0 to '
+                      'disable')),
+    cfg.BoolOpt('outbox',
+                default=False,
+                help=_('Queue in the neutron DB the mutations that could not '
+                       'be delivered to an agent and deliver them later')),
+    cfg.IntOpt('outbox_drain_interval',
+               default=10,
+               help=_('Seconds between two deliveries of the queued '
+                      'mutations')),
+    cfg.IntOpt('agent_state_ttl',
+               default=0,
+               help=_('Seconds the state of an agent is cached and reused '
+                      'by the port updates, which then send the agent only '
+                      'the entries changed since the revision of its '
+                      'state, 0 to disable')),
+    cfg.BoolOpt('bootstrap',
+                default=False,
+                help=_('Ask the state of the agents whose state is not '
+                       'cached in the reply of their apply, they are then '
+                       'applied all their connect_db. Without the cache of '
+                       'agent_state_ttl every port update bootstraps its '
+                       'agent, otherwise the state is asked then the '
+                       'entries changed since its revision are applied')),
+    cfg.IntOpt('agent_state_refresh_interval',
+               default=60,
+               help=_('Seconds between two refreshes of the cached agent '
+                      'states about to expire')),
+    cfg.IntOpt('probe_interval',
+               default=0,
+               help=_('Seconds between two probes of all the vm agents, 0 '
+                      'to disable')),
+    cfg.BoolOpt('relay',
+                default=False,
+                help=_('Send the updates and deletes of the vms of a zone '
+                       'to one of them, the relay, which forwards them to '
+                       'the other ones')),
+    cfg.IntOpt('relay_min_zone_size',
+               default=8,
+               help=_('Minimum number of destinations in a zone to send '
+                      'them through a relay')),
+    cfg.StrOpt('publisher_address',
+               default='',
+               help=_('ZeroMQ address the agents subscribe to, '
+                      'tcp://<log agent ip>:<port>, to receive the updates '
+                      'and deletes published once by topic, empty to send '
+                      'them to every vm')),
     cfg.StrOpt('db_dir',
                default='/var/lib/bambuk',
                help=_('The DB folder')),
@@ -92,6 +240,130 @@ def receiver():
     return cfg.CONF.bambuk.receiver
 
 
+def receiver_workers():
+    return cfg.CONF.bambuk.receiver_workers
+
+
+def codec():
+    return cfg.CONF.bambuk.codec
+
+
+def compression():
+    return cfg.CONF.bambuk.compression
+
+
+def compression_threshold():
+    return cfg.CONF.bambuk.compression_threshold
+
+
+def connection_idle_timeout():
+    return cfg.CONF.bambuk.connection_idle_timeout
+
+
+def max_frame_size():
+    return cfg.CONF.bambuk.max_frame_size
+
+
+def pipeline_depth():
+    return cfg.CONF.bambuk.pipeline_depth
+
+
+def sender_cache_size():
+    return cfg.CONF.bambuk.sender_cache_size
+
+
+def sender_idle_timeout():
+    return cfg.CONF.bambuk.sender_idle_timeout
+
+
+def bulk_concurrency():
+    return cfg.CONF.bambuk.bulk_concurrency
+
+
+def bulk_deadline():
+    return cfg.CONF.bambuk.bulk_deadline
+
+
+def retry_attempts():
+    return cfg.CONF.bambuk.retry_attempts
+
+
+def retry_base_delay():
+    return cfg.CONF.bambuk.retry_base_delay
+
+
+def retry_max_delay():
+    return cfg.CONF.bambuk.retry_max_delay
+
+
+def sync_attempts():
+    return cfg.CONF.bambuk.sync_attempts
+
+
+def sync_deadline():
+    return cfg.CONF.bambuk.sync_deadline
+
+
+def breaker_failure_threshold():
+    return cfg.CONF.bambuk.breaker_failure_threshold
+
+
+def breaker_reset_timeout():
+    return cfg.CONF.bambuk.breaker_reset_timeout
+
+
+def rpc_timeout():
+    return cfg.CONF.bambuk.rpc_timeout
+
+
+def rpc_timeout_min():
+    return cfg.CONF.bambuk.rpc_timeout_min
+
+
+def rpc_timeout_max():
+    return cfg.CONF.bambuk.rpc_timeout_max
+
+
+def shadow_size():
+    return cfg.CONF.bambuk.shadow_size
+
+
+def outbox():
+    return cfg.CONF.bambuk.outbox
+
+
+def outbox_drain_interval():
+    return cfg.CONF.bambuk.outbox_drain_interval
+
+
+def agent_state_ttl():
+    return cfg.CONF.bambuk.agent_state_ttl
+
+
+def bootstrap():
+    return cfg.CONF.bambuk.bootstrap
+
+
+def agent_state_refresh_interval():
+    return cfg.CONF.bambuk.agent_state_refresh_interval
+
+
+def probe_interval():
+    return cfg.CONF.bambuk.probe_interval
+
+
+def relay():
+    return cfg.CONF.bambuk.relay
+
+
+def relay_min_zone_size():
+    return cfg.CONF.bambuk.relay_min_zone_size
+
+
+def publisher_address():
+    return cfg.CONF.bambuk.publisher_address
+
+
 def db_dir():
     return cfg.CONF.bambuk.db_dir
 
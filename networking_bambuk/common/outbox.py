@@ -0,0 +1,138 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import traceback
+
+from networking_bambuk.common import config
+from networking_bambuk.db.bambuk import bambuk_db
+from networking_bambuk.rpc import delivery
+
+from neutron import context as n_context
+
+from oslo_log import log
+
+from oslo_serialization import jsonutils
+
+
+LOG = log.getLogger(__name__)
+
+# attempts by vm of a drain, the next drain tries again
+DRAIN_ATTEMPTS = 1
+
+
+class Outbox(object):
+    """Mutations pending delivery to the vms, stored in the neutron DB.
+
+    The mutations of a vm are coalesced by (table, key), only the latest
+    one is kept, and are delivered in order once the vm is reachable:
+    the updates first then the deletes.
+    """
+
+    def __init__(self, bambuk_client):
+        self._bambuk_client = bambuk_client
+
+    def destinations(self):
+        ctx = n_context.get_admin_context()
+        return bambuk_db.get_outbox_destinations(ctx)
+
+    def add(self, method, connect_db, vms):
+        if not isinstance(connect_db, list):
+            connect_db = [connect_db]
+        ctx = n_context.get_admin_context()
+        with ctx.session.begin(subtransactions=True):
+            for vm in vms:
+                for entry in connect_db:
+                    value = entry.get('value')
+                    if value is not None:
+                        value = jsonutils.dumps(value)
+                    bambuk_db.add_outbox_entry(
+                        ctx, vm, entry['table'], entry['key'], method, value)
+        LOG.info('%d mutations queued for %s' % (len(connect_db), vms))
+
+    def last_id(self, vm):
+        """Return the id of the last mutation queued for vm, see clear."""
+        ctx = n_context.get_admin_context()
+        return bambuk_db.get_outbox_last_id(ctx, vm)
+
+    def clear(self, vm, last_id):
+        """Forget the mutations of vm queued up to last_id.
+
+        The mutations queued meanwhile, even for the same keys, have a
+        greater id and are kept.
+        """
+        ctx = n_context.get_admin_context()
+        with ctx.session.begin(subtransactions=True):
+            bambuk_db.delete_outbox_entries(ctx, vm, last_id)
+
+    def drain(self):
+        """Deliver the queued mutations of all the vms.
+
+        The vms are delivered together, each with its own mutations, in a
+        bulk send bounded by DRAIN_ATTEMPTS and bulk_deadline: the vms
+        still unreachable wait for the next drain without holding the
+        other ones. The vms known dead are not even tried.
+        """
+        ctx = n_context.get_admin_context()
+        pending = {}
+        for vm in bambuk_db.get_outbox_destinations(ctx):
+            if delivery.is_open(vm):
+                LOG.debug('%s still unreachable' % vm)
+                continue
+            pending[vm] = bambuk_db.get_outbox_entries(ctx, vm)
+        if not pending:
+            return
+        delivered = set(pending)
+        for method in ('update', 'delete'):
+            connect_dbs = {}
+            for vm in delivered:
+                connect_db = self._connect_db(method, pending[vm])
+                if connect_db:
+                    connect_dbs[vm] = connect_db
+            if not connect_dbs:
+                continue
+            report = self._bambuk_client.deliver(
+                method, connect_dbs, attempts=DRAIN_ATTEMPTS)
+            if report.stragglers:
+                LOG.warning('the outbox %s of %s not delivered' % (
+                    method, report.stragglers))
+            # the deletes of a vm follow its updates
+            delivered -= set(report.stragglers)
+        with ctx.session.begin(subtransactions=True):
+            for vm in delivered:
+                for entry in pending[vm]:
+                    bambuk_db.delete_outbox_entry(ctx, entry)
+        LOG.info('queued mutations delivered to %d of %d vms' % (
+            len(delivered), len(pending)))
+
+    @staticmethod
+    def _connect_db(method, entries):
+        connect_db = []
+        for entry in entries:
+            if (entry.action_type == 'delete') != (method == 'delete'):
+                continue
+            item = {'table': entry.table_name, 'key': entry.key}
+            if method != 'delete':
+                item['value'] = jsonutils.loads(entry.value)
+            connect_db.append(item)
+        return connect_db
+
+    def start(self):
+        eventlet.spawn_n(self._run)
+
+    def _run(self):
+        while True:
+            eventlet.sleep(config.outbox_drain_interval())
+            try:
+                self.drain()
+            except Exception:
+                LOG.error('outbox drain failed %s' % traceback.format_exc())
@@ -12,7 +12,9 @@
 #    under the License.
 #
 
+import calendar
 import netaddr
+import six
 
 from neutron import context as n_context
 from neutron.extensions import allowedaddresspairs as addr_pair
@@ -21,11 +23,34 @@ from neutron import manager
 
 from oslo_log import log as o_log
 
-from oslo_serialization import jsonutils
+from oslo_utils import timeutils
 
 LOG = o_log.getLogger(__name__)
 
 
+def revision(*objs):
+    """Return the revision of a content built from neutron objects.
+
+    It is the last update time of the objects, in seconds since the epoch,
+    0 if unknown. Unlike their revision_number it orders the changes of
+    different objects.
+    """
+    res = 0
+    for obj in objs:
+        updated_at = obj and (obj.get('updated_at') or obj.get('created_at'))
+        if not updated_at:
+            continue
+        if isinstance(updated_at, six.string_types):
+            updated_at = timeutils.parse_isotime(updated_at)
+        res = max(res, calendar.timegm(updated_at.utctimetuple()))
+    return res
+
+
+def version(obj):
+    """Return the version of an object, its neutron revision_number."""
+    return obj.get('revision_number', 1)
+
+
 def lport(port):
     ips = [ip['ip_address'] for ip in port.get('fixed_ips', [])]
     subnets = [ip['subnet_id'] for ip in port.get('fixed_ips', [])]
@@ -53,7 +78,7 @@ def lport(port):
     lport['extra_dhcp_opts'] = port.get('extra_dhcp_opts')
     lport['device_owner'] = port.get('device_owner')
     lport['device_id'] = port.get('device_id')
-    lport['version'] = 1
+    lport['version'] = version(port)
     lport['qos_policy_id'] = None
     lport['binding_vnic_type'] = port.get('binding:vnic_type')
   
@@ -66,7 +91,7 @@ def lsecgroup(sg):
     secgroup['topic'] = sg['tenant_id']
     secgroup['name'] = sg.get('name', 'no_sg_name')
     secgroup['rules'] = []
-    secgroup['version'] = 1
+    secgroup['version'] = version(sg)
     for sgr in sg['security_group_rules']:
         secgroupr = {}
         for k in ['id', 'direction', 'protocol', 'port_range_max',
@@ -74,8 +99,7 @@ def lsecgroup(sg):
                   'security_group_id', 'port_range_min', 'ethertype']:
             secgroupr[k] = sgr[k]
         secgroupr['topic'] = sg['tenant_id']
-        secgroupr['version'] = 1
-        secgroupr['version'] = 1
+        secgroupr['version'] = version(sgr)
         secgroup['rules'].append(secgroupr)
     secgroup['unique_key'] = sg['standard_attr_id']
     return secgroup
@@ -105,7 +129,7 @@ def lswitch(network, subnets):
     lswitch['mtu'] = network.get('mtu')
     lswitch['subnets'] = [lsubnet(subnet) for subnet in subnets]
     lswitch['unique_key'] = network['standard_attr_id']
-    lswitch['version'] = 1
+    lswitch['version'] = version(network)
     return lswitch
 
 
@@ -143,6 +167,8 @@ class BambukPortInfo(object):
             filters={'network_id': [port['network_id']]})
         for subnet in _subnets:
             subnets[subnet['id']] = subnet
+        self._revisions[('lswitch', network['id'])] = revision(
+            network, *_subnets)
         return lswitch(network, _subnets), network
 
     # TODO(lionelz): As the segmentation ID code is commented out,
@@ -159,6 +185,9 @@ class BambukPortInfo(object):
     def _calculate_obj(self):
         ctx = n_context.get_admin_context()
 
+        # revision of the entries by (table, key)
+        self._revisions = {}
+
         # logical switch
         subnets = {}
         self.lswitches = {}
@@ -175,18 +204,24 @@ class BambukPortInfo(object):
         # port
         if self._port:
             self.lport = lport(self._port)
+            self._revisions[('lport', self._port['id'])] = revision(
+                self._port)
         else:
             self.lport = None
 
         # router
         self.lrouter = self._lrouter(
             self._router, self._router_ports, subnets)
+        if self._router:
+            self._revisions[('lrouter', self._router['id'])] = revision(
+                self._router, *self._router_ports)
 
         # other ports
         self.other_lports = []
         for port in self._other_ports:
             if port.get('device_owner').startswith('compute:'):
                 self.other_lports.append(lport(port))
+                self._revisions[('lport', port['id'])] = revision(port)
 
         # security groups
         self.secgroup = []
@@ -195,6 +230,8 @@ class BambukPortInfo(object):
                 ctx, {'id': self.lport['security_groups']})
             for sg in sgs:
                 self.secgroup.append(lsecgroup(sg))
+                self._revisions[('secgroup', sg['id'])] = revision(
+                    sg, *sg['security_group_rules'])
 
         # list of chassis
         self.chassis = []
@@ -207,6 +244,25 @@ class BambukPortInfo(object):
                     'id': tunnel['host'],
                 })
 
+    def topics(self):
+        """Return the topics the vm of the port subscribes to.
+
+        The networks it reaches and the security groups of its port.
+        """
+        topics = set(self.lswitches)
+        if self.lport:
+            topics.update(self.lport['security_groups'] or [])
+        return sorted(topics)
+
+    def _entry(self, table, key, value):
+        """Return a connect_db entry, with the revision of its content."""
+        return {
+            'table': table,
+            'key': key,
+            'value': value,
+            'revision': self._revisions.get((table, key), 0)
+        }
+
     def port_db(self, c_db_in=None):
         """Return a DB representation of the ports."""
         if c_db_in:
@@ -214,11 +270,7 @@ class BambukPortInfo(object):
         else:
             c_db = []
         if self.lport:
-            c_db.append({
-                'table': 'lport',
-                'key': self.lport['id'],
-                'value': jsonutils.dumps(self.lport)
-            })
+            c_db.append(self._entry('lport', self.lport['id'], self.lport))
         return c_db
 
     def chassis_db(self, c_db_in=None, chassis_to_include=None):
@@ -230,11 +282,7 @@ class BambukPortInfo(object):
         # list of chassis
         for chassis in self.chassis:
             if not chassis_to_include or chassis['id'] in chassis_to_include:
-                c_db.append({
-                    'table': 'chassis',
-                    'key': chassis['id'],
-                    'value': jsonutils.dumps(chassis)
-                })
+                c_db.append(self._entry('chassis', chassis['id'], chassis))
         return c_db
 
     def lswitch_db(self, c_db_in=None):
@@ -244,11 +292,8 @@ class BambukPortInfo(object):
         else:
             c_db = []
         for lswitch_id in self.lswitches:
-            c_db.append({
-                'table': 'lswitch',
-                'key': lswitch_id,
-                'value': jsonutils.dumps(self.lswitches[lswitch_id])
-            })
+            c_db.append(self._entry(
+                'lswitch', lswitch_id, self.lswitches[lswitch_id]))
         return c_db
 
     def lrouter_db(self, c_db_in=None):
@@ -258,11 +303,8 @@ class BambukPortInfo(object):
         else:
             c_db = []
         if self.lrouter:
-            c_db.append({
-                'table': 'lrouter',
-                'key': self.lrouter['id'],
-                'value': jsonutils.dumps(self.lrouter)
-            })
+            c_db.append(self._entry(
+                'lrouter', self.lrouter['id'], self.lrouter))
         return c_db
 
     def to_db(self):
@@ -271,19 +313,11 @@ class BambukPortInfo(object):
 
         # list of other ports
         for port in self.other_lports:
-            port_connect_db.append({
-                'table': 'lport',
-                'key': port['id'],
-                'value': jsonutils.dumps(port)
-            })
+            port_connect_db.append(self._entry('lport', port['id'], port))
 
         # security groups
         for sg in self.secgroup:
-            port_connect_db.append({
-                'table': 'secgroup',
-                'key': sg['id'],
-                'value': jsonutils.dumps(sg)
-            })
+            port_connect_db.append(self._entry('secgroup', sg['id'], sg))
 
         # logical switch
         self.lswitch_db(port_connect_db)
@@ -324,5 +358,5 @@ class BambukPortInfo(object):
         lrouter['ports'] = (
             [self._lrouter_port(port, subnets) for port in router_ports]
         )
-        lrouter['version'] = 1
+        lrouter['version'] = version(router)
         return lrouter
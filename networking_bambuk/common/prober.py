@@ -0,0 +1,129 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import time
+import traceback
+
+from networking_bambuk.common import config
+from networking_bambuk.common import update_actions
+from networking_bambuk.rpc import delivery
+
+from neutron import context as n_context
+from neutron import manager
+
+from oslo_log import log
+
+
+LOG = log.getLogger(__name__)
+
+
+class AgentProber(object):
+    """Ask all the vm agents their state every probe_interval seconds.
+
+    The vms are found in the neutron ports and probed in batches of
+    bulk_concurrency. Like any other request, the probes measure the round
+    trip times to the vms and their failures open the circuits of the dead
+    ones. The states answered go to the agent state cache and to the
+    neutron agents. The vms having missed published mutations get their
+    whole connect_db applied.
+    """
+
+    def __init__(self, bambuk_client):
+        self._bambuk_client = bambuk_client
+        # a port of every vm
+        self._port_ids = {}
+
+    @property
+    def _plugin(self):
+        return manager.NeutronManager.get_plugin()
+
+    def destinations(self, ctx):
+        vms = {}
+        port_ids = {}
+        for port in self._plugin.get_ports(
+                ctx, fields=['id', 'binding:profile', 'binding:host_id']):
+            provider_port = update_actions.Action._get_provider_port(
+                ctx, port)
+            if provider_port:
+                vms[provider_port['provider_mgnt_ip']] = (
+                    update_actions.get_server_conf(provider_port))
+                port_ids[provider_port['provider_mgnt_ip']] = port['id']
+        self._port_ids = port_ids
+        return vms
+
+    def _probe(self, vm, conf):
+        try:
+            return vm, self._bambuk_client.state(conf, vm)
+        except delivery.CircuitOpen:
+            return vm, None
+        except Exception:
+            LOG.debug('no state from %s, %s' % (vm, traceback.format_exc()))
+            return vm, None
+
+    def probe(self):
+        """Probe all the vms, return the states of the alive ones."""
+        ctx = n_context.get_admin_context()
+        vms = self.destinations(ctx)
+        pool = eventlet.GreenPool(config.bulk_concurrency())
+        states = {}
+        ts = time.time()
+        for vm, state in pool.imap(lambda item: self._probe(*item),
+                                   vms.items()):
+            if state:
+                states[vm] = state
+        LOG.info('%d vms probed in %2.2fs, %d dead' % (
+            len(vms), time.time() - ts, len(vms) - len(states)))
+
+        agent_cache = self._bambuk_client.agents
+        entries = {}
+        if agent_cache is not None:
+            for vm, conf in vms.items():
+                entries[vm] = agent_cache.update(vm, conf, states.get(vm))
+        if states and config.l2_population():
+            self._register(ctx, states, entries)
+        self._resync(states)
+        return states
+
+    def _resync(self, states):
+        """Apply the whole connect_db of the vms having missed mutations."""
+        for vm in self._bambuk_client.resyncs.intersection(states):
+            LOG.info('%s missed published mutations, applying all' % vm)
+            try:
+                update_actions.PortUpdateAction(
+                    {'obj_id': self._port_ids[vm]},
+                    self._bambuk_client).process()
+            except Exception:
+                LOG.error('resync of %s failed %s' % (
+                    vm, traceback.format_exc()))
+
+    def _register(self, ctx, states, entries):
+        """Create or update the neutron agents in a single transaction."""
+        with ctx.session.begin(subtransactions=True):
+            for vm, state in states.items():
+                agent_state = dict(state)
+                agent_state.pop('revision', None)
+                self._plugin.create_or_update_agent(ctx, agent_state)
+        for entry in entries.values():
+            if entry:
+                entry.registered = True
+
+    def start(self):
+        eventlet.spawn_n(self._run)
+
+    def _run(self):
+        while True:
+            eventlet.sleep(config.probe_interval())
+            try:
+                self.probe()
+            except Exception:
+                LOG.error('agent probe failed %s' % traceback.format_exc())
@@ -0,0 +1,123 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import traceback
+
+from networking_bambuk.common import config
+from networking_bambuk.common import update_actions
+
+from neutron import context as n_context
+from neutron import manager
+from neutron.plugins.common import constants as p_const
+
+from oslo_log import log
+
+
+LOG = log.getLogger(__name__)
+
+
+class TopicMap(object):
+    """The vms of every topic, the subscribers of port_infos.topics().
+
+    A vm subscribes to the networks its port reaches, through the router
+    of its network, and to the security groups of its port. The map is
+    read from the neutron DB every probe_interval seconds (60 if the
+    probes are disabled), the vms applied meanwhile are added with the
+    topics of their subscription.
+    """
+
+    DEFAULT_REFRESH_INTERVAL = 60
+
+    def __init__(self):
+        self._vms = None
+
+    @property
+    def _plugin(self):
+        return manager.NeutronManager.get_plugin()
+
+    @property
+    def _l3_plugin(self):
+        return manager.NeutronManager.get_service_plugins().get(
+            p_const.L3_ROUTER_NAT)
+
+    def loaded(self):
+        return self._vms is not None
+
+    def vms(self, topics):
+        """Return the vms of any of topics."""
+        vms = set()
+        for topic in topics:
+            vms.update(self._vms.get(topic, ()))
+        return vms
+
+    def add(self, vm, topics):
+        if self._vms is None:
+            return
+        for topic in topics:
+            self._vms.setdefault(topic, set()).add(vm)
+
+    def _reached_networks(self, ctx, ports):
+        """Return the networks reached from each network with a router.
+
+        As in the port updates, a network reaches the networks of its
+        distributed router when the router is up.
+        """
+        router_networks = {}
+        for port in ports:
+            if (port.get('device_owner') in
+                    update_actions.ROUTER_INTERFACE_OWNERS):
+                router_networks.setdefault(
+                    port['device_id'], set()).add(port['network_id'])
+        reached = {}
+        for router_id, networks in router_networks.items():
+            router = self._l3_plugin.get_router(ctx, router_id)
+            if not (router['admin_state_up'] and router['distributed']):
+                continue
+            for network_id in networks:
+                reached.setdefault(network_id, set()).update(networks)
+        return reached
+
+    def refresh(self):
+        ctx = n_context.get_admin_context()
+        ports = self._plugin.get_ports(
+            ctx, fields=['binding:profile', 'binding:host_id', 'network_id',
+                         'security_groups', 'device_owner', 'device_id'])
+        reached = self._reached_networks(ctx, ports)
+        vms = {}
+        for port in ports:
+            provider_port = update_actions.Action._get_provider_port(
+                ctx, port)
+            if not provider_port:
+                continue
+            topics = reached.get(port['network_id'],
+                                 set([port['network_id']]))
+            topics = topics.union(port.get('security_groups') or [])
+            for topic in topics:
+                vms.setdefault(topic, set()).add(
+                    provider_port['provider_mgnt_ip'])
+        self._vms = vms
+        LOG.info('%d topics of %d vms' % (
+            len(vms), len(set().union(*vms.values()))))
+
+    def start(self):
+        eventlet.spawn_n(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                LOG.error('topic map refresh failed %s' %
+                          traceback.format_exc())
+            eventlet.sleep(config.probe_interval() or
+                           self.DEFAULT_REFRESH_INTERVAL)
@@ -20,8 +20,6 @@ from networking_bambuk.db.bambuk import bambuk_db
 
 from oslo_log import log as o_log
 
-from oslo_serialization import jsonutils
-
 
 # Defined in neutron_lib.constants
 ROUTER_INTERFACE_OWNERS = {
@@ -69,6 +67,14 @@ db_base_plugin_v2.NeutronDbPluginV2.register_dict_extend_funcs(
     l3.ROUTERS, [_extend_dict_std_attr_id])
 
 
+def get_server_conf(provider_port):
+    """Return the conf sent to the agent of the vm of provider_port."""
+    return {
+        'device_id': provider_port['host_id'],
+        'local_ip': provider_port['provider_ip']
+    }
+
+
 class Action(object):
     """Base class for Action handlers."""
 
@@ -150,7 +156,58 @@ class Action(object):
         """Actual worker method."""
         pass
 
-    def _get_provider_port(self, ctx, port):
+    def _distribute(self, method, connect_db, topics, ports,
+                    exclude_ids=None):
+        """Send connect_db to the vms holding ports.
+
+        With a publisher an update is published once on each topic and
+        sent only to the vms of the topics not confirmed subscribing. The
+        deletes are sent to the vms of ports only: the subscribers of a
+        network include the vms reaching it through a router, which keep
+        the entries deleted for the others.
+        :param method: update or delete
+        :param topics: the networks or security groups of connect_db
+        """
+        vms = None
+        if (method == 'update' and topics and
+                self._bambuk_client.publisher is not None):
+            vms = self._bambuk_client.publish(method, connect_db, topics)
+        if vms is None:
+            vms = self._get_vms(ports, exclude_ids)
+        elif not vms:
+            return None
+        return getattr(self, '_' + method)(connect_db, vms)
+
+    def _update(self, connect_db_update, vms):
+        report = self._bambuk_client.update(connect_db_update, vms)
+        return self._check_report(report, 'update', connect_db_update)
+
+    def _delete(self, connect_db_delete, vms):
+        report = self._bambuk_client.delete(connect_db_delete, vms)
+        return self._check_report(report, 'delete', connect_db_delete)
+
+    def _check_report(self, report, method, connect_db):
+        """Give the vms that timed out in a bulk send a second chance.
+
+        With the outbox enabled they are already queued, otherwise they
+        are sent again once, with a new deadline.
+        """
+        LOG.info('%s %s' % (method, report))
+        timed_out = report.timed_out
+        if not timed_out:
+            return report
+        LOG.warning('%s timed out for %s' % (method, timed_out))
+        if self._bambuk_client.outbox:
+            return report
+        retry = getattr(self._bambuk_client, method)(connect_db, timed_out)
+        for vm in timed_out:
+            report.add(vm, retry[vm], retry.latencies.get(vm, 0))
+        if retry.stragglers:
+            LOG.error('%s not delivered to %s' % (method, retry.stragglers))
+        return report
+
+    @staticmethod
+    def _get_provider_port(ctx, port):
         """Get the port provider port for a given port."""
 
 #         LOG.debug('%s', port)
@@ -319,10 +376,7 @@ class PortUpdateAction(Action):
         if not provider_port:
             return
 
-        server_conf = {
-            'device_id': provider_port['host_id'],
-            'local_ip': provider_port['provider_ip']
-        }
+        server_conf = get_server_conf(provider_port)
 
         # TODO(snapiri): At the moment we assume a network is connected
         #                to a single router at most.
@@ -341,22 +395,43 @@ class PortUpdateAction(Action):
             port_db, other_ports, endpoints, router, router_ports)
 
         # update all other ports for the possible new endpoint
-        vms = self._get_vms(other_ports, [port['id']])
         update_connect_db = port_info.port_db()
         update_connect_db = port_info.chassis_db(
             update_connect_db, [port_info.lport['chassis']])
-        self._bambuk_client.update(update_connect_db, vms)
+        networks = set([port['network_id']] +
+                       [r_port['network_id'] for r_port in router_ports])
+        self._distribute('update', update_connect_db, sorted(networks),
+                         other_ports, [port['id']])
         eventlet.sleep(0)
 
         # get agent state
-        agent_state = self._bambuk_client.state(
-            server_conf, provider_port['provider_mgnt_ip'])
+        vm = provider_port['provider_mgnt_ip']
+        agent_cache = self._bambuk_client.agents
+        connect_db = port_info.to_db()
+        applied = None
+        cached = None
+        if config.bootstrap() and (agent_cache is None or
+                                   vm not in agent_cache):
+            # a vm unknown yet answers its state with its apply, all its
+            # entries are sent: with the cache only its misses bootstrap
+            # and the vms cached catch up from their revision
+            agent_state, applied = self._bambuk_client.bootstrap(
+                server_conf, connect_db, vm, topics=port_info.topics())
+            if agent_state and agent_cache is not None:
+                cached = agent_cache.update(vm, server_conf,
+                                            dict(agent_state))
+        elif agent_cache is not None:
+            agent_state, cached = agent_cache.state(server_conf, vm)
+        else:
+            agent_state = self._bambuk_client.state(server_conf, vm)
         if not agent_state:
             return
+        # the agents reporting a revision catch up from it
+        revision = agent_state.pop('revision', None)
 
         # TODO(lionelz): add tunnel_types to the port data profile
         #                to support other than vxlan
-        if config.l2_population():
+        if config.l2_population() and not (cached and cached.registered):
             # create or update the agent
             agent = self._plugin.create_or_update_agent(
                 ctx, agent_state)
@@ -371,9 +446,16 @@ class PortUpdateAction(Action):
             LOG.debug(agents)
             if not agents or len(agents) == 0:
                 return
-
-        self._bambuk_client.apply(
-            port_info.to_db(), provider_port['provider_mgnt_ip'])
+            if cached:
+                cached.registered = True
+
+        if applied is None:
+            applied = self._bambuk_client.apply(
+                connect_db, vm, since=revision, topics=port_info.topics())
+            if applied and agent_cache is not None:
+                agent_cache.applied(vm, connect_db)
+        if not applied and agent_cache is not None:
+            agent_cache.invalidate(vm)
         eventlet.sleep(0)
 
         for tunnel_type in agent_state['configurations']['tunnel_types']:
@@ -467,13 +549,11 @@ class SecurityGroupUpdateAction(Action):
         # get all the ports connected to the sg
         ctx = n_context.get_admin_context()
         sg, ports = self._get_ports_by_sg_id(ctx, self._log['obj_id'])
-        vms = self._get_vms(ports)
-
-        self._bambuk_client.update({
+        self._distribute('update', {
                 'table': 'secgroup',
                 'key': sg['id'],
-                'value': jsonutils.dumps(port_infos.lsecgroup(sg))
-        }, vms)
+                'value': port_infos.lsecgroup(sg)
+        }, [sg['id']], ports)
 
 
 class RouterUpdateAction(Action):
@@ -523,12 +603,12 @@ class RouterUpdateAction(Action):
                     continue
                 # Send delete message to the connected ports for
                 #  the detached ports
-                vms = self._get_vms(conneted_ports)
                 endpoints, _ = self._get_endpoints(detached_ports)
                 port_info = port_infos.BambukPortInfo(None, detached_ports,
                                                       endpoints,
                                                       router, [port_2])
-                self._bambuk_client.delete(port_info.to_db(), vms)
+                self._distribute('delete', port_info.to_db(),
+                                 [port['network_id']], conneted_ports)
 
 
 class RouterIfaceAttachAction(Action):
@@ -570,8 +650,9 @@ class RouterIfaceAttachAction(Action):
                                               router, router_ports)
 
         # Update all other ports on the possibly new endpoint
-        vms = self._get_vms(ports)
-        self._bambuk_client.update(port_info.to_db(), vms)
+        networks = set(port['network_id'] for port in router_ports)
+        self._distribute('update', port_info.to_db(), sorted(networks),
+                         ports)
 
 
 class RouterIfaceDetachAction(Action):
@@ -616,23 +697,25 @@ class RouterIfaceDetachAction(Action):
 
         if len(connected_ports):
             # Disconnect 1
-            vms = self._get_vms(connected_ports)
             endpoints, _ = self._get_endpoints(ctx, detached_ports)
             port_info = port_infos.BambukPortInfo(None, detached_ports,
                                                   endpoints,
                                                   None, None)
             # TODO(snapiri): We should also send delete to the lswitch
-            self._bambuk_client.delete(port_info.to_db(), vms)
+            networks = set(r_port['network_id']
+                           for r_port in connected_router_ports)
+            self._distribute('delete', port_info.to_db(), sorted(networks),
+                             connected_ports)
 
         # Disconnect 2
-        vms = self._get_vms(detached_ports)
         endpoints = []
         if len(connected_ports):
             endpoints, _ = self._get_endpoints(ctx, connected_ports)
         port_info = port_infos.BambukPortInfo(None, connected_ports,
                                               endpoints,
                                               router, connected_router_ports)
-        self._bambuk_client.delete(port_info.to_db(), vms)
+        self._distribute('delete', port_info.to_db(),
+                         [detached_network['id']], detached_ports)
 
 
 ACTIONS_CLASS = {
@@ -0,0 +1,83 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import traceback
+
+from networking_bambuk.common import config
+from networking_bambuk.common import update_actions
+from networking_bambuk.ml2 import bambuk_type_vxlan
+
+from neutron import context as n_context
+from neutron import manager
+
+from oslo_log import log
+
+
+LOG = log.getLogger(__name__)
+
+
+class ZoneMap(object):
+    """The zone of every vm, the zone of the vxlan endpoint of its host.
+
+    The map is read from the neutron DB every probe_interval seconds (60
+    if the probes are disabled).
+    """
+
+    DEFAULT_REFRESH_INTERVAL = 60
+
+    def __init__(self):
+        self._zones = {}
+
+    @property
+    def _plugin(self):
+        return manager.NeutronManager.get_plugin()
+
+    def zone(self, vm):
+        return self._zones.get(vm)
+
+    def group(self, vms):
+        """Return the vms by zone, the vms of unknown zone under None."""
+        groups = {}
+        for vm in vms:
+            groups.setdefault(self._zones.get(vm), []).append(vm)
+        return groups
+
+    def refresh(self):
+        ctx = n_context.get_admin_context()
+        host_zones = dict(
+            (endpoint.host, endpoint.zone)
+            for endpoint in ctx.session.query(
+                bambuk_type_vxlan.BambukVxlanEndpoints))
+        zones = {}
+        for port in self._plugin.get_ports(
+                ctx, fields=['binding:profile', 'binding:host_id']):
+            provider_port = update_actions.Action._get_provider_port(
+                ctx, port)
+            if provider_port and host_zones.get(provider_port['host_id']):
+                zones[provider_port['provider_mgnt_ip']] = (
+                    host_zones[provider_port['host_id']])
+        self._zones = zones
+        LOG.info('%d vms in %d zones' % (len(zones), len(set(zones.values()))))
+
+    def start(self):
+        eventlet.spawn_n(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                LOG.error('zone map refresh failed %s' %
+                          traceback.format_exc())
+            eventlet.sleep(config.probe_interval() or
+                           self.DEFAULT_REFRESH_INTERVAL)
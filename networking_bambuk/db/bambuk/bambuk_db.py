@@ -1,3 +1,5 @@
+import datetime
+
 from neutron.db import model_base
 
 from oslo_log import log as o_log
@@ -47,6 +49,28 @@ class ProviderPort(model_base.BASEV2,
     provider_mgnt_ip = sa.Column(sa.String(length=64), nullable=False)
 
 
+class BambukOutboxEntry(model_base.BASEV2):
+    """Define a connect_db mutation pending delivery to a vm.
+
+    There is at most one entry by (destination, table, key), the latest
+    mutation replaces the previous one. The ids follow the order the
+    mutations were queued in.
+    """
+
+    __tablename__ = 'bambukoutbox'
+    __table_args__ = (
+        sa.UniqueConstraint('destination', 'table_name', 'key'),
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    destination = sa.Column(sa.String(length=64), nullable=False)
+    table_name = sa.Column(sa.String(length=36), nullable=False)
+    key = sa.Column(sa.String(length=255), nullable=False)
+    action_type = sa.Column(sa.String(length=36), nullable=False)
+    value = sa.Column(sa.Text, nullable=True)
+    created_at = sa.Column(sa.DateTime, nullable=False)
+
+
 def get_one_bambuk_update_log(context):
     query = context.session.query(BambukUpdateLog)
     b_log = query.first()
@@ -58,3 +82,51 @@ def get_one_bambuk_update_log(context):
 
 def delete_bambuk_update_log(context, bambuk_update_log):
     context.session.delete(bambuk_update_log)
+
+
+def add_outbox_entry(context, destination, table_name, key, action,
+                     value=None):
+    """Queue a mutation, replacing the one of the same key with a new id."""
+    query = context.session.query(BambukOutboxEntry)
+    query.filter_by(destination=destination,
+                    table_name=table_name,
+                    key=key).delete()
+    row = BambukOutboxEntry(
+        destination=destination,
+        table_name=table_name,
+        key=key,
+        action_type=action,
+        value=value,
+        created_at=datetime.datetime.utcnow()
+    )
+    context.session.add(row)
+
+
+def get_outbox_destinations(context):
+    query = context.session.query(BambukOutboxEntry.destination).distinct()
+    return set(row.destination for row in query)
+
+
+def get_outbox_entries(context, destination):
+    query = context.session.query(BambukOutboxEntry)
+    return query.filter_by(destination=destination).order_by(
+        BambukOutboxEntry.id).all()
+
+
+def get_outbox_last_id(context, destination):
+    """Return the id of the last mutation queued for destination, or 0."""
+    query = context.session.query(sa.func.max(BambukOutboxEntry.id))
+    return query.filter_by(destination=destination).scalar() or 0
+
+
+def delete_outbox_entry(context, entry):
+    """Delete the entry, unless it was replaced by a newer mutation."""
+    query = context.session.query(BambukOutboxEntry)
+    query.filter_by(id=entry.id).delete()
+
+
+def delete_outbox_entries(context, destination, last_id):
+    """Delete the entries of destination queued up to last_id."""
+    query = context.session.query(BambukOutboxEntry)
+    query.filter(BambukOutboxEntry.destination == destination,
+                 BambukOutboxEntry.id <= last_id).delete()
@@ -0,0 +1,29 @@
+""" Add bambukoutbox table
+
+Revision ID: 5c3f1a7e9b2d
+Revises: 490c90d35219
+Create Date: 2026-10-18 09:12:41.310544
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c3f1a7e9b2d'
+down_revision = '490c90d35219'
+
+
+def upgrade():
+    op.create_table(
+        'bambukoutbox',
+        sa.Column('id', sa.Integer, nullable=False, autoincrement=True),
+        sa.Column('destination', sa.String(length=64), nullable=False),
+        sa.Column('table_name', sa.String(length=36), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('action_type', sa.String(length=36), nullable=False),
+        sa.Column('value', sa.Text, nullable=True),
+        sa.Column('created_at', sa.DateTime, nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('destination', 'table_name', 'key'))
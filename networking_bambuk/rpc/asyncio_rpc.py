@@ -0,0 +1,364 @@
+"""Transport built on asyncio streams, Python 3 only.
+
+The asyncio event loop runs in a dedicated native thread, next to the
+eventlet hub of the process, and is shared by all its receivers and
+senders. It only does the network I/O: the green threads submit
+coroutines to the loop and the results come back to the hub through a
+GreenBridge, like the agent calls. The agent, the retries and the
+circuit breakers keep being called from green threads only.
+
+The messages are framed as in asynctcp_rpc: the length (4 bytes, network
+order) followed by the message, the replies of a connection come in the
+order of its requests.
+"""
+import asyncio
+import collections
+import os
+import struct
+import time
+import traceback
+
+import eventlet
+from eventlet import event
+from eventlet import hubs
+from eventlet import patcher
+from eventlet import tpool
+
+from networking_bambuk.common import config
+from networking_bambuk.rpc import bambuk_rpc
+
+from oslo_log import log
+
+
+LOG = log.getLogger(__name__)
+
+# the loop needs a real thread, not a green one
+_threading = patcher.original('threading')
+
+HEADER = struct.Struct('!I')
+
+
+def frame(message):
+    return HEADER.pack(len(message)) + message
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    (size,) = HEADER.unpack(header)
+    if size > config.max_frame_size():
+        # the connection is dropped rather than buffering it
+        raise IOError('frame of %d bytes' % size)
+    return await reader.readexactly(size)
+
+
+class EventLoopThread(object):
+    """An asyncio event loop running in its own native thread."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = _threading.Thread(target=self._run,
+                                         name='bambuk-asyncio')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule coro in the loop, return a concurrent future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro):
+        """Run coro in the loop and wait for its result, green friendly."""
+        return tpool.execute(self.submit(coro).result)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class GreenBridge(object):
+    """Run functions in green threads on behalf of the event loop.
+
+    The loop queues the calls and writes to a pipe, a green thread of
+    the hub waits for the pipe to be readable and spawns the calls.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._calls = collections.deque()
+        self._read_fd, self._write_fd = os.pipe()
+        eventlet.spawn_n(self._dispatch)
+
+    def run(self, func, *args):
+        """Return an asyncio future of func(*args), called from the loop."""
+        future = self._loop.create_future()
+        self._queue(future, func, args)
+        return future
+
+    def spawn(self, func, *args):
+        """Call func(*args) in a green thread, from any native thread."""
+        self._queue(None, func, args)
+
+    def _queue(self, future, func, args):
+        self._calls.append((future, func, args))
+        os.write(self._write_fd, b'x')
+
+    def _dispatch(self):
+        while True:
+            hubs.trampoline(self._read_fd, read=True)
+            os.read(self._read_fd, 4096)
+            while self._calls:
+                eventlet.spawn_n(self._call, *self._calls.popleft())
+
+    def _call(self, future, func, args):
+        try:
+            result = func(*args)
+        except Exception as e:
+            if future is None:
+                LOG.error('an exception occured %s, %s' % (
+                    e, traceback.format_exc()))
+            else:
+                self._loop.call_soon_threadsafe(
+                    self._set_exception, future, e)
+        else:
+            if future is not None:
+                self._loop.call_soon_threadsafe(
+                    self._set_result, future, result)
+
+    @staticmethod
+    def _set_result(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future, error):
+        if not future.done():
+            future.set_exception(error)
+
+
+# the loop of the process and its bridge, see loop_thread
+_loop_thread = None
+_bridge = None
+
+
+def loop_thread():
+    """Return the loop of the process and its bridge, start them once."""
+    global _loop_thread, _bridge
+    if _loop_thread is None:
+        _loop_thread = EventLoopThread()
+        _bridge = GreenBridge(_loop_thread.loop)
+    return _loop_thread, _bridge
+
+
+class AsyncioReceiver(bambuk_rpc.BambukRpcReceiver):
+    """Receiver serving every connection in its own coroutine.
+
+    Every request is processed in a green thread as soon as it is read,
+    in the order defined by bambuk_rpc.RequestOrdering, and the replies
+    of a connection are written in the order of its requests.
+    """
+
+    def __init__(self, bambuk_agent):
+        self._port = config.listener_port()
+        self._ip = config.listener_ip()
+        self._loop_thread, self._bridge = loop_thread()
+        self._ordering = bambuk_rpc.RequestOrdering()
+        self._server = None
+        super(AsyncioReceiver, self).__init__(bambuk_agent)
+
+    def receive(self):
+        self._server = self._loop_thread.call(asyncio.start_server(
+            self._serve, self._ip, self._port, reuse_address=True))
+
+    async def _serve(self, reader, writer):
+        replies = asyncio.Queue()
+        replier = asyncio.ensure_future(self._reply(replies, writer))
+        # set once the previous request of the connection is ordered
+        entered = None
+        try:
+            while self._running:
+                message_data = await read_frame(reader)
+                next_entered = event.Event()
+                replies.put_nowait(self._bridge.run(
+                    self._process, message_data, entered, next_entered))
+                entered = next_entered
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            LOG.error('an exception occured %s, %s' % (
+                e, traceback.format_exc()))
+        finally:
+            replies.put_nowait(None)
+            await replier
+
+    async def _reply(self, replies, writer):
+        try:
+            while True:
+                response = await replies.get()
+                if response is None:
+                    break
+                writer.write(frame(await response))
+                await writer.drain()
+        except Exception as e:
+            LOG.error('an exception occured %s, %s' % (
+                e, traceback.format_exc()))
+        finally:
+            writer.close()
+
+    def _process(self, message_data, entered, next_entered):
+        if entered is not None:
+            entered.wait()
+        try:
+            msg_codec, message = self.decode(message_data)
+            waits, done = self._ordering.enter(message)
+        finally:
+            next_entered.send()
+        try:
+            for previous in waits:
+                previous.wait()
+            response = self.handle(msg_codec, message)
+            if response is None:
+                response = msg_codec.encode(None)
+            return response
+        finally:
+            if done:
+                self._ordering.exit(done)
+
+    def close(self):
+        super(AsyncioReceiver, self).close()
+        if self._server:
+            self._loop_thread.call(self._close_server())
+
+    async def _close_server(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+class Connection(object):
+    """Long lived connection to an agent, the requests are pipelined."""
+
+    def __init__(self, address):
+        self._address = address
+        self._reader = None
+        self._writer = None
+        self._pending = collections.deque()
+        self._connecting = None
+        self.last_used = time.time()
+
+    @property
+    def healthy(self):
+        return self._writer is None or not self._writer.is_closing()
+
+    def idle(self, timeout):
+        return (not self._pending and
+                time.time() - self.last_used > timeout)
+
+    async def _connect(self):
+        if self._writer is None:
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(
+                    asyncio.open_connection(*self._address))
+            try:
+                reader, writer = await asyncio.shield(self._connecting)
+            except Exception:
+                self._connecting = None
+                raise
+            if self._writer is None:
+                self._reader, self._writer = reader, writer
+                asyncio.ensure_future(self._receive())
+
+    async def _receive(self):
+        try:
+            while True:
+                response = await read_frame(self._reader)
+                self.last_used = time.time()
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(response)
+        except Exception as e:
+            self.close(e)
+
+    async def request(self, message, timeout=None):
+        self.last_used = time.time()
+        await self._connect()
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append(future)
+        self._writer.write(frame(message))
+        try:
+            await self._writer.drain()
+            return await asyncio.wait_for(asyncio.shield(future),
+                                          timeout or config.rpc_timeout())
+        except asyncio.TimeoutError:
+            # the replies are matched in order, start over
+            self.close(bambuk_rpc.BambukRpcTimeout(
+                'no reply from %s' % repr(self._address)))
+            raise bambuk_rpc.BambukRpcTimeout(
+                'no reply from %s' % repr(self._address))
+
+    def close(self, error=None):
+        error = error or IOError('connection to %s closed' %
+                                 repr(self._address))
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+        if self._writer is not None:
+            self._writer.close()
+
+
+class AsyncioSenderPool(bambuk_rpc.BambukSenderPool):
+    """Sender pool doing the network I/O of its requests in the loop.
+
+    The requests are sent from green threads, with the retries, circuit
+    breaking and bulk sends of the other transports. A green thread
+    waits for its reply without holding a native thread.
+    """
+
+    def __init__(self):
+        self._loop_thread, self._bridge = loop_thread()
+        self._connections = {}
+
+    def connection(self, address):
+        """Return a connection to address, call from the loop only."""
+        self._evict_idle()
+        conn = self._connections.get(address)
+        if conn is None or not conn.healthy:
+            conn = Connection(address)
+            self._connections[address] = conn
+        return conn
+
+    def _evict_idle(self):
+        timeout = config.connection_idle_timeout()
+        for address, conn in list(self._connections.items()):
+            if not conn.healthy or conn.idle(timeout):
+                LOG.debug('evicting connection to %s' % repr(address))
+                del self._connections[address]
+                conn.close()
+
+    def get_sender(self, vm, send_id=None):
+        return AsyncioSender(vm, self)
+
+    def request(self, address, message_data, timeout=None):
+        """Send message_data to address and wait for its reply."""
+        done = event.Event()
+        future = self._loop_thread.submit(
+            self._request(address, message_data, timeout))
+        future.add_done_callback(
+            lambda future: self._bridge.spawn(done.send, future))
+        return done.wait().result()
+
+    async def _request(self, address, message_data, timeout):
+        return await self.connection(address).request(message_data,
+                                                      timeout)
+
+
+class AsyncioSender(bambuk_rpc.BambukRpcSender):
+
+    def __init__(self, host_or_ip, pool, port=None):
+        super(AsyncioSender, self).__init__(host_or_ip)
+        self.address = (host_or_ip, port or config.listener_port())
+        self._pool = pool
+
+    def send(self, message, send_id=None, timeout=None):
+        return self._pool.request(self.address, message, timeout)
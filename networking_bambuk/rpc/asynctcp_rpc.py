@@ -1,6 +1,12 @@
+import collections
+import eventlet
+import struct
 import sys
-import uuid
+import time
 
+from eventlet import event
+from eventlet import hubs
+from eventlet import semaphore
 from eventlet.green import asyncore
 from eventlet.green import socket
 
@@ -13,33 +19,160 @@ from oslo_log import log
 LOG = log.getLogger(__name__)
 
 
-SEP = '\n.\n'
-BUFF_SIZE = 8192
+# every message is sent as a frame: its length (4 bytes, network order)
+# followed by the message itself
+HEADER = struct.Struct('!I')
+BUFF_SIZE = 65536
+# seconds between two scans of the idle connections
+EVICT_INTERVAL = 1
 
-class ReceiverHandler(asyncore.dispatcher):
+
+def frame(message):
+    return HEADER.pack(len(message)) + message
+
+
+class FrameTooLarge(IOError):
+    """The peer announced a frame larger than max_frame_size."""
+
+
+class FrameBuffer(object):
+    """Reassemble the frames received from a stream."""
+
+    def __init__(self, max_size=None):
+        self._buffer = bytearray()
+        self._max_size = max_size or config.max_frame_size()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        self._buffer.extend(data)
+
+    def pop_frames(self):
+        """Remove and return the complete frames received so far."""
+        frames = []
+        buf = self._buffer
+        offset = 0
+        while len(buf) - offset >= HEADER.size:
+            (size,) = HEADER.unpack_from(buf, offset)
+            if size > self._max_size:
+                # do not buffer what the peer announces without limit
+                raise FrameTooLarge('frame of %d bytes' % size)
+            end = offset + HEADER.size + size
+            if len(buf) < end:
+                break
+            frames.append(bytes(buf[offset + HEADER.size:end]))
+            offset = end
+        if offset:
+            del buf[:offset]
+        return frames
+
+
+class SendBuffer(object):
+    """Queue of frames to send, sliced without copy."""
+
+    def __init__(self):
+        self._views = collections.deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if data:
+            self._views.append(memoryview(data))
+            self._size += len(data)
+
+    def peek(self):
+        return self._views[0][:BUFF_SIZE]
+
+    def consume(self, nbytes):
+        self._views[0] = self._views[0][nbytes:]
+        self._size -= nbytes
+        if not len(self._views[0]):
+            self._views.popleft()
+
+
+class GreenDispatcher(asyncore.dispatcher):
+    """Dispatcher driven by green threads waiting on its socket.
+
+    A green thread waits in the hub for the socket to be readable while
+    reading() and another one for it to be writable while writable(),
+    nothing runs while the dispatcher is idle.
+    """
+
+    _reader = None
+    _writer = None
+
+    def reading(self):
+        return True
+
+    def drive(self):
+        """Start the green threads the socket needs, call on changes."""
+        if self._reader is None and self.reading():
+            self._reader = eventlet.spawn(self._loop, True)
+        if self._writer is None and self.writable():
+            self._writer = eventlet.spawn(self._loop, False)
+
+    def close(self):
+        # a green thread left waiting on the socket would wait on the
+        # next socket reusing its file descriptor
+        current = eventlet.getcurrent()
+        for thread in (self._reader, self._writer):
+            if thread is not None and thread is not current:
+                thread.kill()
+        self._reader = self._writer = None
+        asyncore.dispatcher.close(self)
+
+    def _loop(self, read):
+        wanted = self.reading if read else self.writable
+        try:
+            while self._fileno is not None and wanted():
+                hubs.trampoline(self.socket, read=read, write=not read)
+                if read:
+                    self.handle_read_event()
+                else:
+                    self.handle_write_event()
+        except Exception:
+            # closed while waiting, by another green thread, or failed
+            if self._fileno is not None:
+                self.handle_error()
+        finally:
+            if read:
+                self._reader = None
+            else:
+                self._writer = None
+
+
+class ReceiverHandler(GreenDispatcher):
 
     def __init__(self, bambuk_agent, s=None, m=None):
-        asyncore.dispatcher.__init__(self, sock=s, map=m)
         self.bambuk_agent = bambuk_agent
-        self.out_buffer = ''
-        self.in_buffer = ''
+        self.out_buffer = SendBuffer()
+        self.in_buffer = FrameBuffer()
+        asyncore.dispatcher.__init__(self, sock=s, map=m)
+        self.drive()
 
     def handle_read(self):
-        self.in_buffer = self.in_buffer + self.recv(BUFF_SIZE)
-        if self.in_buffer:
-            LOG.debug('ReceiverHandler received %s' % repr(self.in_buffer))
-            if self.in_buffer.endswith(SEP):
-                self.out_buffer = self.bambuk_agent.call_agent(
-                    self.in_buffer[0:len(self.in_buffer) - len(SEP)]) + SEP
-                self.in_buffer = ''
-            
+        data = self.recv(BUFF_SIZE)
+        if data:
+            self.in_buffer.feed(data)
+            for message in self.in_buffer.pop_frames():
+                LOG.debug('ReceiverHandler received %d bytes' % len(message))
+                self.send(frame(self.bambuk_agent.call_agent(message)))
+
+    def handle_error(self):
+        _, v, _ = sys.exc_info()
+        LOG.error('error on connection from %s: %s' % (self.addr, v))
+        self.close()
 
     def handle_close(self):
         self.close()
 
     def initiate_send(self):
-        num_sent = asyncore.dispatcher.send(self, self.out_buffer[:BUFF_SIZE])
-        self.out_buffer = self.out_buffer[num_sent:]
+        if len(self.out_buffer):
+            num_sent = asyncore.dispatcher.send(self, self.out_buffer.peek())
+            self.out_buffer.consume(num_sent)
 
     def handle_write(self):
         self.initiate_send()
@@ -48,22 +181,27 @@ class ReceiverHandler(asyncore.dispatcher):
         return (not self.connected) or len(self.out_buffer)
 
     def send(self, data):
-        LOG.debug('ReceiverHandler sending %d' % repr(data))
-        self.out_buffer = self.out_buffer + data
+        LOG.debug('ReceiverHandler sending %d bytes' % len(data))
+        self.out_buffer.append(data)
         self.initiate_send()
+        self.drive()
 
 
-class TCPServer(asyncore.dispatcher):
+class TCPServer(GreenDispatcher):
 
     def __init__(self, address, bambuk_agent, m):
         asyncore.dispatcher.__init__(self, map=m)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
         self.bind(address)
-        self.listen(5)
+        # a burst of connections is not retried by the clients
+        self.listen(socket.SOMAXCONN)
         self.bambuk_agent = bambuk_agent
         self.m = m
 
+    def writable(self):
+        return False
+
     def handle_accept(self):
         pair = self.accept()
         if pair is not None:
@@ -73,89 +211,195 @@ class TCPServer(asyncore.dispatcher):
 
 
 class AsyncTCPReceiver(bambuk_rpc.BambukRpcReceiver):
+    """Receiver handling the requests of all its connections in turn."""
 
     def __init__(self, bambuk_agent):
         self._port = config.listener_port()
         self._ip = config.listener_ip()
+        # the server and its connections
+        self._map = {}
+        self._lock = semaphore.Semaphore()
         super(AsyncTCPReceiver, self).__init__(bambuk_agent)
 
     def receive(self):
-        while self._running:
-            m = {}
-            _ = TCPServer((self._ip, self._port), self, m)
-            asyncore.loop(map=m)
+        TCPServer((self._ip, self._port), self, self._map).drive()
 
+    def call_agent(self, message_data):
+        with self._lock:
+            return super(AsyncTCPReceiver, self).call_agent(message_data)
 
-class TCPClient(asyncore.dispatcher):
+    def close(self):
+        super(AsyncTCPReceiver, self).close()
+        for dispatcher in list(self._map.values()):
+            dispatcher.close()
 
-    def __init__(self, address, message, m):
-        asyncore.dispatcher.__init__(self, map=m)
-        self._message = message
+
+class Request(object):
+    """A message sent on a connection and its reply."""
+
+    def __init__(self, message):
+        self.message = message
+        self.done = False
+        self.result = None
+        self.error = None
+        self._event = event.Event()
+
+    def set_result(self, result):
+        self.result = result
+        self.done = True
+        self._event.send()
+
+    def set_error(self, error):
+        self.error = error
+        self.done = True
+        self._event.send()
+
+    def wait(self):
+        self._event.wait()
+
+
+class TCPConnection(GreenDispatcher):
+    """Long lived connection to an agent.
+
+    Requests are pipelined on the connection, the agent handles them in
+    order so the replies are matched to the requests first in first out.
+    The socket is read while requests are pending.
+    """
+
+    def __init__(self, address, m):
+        # the connection is ready before its socket is created
         self._address = address
+        self.out_buffer = SendBuffer()
+        self.in_buffer = FrameBuffer()
+        self._pending = collections.deque()
+        self.failed = False
+        self.last_used = time.time()
+        asyncore.dispatcher.__init__(self, map=m)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect(address)
-        self.out_buffer = message + SEP
-        self.in_buffer = ''
-        self.result = ''
+
+    def request(self, req):
+        self.last_used = time.time()
+        self._pending.append(req)
+        self.out_buffer.append(frame(req.message))
+        if self.connected:
+            # send what the socket takes without waiting
+            try:
+                self.handle_write()
+            except Exception:
+                self.handle_error()
+                return
+        self.drive()
+
+    def reading(self):
+        return bool(self._pending)
+
+    def healthy(self):
+        return not self.failed and self.socket is not None
+
+    def idle(self, timeout):
+        return (not self._pending and
+                time.time() - self.last_used > timeout)
+
+    def _fail(self, error):
+        self.failed = True
+        while self._pending:
+            self._pending.popleft().set_error(error)
+        self.close()
 
     def handle_connect(self):
-        LOG.debug('handle_connect')
+        LOG.debug('connected to %s' % repr(self._address))
 
     def handle_error(self):
         _, v, _ = sys.exc_info()
-        LOG.error('error sending %s to %s' % (self._message, self._address))
-        raise v
+        LOG.error('error on connection to %s: %s' % (self._address, v))
+        self._fail(v)
 
     def handle_close(self):
-        LOG.debug('handle_close')
-        self.result = self.in_buffer[0:len(self.in_buffer) - len(SEP)]
-        self.close()
+        LOG.debug('connection to %s closed' % repr(self._address))
+        self._fail(socket.error('connection to %s closed' %
+                                repr(self._address)))
 
     def handle_read(self):
-        self.in_buffer = self.in_buffer + self.recv(BUFF_SIZE)
-        if self.in_buffer:
-            LOG.debug('ReceiverHandler received %s' % repr(self.in_buffer))
-            if self.in_buffer.endswith(SEP):
-                self.handle_close()
+        data = self.recv(BUFF_SIZE)
+        if data:
+            self.in_buffer.feed(data)
+            for message in self.in_buffer.pop_frames():
+                LOG.debug('TCPConnection received %d bytes' % len(message))
+                self.last_used = time.time()
+                self._pending.popleft().set_result(message)
 
     def writable(self):
-        return (len(self.out_buffer) > 0)
+        return (not self.connected) or len(self.out_buffer) > 0
 
     def handle_write(self):
-        sent = self.send(self.out_buffer)
-        LOG.debug('TCPClient sent %d' % sent)
-        self.out_buffer = self.out_buffer[sent:]
+        if len(self.out_buffer):
+            sent = self.send(self.out_buffer.peek())
+            LOG.debug('TCPConnection sent %d' % sent)
+            self.out_buffer.consume(sent)
 
 
 class AsyncTCPSenderPool(bambuk_rpc.BambukSenderPool):
 
-    maps = {}
+    # connections by agent address and their asyncore map
+    connections = {}
+    map = {}
+    _evicted_at = 0
+
+    def connection(self, address):
+        """Return a healthy connection to address, opening it if needed."""
+        self._evict_idle()
+        conn = AsyncTCPSenderPool.connections.get(address)
+        if conn is None or not conn.healthy():
+            conn = TCPConnection(address, AsyncTCPSenderPool.map)
+            AsyncTCPSenderPool.connections[address] = conn
+        return conn
+
+    def _evict_idle(self):
+        if time.time() - AsyncTCPSenderPool._evicted_at < EVICT_INTERVAL:
+            return
+        AsyncTCPSenderPool._evicted_at = time.time()
+        timeout = config.connection_idle_timeout()
+        for address, conn in list(AsyncTCPSenderPool.connections.items()):
+            if not conn.healthy() or conn.idle(timeout):
+                LOG.debug('evicting connection to %s' % repr(address))
+                del AsyncTCPSenderPool.connections[address]
+                if conn.healthy():
+                    conn.close()
 
     def get_sender(self, vm, send_id=None):
-        if send_id:
-            return AsyncTCPSender(vm, AsyncTCPSenderPool.maps[send_id])
-        return AsyncTCPSender(vm, {})
-        
-    def start_bulk_send(self):
-        send_id = uuid.uuid4()
-        AsyncTCPSenderPool.maps[send_id] = {}
-        return send_id
+        return AsyncTCPSender(vm, self)
+
+    def wait(self, requests, timeout=None):
+        """Wait for the replies of requests.
 
-    def loop(self, send_id):
-        asyncore.loop(map=AsyncTCPSenderPool.maps[send_id])
-        del AsyncTCPSenderPool.maps[send_id]
+        :returns: False if timeout seconds elapsed before, True otherwise
+        """
+        with eventlet.Timeout(timeout, False):
+            for req in requests:
+                req.wait()
+            return True
+        return False
 
 
 class AsyncTCPSender(bambuk_rpc.BambukRpcSender):
 
-    def __init__(self, host_or_ip, m, port=config.listener_port()):
-        super(AsyncTCPSender, self).__init__()
-        self.address = (host_or_ip, port)
-        self._map = m
-
-    def send(self, message, send_id=None):
-        LOG.debug('message to send %s to %s' % (message, self.address))
-        c = TCPClient(self.address, message, self._map)
-        if not send_id:
-            asyncore.loop(map=self._map)
-            return c.result
\ No newline at end of file
+    def __init__(self, host_or_ip, pool, port=None):
+        super(AsyncTCPSender, self).__init__(host_or_ip)
+        self.address = (host_or_ip, port or config.listener_port())
+        self._pool = pool
+
+    def send(self, message, send_id=None, timeout=None):
+        LOG.debug('message to send to %s' % repr(self.address))
+        req = Request(message)
+        conn = self._pool.connection(self.address)
+        conn.request(req)
+        if not self._pool.wait([req], timeout or config.rpc_timeout()):
+            # the replies are matched in order, start over
+            error = bambuk_rpc.BambukRpcTimeout(
+                'no reply from %s' % repr(self.address))
+            conn._fail(error)
+            raise error
+        if req.error:
+            raise req.error
+        return req.result
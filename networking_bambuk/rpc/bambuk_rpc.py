@@ -1,10 +1,18 @@
 import abc
+import collections
 import eventlet
-import json
+import math
 import six
+import time
 import traceback
+import uuid
+
+from eventlet import event
 
 from networking_bambuk.common import config
+from networking_bambuk.rpc import codec
+from networking_bambuk.rpc import delivery
+from networking_bambuk.rpc import shadow
 
 from oslo_log import log
 
@@ -14,50 +22,644 @@ from oslo_utils import importutils
 LOG = log.getLogger(__name__)
 
 
+# share of the bulk_deadline given to a relay to deliver its peers
+RELAY_DEADLINE = 0.8
+
+# message argument holding the connect_db of each method
+CONNECT_DB_ARG = {
+    'apply': 'connect_db',
+    'bootstrap': 'connect_db',
+    'update': 'connect_db_update',
+    'delete': 'connect_db_delete',
+}
+
+# methods replacing the whole content of the agent
+APPLY_METHODS = ('apply', 'bootstrap')
+
+
+class BambukRpcTimeout(Exception):
+    """No reply received from the agent in time."""
+
+
+class BambukMessage(object):
+    """A message encoded at most once per codec.
+
+    The same instance is handed to every sender of a bulk send so the
+    payload is serialized once whatever the number of destinations.
+    """
+
+    def __init__(self, method, **kwargs):
+        self.method = method
+        self._message = {'method': method}
+        for name, value in kwargs.items():
+            self._message[name] = value
+        self._payloads = {}
+
+    def encode(self, msg_codec=codec.JSON):
+        payload = self._payloads.get(msg_codec.name)
+        if payload is None:
+            payload = msg_codec.encode(self._message)
+            self._payloads[msg_codec.name] = payload
+        return payload
+
+    def get(self, name, default=None):
+        """Return an argument of the message."""
+        return self._message.get(name, default)
+
+    def relayed(self, peers, deadline, attempts=None, zone=None):
+        """Return the message asking a relay to forward this one to peers.
+
+        The relay handles the message then sends it to the peers within
+        deadline seconds and replies with the delivery result by peer.
+        It relays only the peers of its zone, the one of its last state.
+        """
+        kwargs = dict(self._message)
+        return BambukMessage('relay', relayed=kwargs.pop('method'),
+                             peers=list(peers), deadline=deadline,
+                             attempts=attempts, zone=zone, **kwargs)
+
+
+class BulkSendReport(dict):
+    """The delivery result by destination of a bulk send."""
+
+    def __init__(self):
+        super(BulkSendReport, self).__init__()
+        # seconds spent delivering each destination
+        self.latencies = {}
+
+    def add(self, destination, result, latency):
+        self[destination] = result
+        self.latencies[destination] = latency
+
+    def merge(self, report):
+        self.update(report)
+        self.latencies.update(report.latencies)
+
+    def _with_result(self, result):
+        return [dest for dest, res in self.items() if res == result]
+
+    @property
+    def delivered(self):
+        return self._with_result(delivery.DELIVERED)
+
+    @property
+    def failed(self):
+        return self._with_result(delivery.FAILED)
+
+    @property
+    def rejected(self):
+        return self._with_result(delivery.REJECTED)
+
+    @property
+    def queued(self):
+        return self._with_result(delivery.QUEUED)
+
+    @property
+    def timed_out(self):
+        return self._with_result(delivery.TIMED_OUT)
+
+    @property
+    def unchanged(self):
+        return self._with_result(delivery.UNCHANGED)
+
+    @property
+    def stragglers(self):
+        """The destinations that did not get the message."""
+        return [dest for dest, res in self.items()
+                if res not in (delivery.DELIVERED, delivery.UNCHANGED)]
+
+    def __str__(self):
+        latencies = sorted(self.latencies.values()) or [0]
+        return ('%d delivered, %d unchanged, %d failed, %d rejected, '
+                '%d timed out, %d queued, '
+                'latency median %2.3fs max %2.3fs' % (
+                    len(self.delivered), len(self.unchanged),
+                    len(self.failed), len(self.rejected),
+                    len(self.timed_out), len(self.queued),
+                    latencies[len(latencies) // 2], latencies[-1]))
+
+
+class BulkSend(object):
+    """Concurrent delivery of messages to many destinations.
+
+    Every destination is delivered in its own green thread so the
+    retries to a failing destination do not delay the other ones. The
+    destinations not delivered before the deadline are reported timed
+    out.
+
+    The concurrency grows with the number of destinations so that, at
+    the latency observed by the previous deliveries, they are all
+    delivered within the deadline, up to the concurrency limit. It is at
+    least MIN_CONCURRENCY plus the number of destinations whose last send
+    failed, which may hold a slot for all their retries, and a
+    destination waiting for a slot past the deadline is timed out.
+    """
+
+    MIN_CONCURRENCY = 8
+    # weight of the last delivery in the smoothed latency
+    LATENCY_ALPHA = 0.2
+
+    # smoothed latency of the deliveries, shared by all the bulk sends
+    latency = None
+
+    def __init__(self, attempts=None, deadline=None, concurrency=None):
+        self._attempts = attempts
+        self._deadline = deadline or config.bulk_deadline()
+        self._max_concurrency = concurrency or config.bulk_concurrency()
+        self._started_at = time.time()
+        self._count = 0
+        # the destinations whose last send failed
+        self._failing = 0
+        self._pool = eventlet.GreenPool(self._concurrency())
+        self._threads = {}
+        self.report = BulkSendReport()
+
+    def _concurrency(self):
+        if BulkSend.latency is None:
+            return self._max_concurrency
+        needed = int(math.ceil(
+            self._count * BulkSend.latency / self._deadline))
+        return min(max(needed, self.MIN_CONCURRENCY + self._failing),
+                   self._max_concurrency)
+
+    def _remaining(self):
+        return self._deadline - (time.time() - self._started_at)
+
+    def spawn(self, sender, message):
+        self._count += 1
+        if delivery.is_failing(sender.destination):
+            self._failing += 1
+        concurrency = self._concurrency()
+        if concurrency > self._pool.size:
+            self._pool.resize(concurrency)
+        remaining = self._remaining()
+        if remaining > 0:
+            # the pool blocks when all the slots are taken
+            with eventlet.Timeout(remaining, False):
+                self._threads[sender.destination] = self._pool.spawn(
+                    self._deliver, sender, message)
+                return
+        self.report.add(sender.destination, delivery.TIMED_OUT,
+                        time.time() - self._started_at)
+
+    def _deliver(self, sender, message):
+        ts = time.time()
+        try:
+            sender.deliver(message, self._attempts)
+            result = delivery.DELIVERED
+        except delivery.CircuitOpen:
+            result = delivery.REJECTED
+        except Exception:
+            result = delivery.FAILED
+        latency = time.time() - ts
+        self._threads.pop(sender.destination, None)
+        self.report.add(sender.destination, result, latency)
+        if result == delivery.DELIVERED:
+            BulkSend._observe(latency)
+
+    @classmethod
+    def _observe(cls, latency):
+        if cls.latency is None:
+            cls.latency = latency
+        else:
+            cls.latency += cls.LATENCY_ALPHA * (latency - cls.latency)
+
+    def wait(self):
+        with eventlet.Timeout(max(self._remaining(), 0), False):
+            self._pool.waitall()
+        now = time.time()
+        for destination, thread in list(self._threads.items()):
+            thread.kill()
+            self.report.add(destination, delivery.TIMED_OUT,
+                            now - self._started_at)
+        self._threads.clear()
+        return self.report
+
+
 @six.add_metaclass(abc.ABCMeta)
 class BambukSenderPool(object):
 
-    @abc.abstractmethod
-    def get_sender(self, vm):
-        pass
+    # codec negotiated with each vm
+    codecs = {}
+    # running bulk sends by send_id
+    bulks = {}
 
     @abc.abstractmethod
-    def start_bulk_send(self):
+    def get_sender(self, vm, send_id=None):
         pass
-    
-    @abc.abstractmethod
+
+    def start_bulk_send(self, attempts=None, deadline=None,
+                        concurrency=None):
+        """Start a bulk send, the senders join it with its send_id.
+
+        :param attempts: maximum number of attempts by destination,
+                         retry_attempts if not specified
+        :param deadline: seconds to deliver all the destinations,
+                         bulk_deadline if not specified
+        :param concurrency: maximum number of concurrent deliveries,
+                            bulk_concurrency if not specified
+        """
+        send_id = uuid.uuid4()
+        BambukSenderPool.bulks[send_id] = BulkSend(
+            attempts, deadline, concurrency)
+        return send_id
+
     def loop(self, send_id):
-        pass
+        """Wait for the end of a bulk send, at most until its deadline.
+
+        :returns: the delivery result (delivery.DELIVERED, FAILED,
+                  REJECTED or TIMED_OUT) by destination
+        :rtype: BulkSendReport
+        """
+        return BambukSenderPool.bulks.pop(send_id).wait()
+
+    def sender(self, vm, send_id=None):
+        """Return a sender to vm using the codec negotiated with it."""
+        sender = self.get_sender(vm, send_id)
+        sender.codec = BambukSenderPool.codecs.get(vm, codec.JSON)
+        return sender
+
+    def negotiate(self, vm, rpc_conf):
+        """Choose the codec to use with vm from its advertised ones."""
+        BambukSenderPool.codecs[vm] = codec.negotiate_compression(
+            codec.negotiate(config.codec(), rpc_conf.get('codecs')),
+            config.compression(), rpc_conf.get('compressions'),
+            config.compression_threshold())
+
+    def bulk_send(self, message, vms, attempts=None, deadline=None):
+        """Send the same message to all the vms.
+
+        :param message: the message to send
+        :type message: BambukMessage
+        :param vms: the destinations
+        :type vms: iterable
+        :param attempts: maximum number of attempts by vm, retry_attempts
+                         if not specified
+        :type attempts: int
+        :param deadline: seconds to deliver all the vms, bulk_deadline if
+                         not specified
+        :type deadline: float
+        :returns: the delivery result by vm
+        :rtype: BulkSendReport
+        """
+        send_id = self.start_bulk_send(attempts, deadline)
+        for vm in vms:
+            self.sender(vm, send_id).send_message(message, send_id)
+        return self.loop(send_id)
 
 
 class BambukAgentClient(object):
 
     def __init__(self):
         self._sender_pool = importutils.import_object(config.sender_pool())
+        # where the undelivered mutations are queued, see outbox.Outbox
+        self.outbox = None
+        # the states of the agents, see agent_cache.AgentStateCache
+        self.agents = None
+        # the zones of the vms, see zones.ZoneMap, to send the bulk
+        # sends through a relay by zone
+        self.zones = None
+        # where the mutations are published by topic, see
+        # zeromq_rpc.ZeroMQPublisher
+        self.publisher = None
+        # the vms of every topic, see topic_map.TopicMap
+        self.topic_map = None
+        # the vms able to subscribe to the publisher
+        self._pubsub = set()
+        # the topics each vm is confirmed receiving from the publisher
+        self._subscribed = {}
+        # the vms having missed published mutations, to apply all
+        self.resyncs = set()
+        self.shadow = shadow.ShadowState()
+        # the keys each vm was last applied, see shadow.view_hash, only
+        # the vms whose keys did not change since can catch up
+        self._views = {}
 
     @config.timefunc
     def state(self, server_conf, vm):
 #         LOG.debug('state to %s' % vm)
-        return self._sender_pool.get_sender(vm).state(server_conf)
+        state = self._sender_pool.sender(vm).state(server_conf,
+                                                   zone=self._zone(vm))
+        if state:
+            self._negotiate(vm, state.pop('rpc', {}))
+        return state
+
+    def _zone(self, vm):
+        """Return the zone of vm, told to its agent to relay its peers."""
+        if self.zones is None:
+            return None
+        return self.zones.zone(vm)
+
+    def _negotiate(self, vm, rpc_conf):
+        """Record what vm supports from the rpc conf of its state."""
+        self._sender_pool.negotiate(vm, rpc_conf)
+        if rpc_conf.get('pubsub'):
+            self._pubsub.add(vm)
+        else:
+            self._pubsub.discard(vm)
+        if self.publisher is not None:
+            self._confirm(vm, rpc_conf)
+
+    def _confirm(self, vm, rpc_conf):
+        """Record the topics vm is confirmed receiving from the publisher.
+
+        An agent reports the topics it received a first published message
+        on, it receives all the following ones. A restarted agent reports
+        none, one having missed messages reports a resync: its shadow is
+        forgotten and it gets the mutations by unicast until confirmed
+        again.
+        """
+        subscription = rpc_conf.get('subscription') or {}
+        topics = set()
+        if subscription.get('publisher') == self.publisher.address:
+            topics = set(subscription.get('topics') or ())
+        if rpc_conf.get('resync'):
+            self.resyncs.add(vm)
+            topics = set()
+        if not topics >= self._subscribed.get(vm, set()):
+            self.shadow.forget(vm)
+        if topics:
+            self._subscribed[vm] = topics
+        else:
+            self._subscribed.pop(vm, None)
+
+    def _subscription(self, vm, topics, unknown=False):
+        """Return the subscription of vm to topics, None if it can not.
+
+        :param unknown: the vm never answered its state yet
+        """
+        if (self.publisher is not None and topics is not None and
+                (unknown or vm in self._pubsub)):
+            return {'publisher': self.publisher.address,
+                    'topics': list(topics)}
+        return None
+
+    def _queued(self, vm):
+        """Return the last mutation queued for vm, before an apply."""
+        if self.outbox:
+            return self.outbox.last_id(vm)
+        return None
+
+    def _applied(self, vm, connect_db, queued, subscription):
+        """Record that the content of vm is now connect_db.
+
+        :param queued: the last mutation queued for vm before connect_db
+                       was applied, see _queued
+        """
+        if subscription and self.topic_map is not None:
+            self.topic_map.add(vm, subscription['topics'])
+        self.resyncs.discard(vm)
+        self._views[vm] = shadow.view_hash(connect_db)
+        self.shadow.reset(vm, connect_db)
+        if self.outbox and queued:
+            # the vm is up to date, forget what was pending
+            self.outbox.clear(vm, queued)
+
+    @config.timefunc
+    def bootstrap(self, server_conf, connect_db, vm, topics=None):
+        """Ask the state of vm and replace its content in one round trip.
+
+        The agents not knowing bootstrap are asked their state then
+        applied connect_db from their revision.
+        :returns: the state of the agent, None if it did not answer, and
+                  whether connect_db was applied
+        """
+        queued = self._queued(vm)
+        self.shadow.forget(vm)
+        # the vm tells whether it can subscribe only in its reply
+        subscription = self._subscription(vm, topics, unknown=True)
+        state = self._sender_pool.sender(vm).bootstrap(
+            server_conf, connect_db, subscription=subscription,
+            zone=self._zone(vm))
+        if not isinstance(state, dict):
+            LOG.info('%s can not bootstrap, asking its state' % vm)
+            state = self.state(server_conf, vm)
+            if not state:
+                return None, False
+            return state, bool(self.apply(connect_db, vm,
+                                          since=state.get('revision'),
+                                          topics=topics))
+        applied = state.pop('applied', False)
+        self._negotiate(vm, state.pop('rpc', {}))
+        if applied:
+            self._applied(vm, connect_db, queued, subscription)
+        return state, bool(applied)
 
     @config.timefunc
-    def apply(self, connect_db, vm):
-        self._sender_pool.get_sender(vm).apply(connect_db)
+    def apply(self, connect_db, vm, since=None, topics=None):
+        """Replace the content of vm with connect_db.
+
+        :param since: the revision the vm reported in its state, only the
+                      entries changed since are sent with the keys of the
+                      others, None to send them all
+        :param topics: the topics the vm subscribes to, if it can
+        """
+        queued = self._queued(vm)
+        self.shadow.forget(vm)
+        sender = self._sender_pool.sender(vm)
+        subscription = self._subscription(vm, topics)
+        if (since is not None and
+                self._views.get(vm) != shadow.view_hash(connect_db)):
+            # the entries entering the view of the vm, the ports of a
+            # network attached to its router or a security group added
+            # to its port, keep the revision they had before
+            LOG.info('the keys of %s changed, applying all' % vm)
+            since = None
+        if since is None:
+            res = sender.apply(connect_db, subscription=subscription)
+        else:
+            changed = [entry for entry in connect_db
+                       if not entry.get('revision') or
+                       entry['revision'] >= since]
+            LOG.info('%d of %d entries changed on %s since %s' % (
+                len(changed), len(connect_db), vm, since))
+            res = sender.apply(
+                changed,
+                keys=[[entry['table'], entry['key']] for entry in connect_db],
+                since=since, subscription=subscription)
+            if not res:
+                # the vm is older than it was known to be
+                LOG.warning('catch up of %s refused, applying all' % vm)
+                res = sender.apply(connect_db, subscription=subscription)
+        if res:
+            self._applied(vm, connect_db, queued, subscription)
+        return res
 
     @config.timefunc
     def update(self, connect_db_update, vms):
-        send_id = self._sender_pool.start_bulk_send()
-        for vm in vms:
-            self._sender_pool.get_sender(vm).update(
-                connect_db_update, send_id)
-        self._sender_pool.loop(send_id)
+        return self._bulk_send('update', connect_db_update, vms)
 
     def delete(self, connect_db_delete, vms):
-        send_id = self._sender_pool.start_bulk_send()
-        for vm in vms:
-            self._sender_pool.get_sender(vm).delete(
-                connect_db_delete, send_id)
-        self._sender_pool.loop(send_id)
+        return self._bulk_send('delete', connect_db_delete, vms)
+
+    def publish(self, method, connect_db, topics):
+        """Publish a connect_db once on each topic.
+
+        Only the vms confirmed receiving one of the topics are known to
+        get it, the other vms of the topics are to send it to.
+        :returns: the vms of the topics not confirmed, None if the vms of
+                  the topics are not known yet, it is then not published
+        """
+        if self.topic_map is None or not self.topic_map.loaded():
+            return None
+        entries = connect_db if isinstance(connect_db, list) else [connect_db]
+        payload = BambukMessage(
+            method, **{CONNECT_DB_ARG[method]: entries}).encode()
+        for topic in topics:
+            self.publisher.publish(topic, payload)
+        topics = set(topics)
+        subscribed = []
+        unsubscribed = []
+        for vm in self.topic_map.vms(topics):
+            if self._subscribed.get(vm, set()) & topics:
+                subscribed.append(vm)
+            else:
+                unsubscribed.append(vm)
+        self.shadow.record(method, entries, subscribed)
+        LOG.info('%s published on %d topics for %d of %d vms' % (
+            method, len(topics), len(subscribed),
+            len(subscribed) + len(unsubscribed)))
+        return unsubscribed
+
+    def deliver(self, method, connect_dbs, attempts=None, deadline=None):
+        """Send each vm its own connect_db in a single bulk send.
+
+        :param connect_dbs: the connect_db to send by vm
+        :param attempts: maximum number of attempts by vm
+        :param deadline: seconds to deliver all the vms
+        :returns: the delivery result by vm
+        :rtype: BulkSendReport
+        """
+        send_id = self._sender_pool.start_bulk_send(attempts, deadline)
+        for vm, connect_db in connect_dbs.items():
+            self._sender_pool.sender(vm, send_id).call_method(
+                method, send_id, **{CONNECT_DB_ARG[method]: connect_db})
+        return self._sender_pool.loop(send_id)
+
+    def _bulk_send(self, method, connect_db, vms):
+        entries = connect_db if isinstance(connect_db, list) else [connect_db]
+        report = BulkSendReport()
+        attempts = None
+        queued = set()
+        if self.outbox:
+            # the vms with pending mutations get the new ones after them
+            # and the dead vms are not even tried, the outbox delivers
+            # them later
+            backlog = self.outbox.destinations()
+            queued = set(vm for vm in vms
+                         if vm in backlog or delivery.is_open(vm))
+            attempts = 1
+
+        # only send to each vm the entries changing its view, the vms
+        # needing the same entries share the same message
+        for group_entries, group_vms in self.shadow.group(
+                method, entries, set(vms) - queued):
+            if not group_entries:
+                for vm in group_vms:
+                    report.add(vm, delivery.UNCHANGED, 0)
+                continue
+            message = BambukMessage(
+                method, **{CONNECT_DB_ARG[method]: group_entries})
+            group_report = self._fan_out(message, group_vms, attempts)
+            self.shadow.record(method, group_entries,
+                               group_report.delivered)
+            report.merge(group_report)
+
+        undelivered = queued | set(report.stragglers)
+        for vm in undelivered:
+            self.shadow.forget(vm)
+        if undelivered and self.outbox:
+            self.outbox.add(method, connect_db, undelivered)
+            for vm in undelivered:
+                report[vm] = delivery.QUEUED
+        if method == 'delete':
+            # the vm may get the deleted keys back with their old revision
+            for vm, result in report.items():
+                if result != delivery.UNCHANGED:
+                    self._views.pop(vm, None)
+        return report
+
+    def _fan_out(self, message, vms, attempts):
+        """Send message to vms, through a relay in the large zones."""
+        if self.zones is None:
+            return self._sender_pool.bulk_send(message, vms,
+                                               attempts=attempts)
+        started_at = time.time()
+        deadline = config.bulk_deadline()
+        direct = []
+        relayed = []
+        for zone, zone_vms in self.zones.group(vms).items():
+            if zone is None or len(zone_vms) < config.relay_min_zone_size():
+                direct.extend(zone_vms)
+            else:
+                relayed.append((zone, zone_vms))
+        pool = eventlet.GreenPool()
+        threads = [(zone_vms, pool.spawn(self._relay, message, zone,
+                                         zone_vms, attempts,
+                                         started_at + deadline))
+                   for zone, zone_vms in relayed]
+        report = BulkSendReport()
+        if direct:
+            report.merge(self._sender_pool.bulk_send(message, direct,
+                                                     attempts=attempts))
+        for zone_vms, thread in threads:
+            remaining = started_at + deadline - time.time()
+            zone_report = None
+            with eventlet.Timeout(max(remaining, 0), False):
+                zone_report = thread.wait()
+            if zone_report is None:
+                # the relay did not answer before the deadline
+                thread.kill()
+                zone_report = BulkSendReport()
+                for vm in zone_vms:
+                    zone_report.add(vm, delivery.TIMED_OUT,
+                                    time.time() - started_at)
+            report.merge(zone_report)
+        return report
+
+    @staticmethod
+    def _relay_of(vms):
+        """Choose the relay of vms, the closest one not known dead."""
+        candidates = [vm for vm in vms if not delivery.is_open(vm)] or vms
+        return min(candidates,
+                   key=lambda vm: (delivery.rtt(vm) is None,
+                                   delivery.rtt(vm), vm))
+
+    def _relay(self, message, zone, vms, attempts, expires_at):
+        """Send message to a relay of vms forwarding it to the others.
+
+        :param zone: the zone of the vms
+        :param expires_at: the time all the vms must be delivered by
+        """
+        relay = self._relay_of(vms)
+        peers = [vm for vm in vms if vm != relay]
+        ts = time.time()
+        sender = self._sender_pool.sender(relay)
+        try:
+            reply = codec.decode(sender.deliver(
+                message.relayed(peers, (expires_at - ts) * RELAY_DEADLINE,
+                                attempts, zone),
+                attempts))
+        except Exception:
+            LOG.warning('relay %s failed, sending directly, %s' % (
+                relay, traceback.format_exc()))
+            reply = None
+        if not isinstance(reply, dict):
+            # the relay is unreachable, too old to relay or of another
+            # zone
+            return self._sender_pool.bulk_send(
+                message, vms, attempts=attempts,
+                deadline=max(expires_at - time.time(), 0))
+        latency = time.time() - ts
+        report = BulkSendReport()
+        # the relay forwards even when its own handler failed
+        report.add(relay, delivery.DELIVERED if reply.get('result')
+                   else delivery.FAILED, latency)
+        for peer in peers:
+            report.add(peer, reply['peers'].get(peer, delivery.FAILED),
+                       latency)
+        LOG.info('relayed by %s: %s' % (relay, report))
+        return report
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -91,11 +693,69 @@ class BambukRpc(object):
         pass
 
 
+class RequestOrdering(object):
+    """Order the concurrent requests of a receiver.
+
+    The mutations of the same (table, key) are processed in their order
+    of arrival, an apply (or a bootstrap) waits for all the previous
+    mutations and all the following ones wait for it. The other requests
+    (state) do not wait.
+    """
+
+    def __init__(self):
+        # last request mutating each (table, key)
+        self._last = {}
+        # last apply
+        self._barrier = None
+
+    @staticmethod
+    def keys(message):
+        keys = set()
+        for arg in CONNECT_DB_ARG.values():
+            entries = message.get(arg)
+            if isinstance(entries, dict):
+                entries = [entries]
+            for entry in entries or []:
+                keys.add((entry.get('table'), entry.get('key')))
+        return keys
+
+    def enter(self, message):
+        """Return the events to wait for and the one to send when done."""
+        method = message.get('relayed') or message.get('method')
+        if method not in CONNECT_DB_ARG:
+            return [], None
+        done = event.Event()
+        waits = [self._barrier] if self._barrier else []
+        if method in APPLY_METHODS:
+            waits.extend(self._last.values())
+            self._last.clear()
+            self._barrier = done
+        else:
+            for key in self.keys(message):
+                if key in self._last:
+                    waits.append(self._last[key])
+                self._last[key] = done
+        return waits, done
+
+    def exit(self, done):
+        for key, last in list(self._last.items()):
+            if last is done:
+                del self._last[key]
+        if self._barrier is done:
+            self._barrier = None
+        done.send()
+
+
 @six.add_metaclass(abc.ABCMeta)
 class BambukRpcReceiver(BambukRpc):
 
     def __init__(self, bambuk_agent):
         self._bambuk_agent = bambuk_agent
+        # sender pool forwarding the relayed messages
+        self._relay_pool = None
+        # the zone of the agent, told by the server with the state, whose
+        # peers it relays
+        self._zone = None
         self._running = True
         eventlet.spawn_n(self.receive)
         eventlet.sleep(0)
@@ -104,29 +764,70 @@ class BambukRpcReceiver(BambukRpc):
     def receive(self):
         pass
 
-    def call_agent(self, message_json):
-        LOG.debug("Received message: %s" % message_json)
-        # call bambuk_agent
-        message = json.loads(message_json)
-        method = message['method']
+    def call_agent(self, message_data):
+        LOG.debug("Received message: %r" % message_data)
+        return self.handle(*self.decode(message_data))
+
+    def decode(self, message_data):
+        """Return the codec of a request and the decoded request."""
+        data = codec.decompress(message_data)
+        msg_codec = codec.codec_of(data)
+        return msg_codec, msg_codec.decode(data)
+
+    def handle(self, msg_codec, message):
+        """Call bambuk_agent, replying with the codec of the request."""
+        method = message.pop('method')
         handler = getattr(self, method, None)
         if handler is not None:
-            del message['method']
             response = handler(**message)
             #  Send reply back to client
-            response_json = json.dumps(response)
-            LOG.debug("Sending response: %s" % response_json)
-            return response_json
+            response_data = msg_codec.encode(response)
+            LOG.debug("Sending response: %r" % response_data)
+            return response_data
 
     def state(self, **kwargs):
         server_conf = kwargs.get('server_conf')
+        self._zone = kwargs.get('zone')
         res = self._bambuk_agent.state(server_conf=server_conf)
         LOG.debug('state: %s' % res)
+        if res:
+            res = dict(res)
+            res['rpc'] = {'codecs': codec.available(),
+                          'compressions': codec.compressions()}
         return res
 
     def apply(self, **kwargs):
         connect_db = kwargs.get('connect_db')
-        return self._bambuk_agent.apply(connect_db=connect_db)
+        keys = kwargs.get('keys')
+        if keys is None:
+            res = self._bambuk_agent.apply(connect_db=connect_db)
+        else:
+            res = self._bambuk_agent.apply(connect_db=connect_db, keys=keys,
+                                           since=kwargs.get('since'))
+        subscription = kwargs.get('subscription')
+        if res and subscription:
+            self.subscribe(subscription['publisher'],
+                           subscription['topics'])
+        return res
+
+    def bootstrap(self, **kwargs):
+        """Apply a connect_db then answer the state of the agent.
+
+        :returns: the state, with whether connect_db was applied
+        """
+        applied = self.apply(connect_db=kwargs.get('connect_db'),
+                             subscription=kwargs.get('subscription'))
+        res = self.state(server_conf=kwargs.get('server_conf'),
+                         zone=kwargs.get('zone'))
+        if res:
+            res = dict(res)
+            res['applied'] = bool(applied)
+        return res
+
+    def subscribe(self, publisher, topics):
+        """Receive the mutations published on topics by publisher."""
+        LOG.warning('%s can not subscribe to %s' % (
+            self.__class__.__name__, publisher))
 
     def update(self, **kwargs):
         connect_db_update = kwargs.get('connect_db_update')
@@ -138,6 +839,35 @@ class BambukRpcReceiver(BambukRpc):
         return self._bambuk_agent.delete(
             connect_db_delete=connect_db_delete)
 
+    def relay(self, **kwargs):
+        """Handle a message then forward it to the peers.
+
+        The peers are relayed only if they are of the zone of the agent,
+        the server sends them directly otherwise.
+        :returns: the result of the message and its delivery result by
+                  peer
+        """
+        method = kwargs.pop('relayed')
+        peers = kwargs.pop('peers')
+        deadline = kwargs.pop('deadline', None)
+        attempts = kwargs.pop('attempts', None)
+        zone = kwargs.pop('zone', None)
+        if method not in ('update', 'delete'):
+            return None
+        if zone is None or zone != self._zone:
+            LOG.warning('not relaying the peers of zone %s from zone %s' % (
+                zone, self._zone))
+            return None
+        result = getattr(self, method)(**kwargs)
+        if self._relay_pool is None:
+            self._relay_pool = importutils.import_object(
+                config.sender_pool())
+        report = self._relay_pool.bulk_send(
+            BambukMessage(method, **kwargs), peers, attempts=attempts,
+            deadline=deadline)
+        LOG.info('%s relayed to %d peers: %s' % (method, len(peers), report))
+        return {'result': result, 'peers': dict(report)}
+
     def close(self):
         self._running = False
 
@@ -145,45 +875,131 @@ class BambukRpcReceiver(BambukRpc):
 @six.add_metaclass(abc.ABCMeta)
 class BambukRpcSender(BambukRpc):
 
-    def __init__(self):
-        pass
+    def __init__(self, destination=None):
+        self.destination = destination
+        self.codec = codec.JSON
 
     @abc.abstractmethod
-    def send(self, message, send_id=None):
+    def send(self, message, send_id=None, timeout=None):
+        """Send the message and return the reply.
+
+        :param timeout: seconds to wait for the reply, rpc_timeout if not
+                        specified
+        :raises: BambukRpcTimeout if the reply did not come in time
+        """
         pass
 
+    # applies in flight by destination
+    applying = collections.Counter()
+
+    def _timeout(self, message):
+        timeout = delivery.timeout(self.destination)
+        if (message.method in APPLY_METHODS or
+                BambukRpcSender.applying[self.destination]):
+            # most of the reply time of an apply is spent writing the
+            # database, not on the network, and the agent answers the
+            # following mutations once it is written
+            timeout = max(timeout, config.rpc_timeout())
+        elif message.method == 'relay':
+            # the relay replies once its peers are delivered
+            timeout = max(timeout, message.get('deadline') or 0)
+        return timeout
+
     def call_method(self, method, send_id=None, **kwargs):
-        message = {'method': method}
-        for name, value in kwargs.items():
-            message[name] = value
-        message_json = json.dumps(message)
-#         LOG.debug("Sending message: %s" % message_json)
+        return self.send_message(BambukMessage(method, **kwargs), send_id)
+
+    def send_message(self, message, send_id=None):
+        if send_id:
+            BambukSenderPool.bulks[send_id].spawn(self, message)
+            return
+        # the caller waits, the retries are left to the bulk sends and
+        # the outbox
+        response_data = self.deliver(message, config.sync_attempts(),
+                                     config.sync_deadline())
+#         LOG.debug("Received response: %r" % response_data)
+        return codec.decode(response_data)
+
+    def deliver(self, message, attempts=None, deadline=None):
+        """Send the message, retrying with backoff, and return the reply.
+
+        :param attempts: maximum number of attempts, retry_attempts if not
+                         specified
+        :param deadline: seconds of all the attempts, not bounded if not
+                         specified
+        :raises: delivery.CircuitOpen if the destination is known dead,
+                 the last send error when all the retries failed
+        """
+        attempts = attempts or config.retry_attempts()
+        started_at = time.time()
+        message_data = message.encode(self.codec)
+#         LOG.debug("Sending message: %r" % message_data)
         nr = 0
-        sent = False
-        while (not sent):
+        while True:
+            if not delivery.allow(self.destination):
+                raise delivery.CircuitOpen(self.destination)
+            ts = time.time()
+            limit = None
+            if deadline:
+                # every attempt gets its share of the deadline, the timeout
+                # doubled by the previous failures does not take it all
+                limit = min(float(deadline) / attempts,
+                            deadline - (ts - started_at))
             try:
-                response_json = self.send(message_json, send_id)
-                sent = True
+                response_data = self._transmit(message, message_data, limit)
             except Exception as e:
+                if isinstance(e, BambukRpcTimeout):
+                    delivery.timed_out(self.destination)
+                delivery.failure(self.destination)
                 nr = nr + 1
-                if nr == 10:
-                    LOG.error(
-                        'retried 10 times to send %s', traceback.format_exc())
-                    raise e
-                LOG.error(
-                    'retry number %d, %s' % (nr, traceback.format_exc()))
-                eventlet.sleep(2)
-#         LOG.debug("Received response: %s" % response_json)
-        if not send_id:
-            return json.loads(response_json)
-
-    def state(self, server_conf, send_id=None):
+                delay = delivery.backoff(nr)
+                if nr >= attempts or (deadline and time.time() + delay >=
+                                      started_at + deadline):
+                    LOG.error('retried %d times to send to %s %s' % (
+                        nr, self.destination, traceback.format_exc()))
+                    raise
+                LOG.warning('retry number %d to %s, %s' % (
+                    nr, self.destination, traceback.format_exc()))
+                eventlet.sleep(delay)
+            else:
+                if not (message.method in APPLY_METHODS + ('relay',) or
+                        BambukRpcSender.applying[self.destination]):
+                    delivery.record_rtt(self.destination, time.time() - ts)
+                delivery.success(self.destination)
+                return response_data
+
+    def _transmit(self, message, message_data, limit=None):
+        timeout = self._timeout(message)
+        if limit:
+            timeout = min(timeout, limit)
+        if message.method not in APPLY_METHODS:
+            return self.send(message_data, timeout=timeout)
+        BambukRpcSender.applying[self.destination] += 1
+        try:
+            return self.send(message_data, timeout=timeout)
+        finally:
+            BambukRpcSender.applying[self.destination] -= 1
+            if not BambukRpcSender.applying[self.destination]:
+                del BambukRpcSender.applying[self.destination]
+
+    def state(self, server_conf, send_id=None, **kwargs):
+        kwargs = dict((name, value) for name, value in kwargs.items()
+                      if value is not None)
+        return self.call_method(
+            'state', send_id, server_conf=server_conf, **kwargs)
+
+    def apply(self, connect_db, send_id=None, **kwargs):
+        # only the optional arguments given are sent
+        kwargs = dict((name, value) for name, value in kwargs.items()
+                      if value is not None)
         return self.call_method(
-            'state', send_id, server_conf=server_conf)
+            'apply', send_id, connect_db=connect_db, **kwargs)
 
-    def apply(self, connect_db, send_id=None):
+    def bootstrap(self, server_conf, connect_db, send_id=None, **kwargs):
+        kwargs = dict((name, value) for name, value in kwargs.items()
+                      if value is not None)
         return self.call_method(
-            'apply', send_id, connect_db=connect_db)
+            'bootstrap', send_id, server_conf=server_conf,
+            connect_db=connect_db, **kwargs)
 
     def update(self, connect_db_update, send_id=None):
         return self.call_method(
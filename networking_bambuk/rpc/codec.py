@@ -0,0 +1,223 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import six
+import time
+import zlib
+
+from oslo_log import log
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+LOG = log.getLogger(__name__)
+
+# 0xc1 is never used by msgpack and can not start a JSON document, the
+# byte following it identifies the codec of a binary message.
+MAGIC = b'\xc1'
+# identifies a compressed message, the message of another codec
+ZLIB_IDENT = b'z'
+
+# message arguments holding connect_db entries
+CONNECT_DB_ARGS = ('connect_db', 'connect_db_update', 'connect_db_delete')
+
+
+def _map_values(message, func):
+    """Return a copy of message with func applied to the entries values."""
+    if not isinstance(message, dict):
+        return message
+    res = dict(message)
+    for arg in CONNECT_DB_ARGS:
+        entries = message.get(arg)
+        if isinstance(entries, dict):
+            entries = _map_entry(entries, func)
+        elif isinstance(entries, list):
+            entries = [_map_entry(entry, func) for entry in entries]
+        else:
+            continue
+        res[arg] = entries
+    return res
+
+
+def _map_entry(entry, func):
+    if 'value' not in entry:
+        return entry
+    entry = dict(entry)
+    entry['value'] = func(entry['value'])
+    return entry
+
+
+def _to_json_string(value):
+    if value is None or isinstance(value, six.string_types):
+        return value
+    return json.dumps(value)
+
+
+class JsonCodec(object):
+    """The legacy codec, connect_db values are sent as JSON strings."""
+
+    name = 'json'
+
+    def encode(self, message):
+        data = json.dumps(_map_values(message, _to_json_string))
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        return data
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgPackCodec(object):
+    """Binary codec, connect_db values are sent as nested structures."""
+
+    name = 'msgpack'
+    ident = b'm'
+
+    def encode(self, message):
+        return MAGIC + self.ident + msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data[2:], raw=False)
+
+
+class ZlibCodec(object):
+    """Compress the messages of another codec above a size threshold.
+
+    A compressed message is MAGIC, ZLIB_IDENT then the zlib compressed
+    message, the smaller ones are left as encoded by the other codec.
+    """
+
+    compression = 'zlib'
+
+    def __init__(self, codec, threshold):
+        self.codec = codec
+        self.threshold = threshold
+        self.name = '%s+%s' % (codec.name, self.compression)
+
+    def encode(self, message):
+        data = self.codec.encode(message)
+        if len(data) < self.threshold:
+            return data
+        ts = time.time()
+        compressed = MAGIC + ZLIB_IDENT + zlib.compress(data)
+        _record(len(data), len(compressed), time.time() - ts)
+        return compressed
+
+    def decode(self, data):
+        return self.codec.decode(decompress(data))
+
+
+# totals of the compressions of this process
+_stats = {'messages': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+
+def _record(bytes_in, bytes_out, seconds):
+    _stats['messages'] += 1
+    _stats['bytes_in'] += bytes_in
+    _stats['bytes_out'] += bytes_out
+    _stats['seconds'] += seconds
+    LOG.info('compressed %d bytes to %d (ratio %2.1f) in %2.4fs' % (
+        bytes_in, bytes_out, float(bytes_in) / bytes_out, seconds))
+
+
+def compression_stats():
+    """Return the number of messages compressed, the bytes before and
+    after compression, the overall ratio and the seconds spent.
+    """
+    stats = dict(_stats)
+    stats['ratio'] = (float(stats['bytes_in']) / stats['bytes_out']
+                      if stats['bytes_out'] else 0.0)
+    return stats
+
+
+JSON = JsonCodec()
+
+CODECS = {JSON.name: JSON}
+BINARY_CODECS = {}
+if msgpack:
+    _msgpack_codec = MsgPackCodec()
+    CODECS[_msgpack_codec.name] = _msgpack_codec
+    BINARY_CODECS[_msgpack_codec.ident] = _msgpack_codec
+
+
+def available():
+    """Return the names of the codecs supported by this process."""
+    return sorted(CODECS.keys())
+
+
+def compressions():
+    """Return the names of the compressions supported by this process."""
+    return [ZlibCodec.compression]
+
+
+def get(name):
+    """Return the codec by name, JSON if not available."""
+    return CODECS.get(name, JSON)
+
+
+def negotiate(preferred, remote_codecs):
+    """Choose the codec to use with a peer.
+
+    :param preferred: the configured codec name
+    :param remote_codecs: the codec names advertised by the peer
+    :returns: the preferred codec if both sides support it, else JSON
+    """
+    if remote_codecs and preferred in remote_codecs and preferred in CODECS:
+        return CODECS[preferred]
+    return JSON
+
+
+def negotiate_compression(msg_codec, preferred, remote_compressions,
+                          threshold):
+    """Wrap msg_codec in the compression preferred if the peer has it.
+
+    :param preferred: the configured compression name, none to disable
+    :param remote_compressions: the compressions advertised by the peer
+    :param threshold: the size from which the messages are compressed
+    """
+    if (remote_compressions and preferred in remote_compressions and
+            preferred in compressions()):
+        return ZlibCodec(msg_codec, threshold)
+    return msg_codec
+
+
+def decompress(data):
+    """Return the message held by data if compressed, else data."""
+    if data[:2] == MAGIC + ZLIB_IDENT:
+        return zlib.decompress(data[2:])
+    return data
+
+
+def codec_of(data):
+    """Detect the codec used to encode data.
+
+    data must be decompressed first, the codec of a compressed message
+    is the codec of the message it holds, the replies to it are not
+    compressed.
+    """
+    if data[:1] == MAGIC:
+        codec = BINARY_CODECS.get(data[1:2])
+        if codec is None:
+            raise ValueError('unsupported codec %r' % data[1:2])
+        return codec
+    return JSON
+
+
+def decode(data):
+    """Decode data whatever the codec used to encode it."""
+    data = decompress(data)
+    return codec_of(data).decode(data)
@@ -0,0 +1,197 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import random
+import time
+
+from networking_bambuk.common import config
+
+from oslo_log import log
+
+
+LOG = log.getLogger(__name__)
+
+# delivery results of a message to a destination
+DELIVERED = 'delivered'
+FAILED = 'failed'
+REJECTED = 'rejected'
+QUEUED = 'queued'
+TIMED_OUT = 'timed_out'
+# the destination already holds the message content, it was not sent
+UNCHANGED = 'unchanged'
+
+
+class CircuitOpen(Exception):
+    """The destination is known to be dead, the message was not sent."""
+
+
+def backoff(attempt):
+    """Return the delay before the retry number attempt.
+
+    Exponential backoff with full jitter: a random delay between 0 and
+    retry_base_delay * 2 ** (attempt - 1), capped at retry_max_delay.
+    """
+    delay = min(config.retry_max_delay(),
+                config.retry_base_delay() * 2 ** (attempt - 1))
+    return random.uniform(0, delay)
+
+
+class CircuitBreaker(object):
+    """Fast fail the sends to a destination after repeated failures.
+
+    After breaker_failure_threshold consecutive failures the circuit is
+    open and the sends are rejected. Once breaker_reset_timeout seconds
+    have elapsed a single send is let through: its success closes the
+    circuit, its failure opens it again.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if not self.is_open:
+            return True
+        if self._probing:
+            return False
+        if time.time() - self.opened_at >= config.breaker_reset_timeout():
+            self._probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        if (self._probing or
+                self.failures >= config.breaker_failure_threshold()):
+            self.opened_at = time.time()
+            self._probing = False
+
+
+# circuit breakers of the destinations that failed, a destination
+# without breaker is healthy
+_breakers = {}
+
+
+def allow(destination):
+    breaker = _breakers.get(destination)
+    return breaker is None or breaker.allow()
+
+
+def success(destination):
+    _breakers.pop(destination, None)
+
+
+def failure(destination):
+    breaker = _breakers.get(destination)
+    if breaker is None:
+        breaker = CircuitBreaker()
+        _breakers[destination] = breaker
+    breaker.failure()
+    if breaker.is_open:
+        LOG.warning('circuit open for %s after %d failures' %
+                    (destination, breaker.failures))
+
+
+def is_open(destination):
+    breaker = _breakers.get(destination)
+    return breaker is not None and breaker.is_open
+
+
+def is_failing(destination):
+    """Whether the last send to destination failed."""
+    return destination in _breakers
+
+
+class RttEstimator(object):
+    """Reply timeout of a destination computed as the TCP one (RFC 6298).
+
+    The timeout is the smoothed round trip time plus four times its
+    variation, between rpc_timeout_min and rpc_timeout_max. It is
+    INITIAL times rpc_timeout_min until the first round trip is measured
+    and doubles after every timeout, until the next measure.
+    """
+
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+    # 1 second with the default rpc_timeout_min, as the initial TCP one
+    INITIAL = 2
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self._backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+        self._backoff = 1
+
+    def timeout(self):
+        if self.srtt is None:
+            rto = self.INITIAL * config.rpc_timeout_min()
+        else:
+            rto = self.srtt + self.K * self.rttvar
+        return max(config.rpc_timeout_min(),
+                   min(rto * self._backoff, config.rpc_timeout_max()))
+
+    def timed_out(self):
+        if self.timeout() < config.rpc_timeout_max():
+            self._backoff *= 2
+
+
+# round trip time estimators by destination
+_estimators = {}
+
+
+def _estimator(destination):
+    estimator = _estimators.get(destination)
+    if estimator is None:
+        estimator = RttEstimator()
+        _estimators[destination] = estimator
+    return estimator
+
+
+def record_rtt(destination, rtt):
+    """Record a round trip time, in seconds, measured to destination."""
+    _estimator(destination).sample(rtt)
+
+
+def rtt(destination):
+    """Return the smoothed round trip time to destination, None if unknown."""
+    estimator = _estimators.get(destination)
+    return estimator.srtt if estimator else None
+
+
+def timeout(destination):
+    """Return the seconds to wait for a reply of destination."""
+    estimator = _estimators.get(destination) or RttEstimator()
+    return estimator.timeout()
+
+
+def timed_out(destination):
+    """Back off the timeout of destination after a reply did not come."""
+    _estimator(destination).timed_out()
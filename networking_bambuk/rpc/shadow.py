@@ -0,0 +1,124 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import hashlib
+
+from networking_bambuk.common import config
+
+from oslo_log import log
+
+from oslo_serialization import jsonutils
+
+
+LOG = log.getLogger(__name__)
+
+
+def entry_key(entry):
+    return entry['table'], entry['key']
+
+
+def entry_hash(entry):
+    value = jsonutils.dumps(entry.get('value'), sort_keys=True)
+    return hashlib.md5(value.encode('utf-8')).digest()
+
+
+def view_hash(connect_db):
+    """Hash the keys of connect_db, whatever their values."""
+    keys = jsonutils.dumps(sorted(entry_key(entry) for entry in connect_db))
+    return hashlib.md5(keys.encode('utf-8')).digest()
+
+
+class ShadowState(object):
+    """What each vm holds, as a content hash by (table, key).
+
+    A vm is known from its last successful apply on: the shadow is then
+    the complete view of the vm, it is kept up to date with the mutations
+    delivered to it and forgotten on any delivery failure. The updates
+    that would not change the view of a known vm and the deletes of keys
+    it does not hold are not sent. The vms unknown get every mutation.
+
+    At most shadow_size vms are known, the least recently used is
+    forgotten first.
+    """
+
+    def __init__(self):
+        self._vms = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._vms)
+
+    def __contains__(self, vm):
+        return vm in self._vms
+
+    def _get(self, vm):
+        shadow = self._vms.pop(vm, None)
+        if shadow is not None:
+            self._vms[vm] = shadow
+        return shadow
+
+    def reset(self, vm, connect_db):
+        """Rebuild the shadow of vm from the connect_db it applied."""
+        size = config.shadow_size()
+        if not size:
+            return
+        self._vms.pop(vm, None)
+        self._vms[vm] = dict(
+            (entry_key(entry), entry_hash(entry)) for entry in connect_db)
+        while len(self._vms) > size:
+            self._vms.popitem(last=False)
+
+    def forget(self, vm):
+        self._vms.pop(vm, None)
+
+    def group(self, method, entries, vms):
+        """Group the vms by the entries that change their view.
+
+        :param method: update or delete
+        :param entries: the connect_db entries
+        :type entries: list
+        :param vms: the destinations
+        :returns: (entries, vms) couples, entries is empty for the vms
+                  whose view does not change
+        :rtype: list
+        """
+        keys = [entry_key(entry) for entry in entries]
+        hashes = None
+        if method != 'delete':
+            hashes = [entry_hash(entry) for entry in entries]
+        everything = tuple(range(len(entries)))
+        groups = collections.OrderedDict()
+        for vm in vms:
+            shadow = self._get(vm)
+            if shadow is None:
+                selected = everything
+            elif hashes is None:
+                selected = tuple(i for i, key in enumerate(keys)
+                                 if key in shadow)
+            else:
+                selected = tuple(i for i, key in enumerate(keys)
+                                 if shadow.get(key) != hashes[i])
+            groups.setdefault(selected, []).append(vm)
+        return [([entries[i] for i in selected], group_vms)
+                for selected, group_vms in groups.items()]
+
+    def record(self, method, entries, vms):
+        """Record the entries delivered to the vms."""
+        for vm in vms:
+            shadow = self._vms.get(vm)
+            if shadow is None:
+                continue
+            for entry in entries:
+                if method == 'delete':
+                    shadow.pop(entry_key(entry), None)
+                else:
+                    shadow[entry_key(entry)] = entry_hash(entry)
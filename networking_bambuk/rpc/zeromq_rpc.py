@@ -1,10 +1,13 @@
+import collections
 import eventlet
-import socket
+import itertools
 import threading
-import uuid
+import time
 
 from oslo_log import log
 
+from eventlet import event
+from eventlet import semaphore
 from eventlet.green import zmq
 
 from zmq import error
@@ -17,103 +20,408 @@ import traceback
 LOG = log.getLogger(__name__)
 
 
+def _context():
+    """Return the ZeroMQ context shared by all the sockets."""
+    return zmq.Context.instance()
+
+
+class SenderCache(object):
+    """Bounded cache of senders by connection.
+
+    The least recently used sender is evicted when the cache is full and
+    the senders not used for sender_idle_timeout seconds are evicted on
+    the next access.
+    """
+
+    def __init__(self):
+        self._senders = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._senders)
+
+    def get(self, key, factory):
+        now = time.time()
+        self._evict_idle(now - config.sender_idle_timeout())
+        sender = self._senders.pop(key, None)
+        if sender:
+            self.hits += 1
+        else:
+            self.misses += 1
+            sender = factory()
+        sender.last_used = now
+        self._senders[key] = sender
+        while len(self._senders) > config.sender_cache_size():
+            self._evict(self._senders.popitem(last=False))
+        return sender
+
+    def _evict_idle(self, oldest):
+        while self._senders:
+            _, sender = next(iter(self._senders.items()))
+            if sender.last_used >= oldest:
+                return
+            self._evict(self._senders.popitem(last=False))
+
+    def _evict(self, item):
+        key, sender = item
+        LOG.debug('evicting sender %s' % key)
+        self.evictions += 1
+        sender.close()
+
+    def stats(self):
+        return {'size': len(self._senders),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
 class ZeroMQReceiver(bambuk_rpc.BambukRpcReceiver):
+    """Receiver answering REQ and DEALER senders on a ROUTER socket.
+
+    Every request is [identity, request id, message] and is answered with
+    [identity, request id, response], REQ senders use an empty request id.
+    The requests are processed concurrently by a pool of receiver_workers
+    green threads, in the order defined by bambuk_rpc.RequestOrdering.
+    """
+
+    # seconds between two checks of the running flag
+    POLL_TIMEOUT = 1
 
     def __init__(self, bambuk_agent):
         self._port = config.listener_port()
         self._ip = config.listener_ip()
+        self._workers = eventlet.GreenPool(config.receiver_workers())
+        self._ordering = bambuk_rpc.RequestOrdering()
+        self._subscriber = ZeroMQSubscriber(self)
         super(ZeroMQReceiver, self).__init__(bambuk_agent)
 
     def receive(self):
-        context = zmq.Context()
-        self._socket = context.socket(zmq.REP)
-        self._socket.setsockopt(zmq.SNDTIMEO, 5)
-        self._socket.setsockopt(zmq.RCVTIMEO, 5)
+        self._socket = _context().socket(zmq.ROUTER)
         self._socket.setsockopt(zmq.LINGER, 0)
         self._socket.bind("tcp://%s:%d" % (self._ip, self._port))
         while self._running:
-            #  Wait for next request from client
             try:
-                LOG.info('waiting for message')
-                message = self._socket.recv()
-                LOG.info('received %s' % message)
-                response = self.call_agent(message)
-                LOG.info('sending %s' % response)
-                self._socket.send(response, zmq.NOBLOCK)
-                LOG.info('%s sent' % response)
+                # the green socket waits in the hub for the socket to be
+                # readable, a zmq.Poller would block the hub
+                request = None
+                with eventlet.Timeout(self.POLL_TIMEOUT, False):
+                    request = self._socket.recv_multipart()
+                if request is None:
+                    continue
+                identity, request_id, message_data = request
+                self.dispatch(message_data, identity, request_id)
+            except Exception as e:
+                LOG.error('an exception occured %s, %s' % (
+                    e, traceback.format_exc()))
+        self._socket.close()
+        self._subscriber.close()
+
+    def dispatch(self, message_data, identity=None, request_id=None):
+        """Process a message in order, answer it if it has an identity."""
+        msg_codec, message = self.decode(message_data)
+        waits, done = self._ordering.enter(message)
+        self._workers.spawn_n(
+            self._process, identity, request_id, msg_codec,
+            message, waits, done)
+
+    def _process(self, identity, request_id, msg_codec, message, waits,
+                 done):
+        try:
+            for previous in waits:
+                previous.wait()
+            response = self.handle(msg_codec, message)
+            if identity is None:
+                return
+            if response is None:
+                response = msg_codec.encode(None)
+            self._socket.send_multipart([identity, request_id, response])
+        except Exception as e:
+            LOG.error('an exception occured %s, %s' % (
+                e, traceback.format_exc()))
+        finally:
+            if done:
+                self._ordering.exit(done)
+
+    def state(self, **kwargs):
+        res = super(ZeroMQReceiver, self).state(**kwargs)
+        if res:
+            res['rpc']['pubsub'] = True
+            subscription = self._subscriber.subscription()
+            if subscription:
+                res['rpc']['subscription'] = subscription
+            if self._subscriber.resync:
+                # published mutations were missed, ask for a full apply
+                res.pop('revision', None)
+                res['rpc']['resync'] = True
+        return res
+
+    def apply(self, **kwargs):
+        res = super(ZeroMQReceiver, self).apply(**kwargs)
+        if res and kwargs.get('keys') is None:
+            # the whole connect_db was applied, nothing is missing
+            self._subscriber.resync = False
+        return res
+
+    def subscribe(self, publisher, topics):
+        self._subscriber.subscribe(publisher, topics)
+
+
+# the ZeroMQReceiver answers the DEALER senders too
+ZeroMQRouterReceiver = ZeroMQReceiver
+
+
+class ZeroMQPublisher(object):
+    """Publish the mutations by topic on a PUB socket.
+
+    Every message is [topic, sequence number, message], the sequence
+    numbers of a topic follow each other so that the subscribers detect
+    the messages they missed.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self._sequences = collections.defaultdict(itertools.count)
+        self._socket = _context().socket(zmq.PUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.bind('tcp://*:%s' % address.rsplit(':', 1)[1])
+
+    def publish(self, topic, message):
+        sequence = next(self._sequences[topic])
+        self._socket.send_multipart([topic.encode('utf-8'),
+                                     str(sequence).encode('ascii'),
+                                     message])
+
+    def close(self):
+        self._socket.close()
+
+
+class ZeroMQSubscriber(object):
+    """Receive the mutations published on the topics of an agent.
+
+    The messages are processed by the receiver as its requests, without
+    reply. The first message received on a topic gives its starting
+    sequence number, the topic is then reported in the subscription of
+    the agent state. A gap in the sequence numbers of a topic sets
+    resync until the next full apply.
+    """
+
+    def __init__(self, receiver):
+        self._receiver = receiver
+        self._socket = None
+        self._publisher = None
+        self._topics = set()
+        # last sequence number received by topic
+        self._sequences = {}
+        self.resync = False
+
+    def subscribe(self, publisher, topics):
+        if publisher != self._publisher:
+            self.close()
+            self._socket = _context().socket(zmq.SUB)
+            self._socket.setsockopt(zmq.LINGER, 0)
+            self._socket.connect(publisher)
+            self._publisher = publisher
+            self._topics = set()
+            self._sequences = {}
+            eventlet.spawn_n(self._receive, self._socket)
+        topics = set(topics)
+        for topic in topics - self._topics:
+            self._socket.setsockopt(zmq.SUBSCRIBE, topic.encode('utf-8'))
+        for topic in self._topics - topics:
+            self._socket.setsockopt(zmq.UNSUBSCRIBE, topic.encode('utf-8'))
+            self._sequences.pop(topic, None)
+        self._topics = topics
+        LOG.info('subscribed to %d topics of %s' % (len(topics), publisher))
+
+    def _receive(self, socket):
+        while not socket.closed:
+            try:
+                topic, sequence, message_data = socket.recv_multipart()
+            except Exception as e:
+                if socket.closed:
+                    return
+                LOG.error('an exception occured %s, %s' % (
+                    e, traceback.format_exc()))
+                continue
+            topic = topic.decode('utf-8')
+            if topic not in self._topics:
+                # a topic starting as a subscribed one
+                continue
+            self._check_sequence(topic, int(sequence))
+            try:
+                self._receiver.dispatch(message_data)
             except Exception as e:
                 LOG.error('an exception occured %s, %s' % (
                     e, traceback.format_exc()))
 
+    def subscription(self):
+        """Return the publisher and the topics received from it."""
+        if self._publisher is None or not self._sequences:
+            return None
+        return {'publisher': self._publisher,
+                'topics': sorted(self._sequences)}
+
+    def _check_sequence(self, topic, sequence):
+        last = self._sequences.get(topic)
+        if last is None:
+            # the messages published before were sent by unicast too,
+            # until the subscription to the topic is confirmed
+            LOG.info('receiving %s from sequence %d' % (topic, sequence))
+        elif sequence != last + 1:
+            LOG.warning('missed %s messages on %s' % (
+                sequence - last - 1, topic))
+            self.resync = True
+        self._sequences[topic] = sequence
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            self._publisher = None
+
 
 class ZeroMQSenderPool(bambuk_rpc.BambukSenderPool):
 
-    senders = {}
-    pools = {}
-    cur = {}
+    senders = SenderCache()
+
+    def _new_sender(self, vm):
+        return ZeroMQSender(vm, config.listener_port())
 
     def get_sender(self, vm, send_id=None):
         key = "tcp://%s:%d" % (vm, config.listener_port())
-        sender = ZeroMQSenderPool.senders.get(key)
-        if not sender:
-            sender = ZeroMQSender(vm, config.listener_port())
-            ZeroMQSenderPool.senders[key] = sender
-        return sender
+        return self.senders.get(key, lambda: self._new_sender(vm))
+
+    def cache_stats(self):
+        return self.senders.stats()
 
-    def start_bulk_send(self):
-        send_id = uuid.uuid4()
-        ZeroMQSenderPool.pools[send_id] = eventlet.GreenPool(600)
-        ZeroMQSenderPool.cur[send_id] = set()
-        return send_id
-    
     @config.timefunc
     def loop(self, send_id):
-        if send_id:
-            LOG.debug('number ................. %s ......................' % 
-                      len(ZeroMQSenderPool.cur[send_id]))
-            ZeroMQSenderPool.pools[send_id].waitall()
-            del ZeroMQSenderPool.pools[send_id]
-            del ZeroMQSenderPool.cur[send_id]
+        results = super(ZeroMQSenderPool, self).loop(send_id)
+        LOG.debug('sender cache %s' % self.cache_stats())
+        return results
 
 
 class ZeroMQSender(bambuk_rpc.BambukRpcSender):
 
     def init(self):
-        context = zmq.Context()
-        context.setsockopt(socket.SO_REUSEADDR, 1)
-        self._socket = context.socket(zmq.REQ)
-        self._socket.setsockopt(zmq.SNDTIMEO, 5)
-        self._socket.setsockopt(zmq.RCVTIMEO, 5)
+        self._socket = _context().socket(zmq.REQ)
+        self._socket.setsockopt(zmq.SNDTIMEO, config.rpc_timeout() * 1000)
+        self._socket.setsockopt(zmq.RCVTIMEO, config.rpc_timeout() * 1000)
         self._socket.setsockopt(zmq.LINGER, 0)
         self._socket.connect(self._conn)
 
     def __init__(self, host_or_ip, port=config.listener_port()):
-        super(ZeroMQSender, self).__init__()
+        super(ZeroMQSender, self).__init__(host_or_ip)
         self._lock = threading.Lock()
         self._conn = 'tcp://%s:%d' % (host_or_ip, port)
+        self._in_flight = 0
+        self._closing = False
+        self.last_used = time.time()
         self.init()
 
-    def _send(self, message, send_id=None):
+    def close(self):
+        """Close the socket, once the requests in flight are done."""
+        self._closing = True
+        if not self._in_flight:
+            self._socket.close()
+
+    def _begin(self):
+        self._in_flight += 1
+
+    def _end(self):
+        self._in_flight -= 1
+        if self._closing and not self._in_flight:
+            self._socket.close()
+
+    def _reset(self):
+        # a REQ socket can not send again before receiving a reply, start
+        # over with a new one unless closed meanwhile
+        self._socket.close()
+        if not self._closing:
+            self.init()
+
+    def _send(self, message, timeout):
         res = None
         self._lock.acquire()
+        self._begin()
         try:
+            self._socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
             self._socket.send(message, zmq.NOBLOCK)
             res = self._socket.recv()
+        except error.Again:
+            self._reset()
+            raise bambuk_rpc.BambukRpcTimeout(
+                'no reply from %s' % self._conn)
+        except Exception:
+            self._reset()
+            raise
         finally:
+            self._end()
             self._lock.release()
-        if send_id:
-            ZeroMQSenderPool.cur[send_id].remove(self._conn)
-#             LOG.debug('received %s....' % self._conn)
+#         LOG.debug('received %s....' % self._conn)
         return res
 
-    def send(self, message, send_id=None):
+    def send(self, message, send_id=None, timeout=None):
 #         LOG.debug('sending to %s' % self._conn)
-        if send_id:
-            ZeroMQSenderPool.cur[send_id].add(self._conn)
-            ZeroMQSenderPool.pools[send_id].spawn_n(
-                self._send, message, send_id)
-            return
-        else:
-            res = self._send(message)
-#             LOG.debug('sent to %s (%s)' % (self._conn, res))
-            return res
+        res = self._send(message, timeout or config.rpc_timeout())
+#         LOG.debug('sent to %s (%s)' % (self._conn, res))
+        return res
+
+
+class ZeroMQDealerSenderPool(ZeroMQSenderPool):
+    """Sender pool pipelining the requests to each vm."""
+
+    senders = SenderCache()
+
+    def _new_sender(self, vm):
+        return ZeroMQDealerSender(vm, config.listener_port())
+
+
+class ZeroMQDealerSender(ZeroMQSender):
+    """Sender with up to pipeline_depth outstanding requests.
+
+    Replies are matched to the requests by request id, in any order.
+    """
+
+    def init(self):
+        self._socket = _context().socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.connect(self._conn)
+        self._replies = {}
+        self._request_ids = itertools.count()
+        self._window = semaphore.Semaphore(config.pipeline_depth())
+        eventlet.spawn_n(self._receive)
+
+    def _receive(self):
+        while not self._socket.closed:
+            try:
+                request_id, response = self._socket.recv_multipart()
+            except Exception as e:
+                if self._socket.closed:
+                    return
+                LOG.error('an exception occured %s, %s' % (
+                    e, traceback.format_exc()))
+                continue
+            reply = self._replies.pop(request_id, None)
+            if reply:
+                reply.send(response)
+
+    def _send(self, message, timeout):
+        self._begin()
+        try:
+            with self._window:
+                request_id = str(next(self._request_ids)).encode('ascii')
+                reply = event.Event()
+                self._replies[request_id] = reply
+                try:
+                    self._socket.send_multipart([request_id, message])
+                    with eventlet.Timeout(timeout, False):
+                        return reply.wait()
+                    raise bambuk_rpc.BambukRpcTimeout(
+                        'no reply from %s' % self._conn)
+                finally:
+                    self._replies.pop(request_id, None)
+        finally:
+            self._end()
@@ -1,6 +1,12 @@
+import mock
 import os
+import shutil
+import tempfile
 import unittest
 
+from oslo_serialization import jsonutils
+
+from networking_bambuk.agent.df import df_agent_db
 from networking_bambuk.agent.df import df_bsd_db
 
 
@@ -12,10 +18,8 @@ class BSDDbDriver(unittest.TestCase):
         BSDDbDriver.bsd_db_driver._db_dir = '/tmp/dbtest'
         BSDDbDriver.bsd_db_driver._tables = {}
         if os.path.exists(BSDDbDriver.bsd_db_driver._db_dir):
-            for f in os.listdir(BSDDbDriver.bsd_db_driver._db_dir):
-                os.remove(os.path.join(BSDDbDriver.bsd_db_driver._db_dir, f))
-        else:
-            os.makedirs(BSDDbDriver.bsd_db_driver._db_dir)
+            shutil.rmtree(BSDDbDriver.bsd_db_driver._db_dir)
+        os.makedirs(BSDDbDriver.bsd_db_driver._db_dir)
 
     @classmethod
     def tearDownClass(cls):
@@ -69,6 +73,162 @@ class BSDDbDriver(unittest.TestCase):
             BSDDbDriver.bsd_db_driver.delete_table('lp')
             BSDDbDriver.bsd_db_driver.delete_table('ln')
 
+    def test_batch(self):
+        driver = BSDDbDriver.bsd_db_driver
+        for i in range(100):
+            driver.create_key('lswitch', str(i), {'id': i}, sync=False)
+        driver.delete_key('lswitch', '0', sync=False)
+        driver.sync()
+        # the committed transactions are seen through another environment
+        # handle
+        reader = df_bsd_db.BSDDbDriver()
+        reader._db_dir = driver._db_dir
+        reader._tables = {}
+        self.assertEqual(99, len(reader.get_all_keys('lswitch')))
+        self.assertEqual({'id': 5}, reader.get_key('lswitch', '5'))
+        reader._close_tables()
+        driver.delete_table('lswitch')
+
+    def test_replace(self):
+        driver = BSDDbDriver.bsd_db_driver
+        driver.create_key('lport', '1', '{}')
+        driver.create_key('lport', '2', '{}')
+        previous = driver._snapshot_dir()
+        connect_db = [
+            {'table': 'lport', 'key': '%d' % i, 'value': '{"a": 1}',
+             'revision': i}
+            for i in range(2, 5)]
+        self.assertTrue(driver.apply(connect_db))
+        # the tables were swapped, the previous ones kept for the readers
+        # which read the link before
+        self.assertTrue(os.path.exists(previous))
+        self.assertNotEqual(previous, driver._snapshot_dir())
+        self._assert_list(['2', '3', '4'], driver.get_all_keys('lport'))
+        self.assertEqual('{"a": 1}', driver.get_key('lport', '2'))
+        self.assertEqual(4, driver._revision())
+
+        # a reader opened on the previous tables
+        reader = df_bsd_db.BSDDbDriver()
+        reader._db_dir = driver._db_dir
+        reader._tables = {}
+        self.assertEqual('{"a": 1}', reader.get_key('lport', '3'))
+        self.assertTrue(driver.apply(connect_db[:1]))
+        self._assert_list(['2'], reader.get_all_keys('lport'))
+        self.assertFalse(os.path.exists(previous))
+        reader._close_tables()
+        driver.delete_table('lport')
+        driver.delete_table(df_agent_db.META_TABLE)
+
+    def _snapshots(self, driver):
+        return [f for f in os.listdir(driver._db_dir)
+                if f.startswith(df_bsd_db.SNAPSHOT_PREFIX)]
+
+    def test_replace_interrupted(self):
+        driver = BSDDbDriver.bsd_db_driver
+        driver.create_key('lport', '1', '{}')
+        previous = driver._snapshot_dir()
+        snapshots = self._snapshots(driver)
+        connect_db = [
+            {'table': 'lport', 'key': '%d' % i, 'value': '{"a": 1}',
+             'revision': i}
+            for i in range(2, 5)]
+        # the new tables are staged, the link is not swapped
+        with mock.patch.object(df_bsd_db.os, 'rename',
+                               side_effect=OSError('interrupted')):
+            self.assertFalse(driver.apply(connect_db))
+        self.assertEqual(previous, driver._snapshot_dir())
+        self._assert_list(['1'], driver.get_all_keys('lport'))
+        self._assert_list(snapshots, self._snapshots(driver))
+
+        # a crash left its staging directory and temporary link
+        tempfile.mkdtemp(prefix=df_bsd_db.SNAPSHOT_PREFIX,
+                         dir=driver._db_dir)
+        self.assertTrue(os.path.lexists(
+            os.path.join(driver._db_dir, df_bsd_db.TABLES_LINK + '.tmp')))
+        self.assertTrue(driver.apply(connect_db))
+        self._assert_list(['2', '3', '4'], driver.get_all_keys('lport'))
+        self._assert_list([os.path.basename(previous), driver._snapshot],
+                          self._snapshots(driver))
+        self.assertFalse(os.path.lexists(
+            os.path.join(driver._db_dir, df_bsd_db.TABLES_LINK + '.tmp')))
+        driver.delete_table('lport')
+        driver.delete_table(df_agent_db.META_TABLE)
+
+    def test_replace_concurrent_reader(self):
+        driver = BSDDbDriver.bsd_db_driver
+        connect_db = [
+            {'table': 'lport', 'key': '%d' % i, 'value': '{"a": 1}',
+             'revision': i}
+            for i in range(2, 5)]
+        self.assertTrue(driver.apply(connect_db))
+        first = driver._snapshot
+        reader = df_bsd_db.BSDDbDriver()
+        reader._db_dir = driver._db_dir
+        reader._tables = {}
+        self.assertEqual('{"a": 1}', reader.get_key('lport', '4'))
+
+        # two replaces while the reader has the first tables open
+        self.assertTrue(driver.apply(connect_db[:1]))
+        self.assertTrue(driver.apply(connect_db[:2]))
+        self.assertIn(first, self._snapshots(driver))
+        self.assertEqual(
+            '{"a": 1}',
+            jsonutils.loads(reader._tables[b'lport'].get(b'4')))
+
+        # the reader moves to the current tables, the first ones are
+        # removed by the next replace
+        self._assert_list(['2', '3'], reader.get_all_keys('lport'))
+        self.assertTrue(driver.apply(connect_db))
+        self.assertNotIn(first, self._snapshots(driver))
+        reader._close_tables()
+        driver.delete_table('lport')
+        driver.delete_table(df_agent_db.META_TABLE)
+
+    def test_replace_crash_after_swap(self):
+        db_dir = '/tmp/dbtest-crash'
+        if os.path.exists(db_dir):
+            shutil.rmtree(db_dir)
+        os.makedirs(db_dir)
+        self.addCleanup(shutil.rmtree, db_dir, True)
+        connect_db = [
+            {'table': 'lport', 'key': '%d' % i, 'value': '{"a": 1}',
+             'revision': i}
+            for i in range(2, 5)]
+        rename = os.rename
+
+        def crash(src, dst):
+            rename(src, dst)
+            os._exit(0)
+
+        # a process dies once the link is swapped, before the previous
+        # tables are closed and removed
+        pid = os.fork()
+        if not pid:
+            try:
+                driver = df_bsd_db.BSDDbDriver()
+                driver._db_dir = db_dir
+                driver._tables = {}
+                driver._env_obj = driver._open_env(recover=True)
+                driver.create_key('lport', '1', '{}')
+                with mock.patch.object(df_bsd_db.os, 'rename',
+                                       side_effect=crash):
+                    driver.apply(connect_db)
+            finally:
+                os._exit(1)
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+
+        # the next process recovers the environment on the new tables
+        driver = df_bsd_db.BSDDbDriver()
+        driver._db_dir = db_dir
+        driver._tables = {}
+        driver._env_obj = driver._open_env(recover=True)
+        self._assert_list(['2', '3', '4'], driver.get_all_keys('lport'))
+        self.assertEqual(4, driver._revision())
+        self.assertTrue(driver.apply(connect_db[:1]))
+        self._assert_list(['2'], driver.get_all_keys('lport'))
+        driver._close_tables()
+        driver._env.close()
+
 
 if __name__ == '__main__':
     unittest.main()
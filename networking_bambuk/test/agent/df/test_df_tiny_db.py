@@ -1,17 +1,31 @@
+import os
+import shutil
+import tempfile
 import unittest
 
+import mock
+
 from networking_bambuk.agent.df import df_tiny_db
 
 from tinydb import TinyDB
 from tinydb.storages import MemoryStorage
 
 
+def _driver(path=None):
+    driver = df_tiny_db.TinyDbDriver()
+    if path:
+        driver._file_db = path
+    else:
+        driver._db_obj = TinyDB(storage=MemoryStorage)
+    return driver
+
+
 class TinyDbDriver(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
         TinyDbDriver.tiny_db_driver = df_tiny_db.TinyDbDriver()
-        TinyDbDriver.tiny_db_driver._db = TinyDB(storage=MemoryStorage)
+        TinyDbDriver.tiny_db_driver._db_obj = TinyDB(storage=MemoryStorage)
 
     @classmethod
     def tearDownClass(cls):
@@ -58,6 +72,173 @@ class TinyDbDriver(unittest.TestCase):
         TinyDbDriver.tiny_db_driver.delete_table('lp')
         TinyDbDriver.tiny_db_driver.delete_table('ln')
 
+    def test_apply_since_revision(self):
+        driver = _driver()
+        connect_db = [
+            {'table': 'lport', 'key': '1', 'value': '{}', 'revision': 10},
+            {'table': 'lport', 'key': '2', 'value': '{}', 'revision': 20},
+        ]
+        self.assertTrue(driver.apply(connect_db))
+        self.assertEqual(20, driver._revision())
+
+        # 2 changed, 3 created, 1 kept as is and 4 deleted
+        driver.create_key('lport', '4', '{}')
+        changed = [
+            {'table': 'lport', 'key': '2', 'value': '{"a": 1}',
+             'revision': 30},
+            {'table': 'lport', 'key': '3', 'value': '{}', 'revision': 25},
+        ]
+        keys = [['lport', '1'], ['lport', '2'], ['lport', '3']]
+        self.assertTrue(driver.apply(changed, keys=keys))
+        self.assertEqual(['1', '2', '3'],
+                         sorted(driver.get_all_keys('lport')))
+        self.assertEqual('{"a": 1}', driver.get_key('lport', '2'))
+        self.assertEqual(30, driver._revision())
+        # the changes since a revision the database does not have
+        self.assertFalse(driver.apply(changed, keys=keys, since=40))
+
+    def test_apply_diff(self):
+        driver = _driver()
+        connect_db = [{'table': 'lport', 'key': str(i), 'value': '{}',
+                       'revision': i} for i in range(5000)]
+        self.assertTrue(driver.apply(connect_db))
+        # the unchanged topology is only read
+        with mock.patch.object(driver, 'set_key') as set_key, \
+                mock.patch.object(driver, 'delete_key') as delete_key, \
+                mock.patch.object(driver, 'sync') as sync:
+            self.assertTrue(driver.apply(connect_db))
+        self.assertFalse(set_key.called)
+        self.assertFalse(delete_key.called)
+        self.assertFalse(sync.called)
+
+        changed = connect_db[1:4999] + [
+            {'table': 'lport', 'key': '4999', 'value': '{"a": 1}',
+             'revision': 5000},
+            {'table': 'lswitch', 'key': '1', 'value': '{}'}]
+        with mock.patch.object(driver, 'clear_all') as clear_all:
+            self.assertTrue(driver.apply(changed))
+        self.assertFalse(clear_all.called)
+        self.assertIsNone(driver.get_key('lport', '0'))
+        self.assertEqual('{"a": 1}', driver.get_key('lport', '4999'))
+        self.assertEqual(['1'], driver.get_all_keys('lswitch'))
+        self.assertEqual(5000, driver._revision())
+
+    def test_index(self):
+        driver = TinyDbDriver.tiny_db_driver
+        driver.create_key('lswitch', '1', '{}')
+        driver.create_key('lswitch', '2', '{}')
+        # an existing key is not duplicated
+        driver.create_key('lswitch', '1', '{"a": 1}')
+        self.assertEqual(['1', '2'], driver.get_all_keys('lswitch'))
+        driver.delete_key('lswitch', '1')
+        driver.delete_key('lswitch', '3')
+        # the index rebuilt from the table
+        driver._keys.clear()
+        self.assertIsNone(driver.get_key('lswitch', '1'))
+        self.assertEqual('{}', driver.get_key('lswitch', '2'))
+        driver.delete_table('lswitch')
+        self.assertNotIn('lswitch', driver._keys)
+
+    def test_index_json_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'connect_db.json')
+        driver = _driver(path)
+        driver.create_key('lport', '1', '{}')
+        driver.create_key('lport', '2', '{}')
+        # the document ids are read back from the file as strings
+        driver = _driver(path)
+        driver.set_key('lport', '1', '{"a": 1}')
+        driver.delete_key('lport', '2')
+        driver.create_key('lport', '3', '{}')
+        driver = _driver(path)
+        self.assertEqual('{"a": 1}', driver.get_key('lport', '1'))
+        self.assertEqual(['1', '3'], sorted(driver.get_all_keys('lport')))
+
+    def test_sync(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'connect_db.json')
+        writer = _driver(path)
+        reader = _driver(path)
+        writer.create_key('lport', '1', '{}', sync=False)
+        self.assertIsNone(reader.get_key('lport', '1'))
+        writer.sync()
+        # the reader sees the file replaced
+        self.assertEqual('{}', reader.get_key('lport', '1'))
+        writer.set_key('lport', '1', '{"a": 1}')
+        self.assertEqual('{"a": 1}', reader.get_key('lport', '1'))
+        # no temporary file left
+        self.assertEqual(['connect_db.json'], os.listdir(tmp_dir))
+
+    def test_apply_single_write(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'connect_db.json')
+        driver = _driver(path)
+        connect_db = [{'table': 'lport', 'key': str(i),
+                       'value': '{"id": "%d"}' % i, 'revision': i}
+                      for i in range(10000)]
+        # the file is written once, when the driver syncs
+        storage_write = df_tiny_db.AtomicJSONStorage.write
+        with mock.patch.object(df_tiny_db.AtomicJSONStorage, 'write',
+                               autospec=True,
+                               side_effect=storage_write) as write:
+            self.assertTrue(driver.apply(connect_db))
+        self.assertEqual(1, write.call_count)
+        driver = _driver(path)
+        self.assertEqual(10000, len(driver.get_all_keys('lport')))
+        self.assertEqual(9999, driver._revision())
+
+    def test_index_reload(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'connect_db.json')
+        writer = _driver(path)
+        reader = _driver(path)
+        writer.create_key('lport', '1', '{}')
+        self.assertIsNone(reader.get_key('lport', '2'))
+        writer.delete_key('lport', '1')
+        writer.create_key('lport', '2', '{"a": 2}')
+        # the index of the reader is rebuilt from the replaced file
+        self.assertIsNone(reader.get_key('lport', '1'))
+        self.assertEqual('{"a": 2}', reader.get_key('lport', '2'))
+        reader.create_key('lport', '3', '{}')
+        writer = _driver(path)
+        self.assertEqual('{"a": 2}', writer.get_key('lport', '2'))
+        self.assertEqual(['2', '3'], sorted(writer.get_all_keys('lport')))
+
+    def test_one_stat_by_operation(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'connect_db.json')
+        driver = _driver(path)
+        driver.create_key('lport', '1', '{}')
+        with mock.patch.object(df_tiny_db.os, 'stat',
+                               wraps=os.stat) as stat:
+            self.assertEqual('{}', driver.get_key('lport', '1'))
+            self.assertEqual(1, stat.call_count)
+            driver.set_key('lport', '2', '{}', sync=False)
+            self.assertEqual(2, stat.call_count)
+
+    def test_index_no_scan(self):
+        driver = _driver()
+        driver._db.table('lport').insert_multiple(
+            {'key': str(i), 'value': '{}'} for i in range(1000))
+        driver.get_key('lport', '0')
+        # the operations on an indexed table read the documents by id
+        with mock.patch('tinydb.database.Table.all') as all_documents, \
+                mock.patch('tinydb.database.Table.search') as search:
+            self.assertEqual('{}', driver.get_key('lport', '500'))
+            driver.set_key('lport', '500', '{"a": 1}')
+            driver.delete_key('lport', '10')
+            driver.create_key('lport', 'new', '{}')
+        self.assertFalse(all_documents.called)
+        self.assertFalse(search.called)
+        self.assertEqual('{"a": 1}', driver.get_key('lport', '500'))
+        self.assertIsNone(driver.get_key('lport', '10'))
+        self.assertEqual(1000, len(driver.get_all_keys('lport')))
+
 
 if __name__ == '__main__':
     unittest.main()
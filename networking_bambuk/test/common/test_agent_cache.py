@@ -0,0 +1,100 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import time
+import unittest
+
+from oslo_config import cfg
+
+from networking_bambuk.common import agent_cache
+
+
+SERVER_CONF = {'device_id': 'host1', 'local_ip': '10.1.0.1'}
+
+
+class FakeClient(object):
+
+    def __init__(self, dead=()):
+        self.calls = []
+        self.dead = set(dead)
+        self.resyncs = set()
+
+    def state(self, server_conf, vm):
+        self.calls.append(vm)
+        if vm in self.dead:
+            raise IOError('%s unreachable' % vm)
+        return {'host': vm, 'revision': 10}
+
+
+class TestAgentStateCache(unittest.TestCase):
+
+    def setUp(self):
+        cfg.CONF.set_override('agent_state_ttl', 300, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'agent_state_ttl',
+                        'bambuk')
+        self.client = FakeClient()
+        self.cache = agent_cache.AgentStateCache(self.client)
+
+    def test_hit(self):
+        state, entry = self.cache.state(SERVER_CONF, '10.0.0.1')
+        self.assertEqual({'host': '10.0.0.1', 'revision': 10}, state)
+        # the callers get a copy
+        state.pop('revision')
+        state, cached = self.cache.state(SERVER_CONF, '10.0.0.1')
+        self.assertIs(entry, cached)
+        self.assertEqual(10, state['revision'])
+        self.assertEqual(['10.0.0.1'], self.client.calls)
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(0.5, stats['hit_rate'])
+
+    def test_miss(self):
+        self.cache.state(SERVER_CONF, '10.0.0.1')
+        # another server conf
+        self.cache.state(dict(SERVER_CONF, local_ip='10.1.0.2'), '10.0.0.1')
+        # expired
+        self.cache._entries['10.0.0.1'].updated_at -= 301
+        self.cache.state(dict(SERVER_CONF, local_ip='10.1.0.2'), '10.0.0.1')
+        self.assertEqual(3, len(self.client.calls))
+
+    def test_dead_agent(self):
+        self.cache.state(SERVER_CONF, '10.0.0.1')
+        self.cache._entries['10.0.0.1'].updated_at -= 301
+        self.client.dead.add('10.0.0.1')
+        self.assertEqual((None, None),
+                         self.cache.state(SERVER_CONF, '10.0.0.1'))
+        self.assertFalse(self.cache._entries['10.0.0.1'].alive)
+        # forgotten by the next refresh
+        self.cache.refresh()
+        self.assertNotIn('10.0.0.1', self.cache)
+
+    def test_refresh(self):
+        for vm in ('10.0.0.1', '10.0.0.2'):
+            self.cache.state(SERVER_CONF, vm)
+        self.cache._entries['10.0.0.1'].updated_at = time.time() - 200
+        del self.client.calls[:]
+        self.cache.refresh()
+        self.assertEqual(['10.0.0.1'], self.client.calls)
+        self.assertLess(self.cache._entries['10.0.0.1'].age(), 1)
+
+    def test_applied(self):
+        self.cache.state(SERVER_CONF, '10.0.0.1')
+        self.cache.applied('10.0.0.1', [{'revision': 5}, {'revision': 42},
+                                        {'revision': 0}])
+        state, _ = self.cache.state(SERVER_CONF, '10.0.0.1')
+        self.assertEqual(42, state['revision'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import unittest
+
+import mock
+
+from oslo_config import cfg
+
+from networking_bambuk.common import agent_cache
+from networking_bambuk.common import prober
+from networking_bambuk.test.common import test_agent_cache
+
+
+def _port(vm):
+    return {'id': 'port-%s' % vm,
+            'binding:host_id': 'host-%s' % vm,
+            'binding:profile': {'provider_mgnt_ip': vm,
+                                'provider_ip': '10.1.0.1'}}
+
+
+class TestAgentProber(unittest.TestCase):
+
+    def setUp(self):
+        cfg.CONF.set_override('l2_population', True, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'l2_population', 'bambuk')
+        cfg.CONF.set_override('agent_state_ttl', 300, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'agent_state_ttl',
+                        'bambuk')
+        self.client = test_agent_cache.FakeClient(dead=['10.0.0.2'])
+        self.client.agents = agent_cache.AgentStateCache(self.client)
+        self.prober = prober.AgentProber(self.client)
+        self.plugin = mock.Mock()
+        self.plugin.get_ports.return_value = [
+            _port('10.0.0.1'), _port('10.0.0.2'),
+            {'binding:host_id': 'host', 'binding:profile': {}}]
+        for target, attr, value in (
+                (prober.AgentProber, '_plugin',
+                 mock.PropertyMock(return_value=self.plugin)),
+                (prober.n_context, 'get_admin_context', mock.MagicMock())):
+            patcher = mock.patch.object(target, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_probe(self):
+        states = self.prober.probe()
+        self.assertEqual(['10.0.0.1'], list(states))
+        self.assertEqual(['10.0.0.1', '10.0.0.2'], sorted(self.client.calls))
+
+        # the agent registered without the revision
+        self.plugin.create_or_update_agent.assert_called_once_with(
+            mock.ANY, {'host': '10.0.0.1'})
+        # the port updates find the state in the cache
+        _, entry = self.client.agents.state(
+            {'device_id': 'host-10.0.0.1', 'local_ip': '10.1.0.1'},
+            '10.0.0.1')
+        self.assertTrue(entry.registered)
+        self.assertEqual(1, self.client.agents.hits)
+
+    @mock.patch.object(prober.update_actions, 'PortUpdateAction')
+    def test_probe_resync(self, action):
+        self.client.resyncs.update(['10.0.0.1', '10.0.0.2'])
+        self.prober.probe()
+        # only the alive vm is applied, from one of its ports
+        action.assert_called_once_with({'obj_id': 'port-10.0.0.1'},
+                                       self.client)
+        action.return_value.process.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import unittest
+
+import mock
+
+from networking_bambuk.common import topic_map
+from networking_bambuk.common import update_actions
+
+
+def _port(vm, network_id, security_groups=()):
+    return {'id': 'port-%s' % vm,
+            'network_id': network_id,
+            'security_groups': list(security_groups),
+            'device_owner': 'compute:nova',
+            'device_id': 'instance-%s' % vm,
+            'binding:host_id': 'host-%s' % vm,
+            'binding:profile': {'provider_mgnt_ip': vm,
+                                'provider_ip': '10.1.0.1'}}
+
+
+def _router_port(router_id, network_id):
+    return {'id': 'port-%s-%s' % (router_id, network_id),
+            'network_id': network_id,
+            'device_owner': 'network:router_interface_distributed',
+            'device_id': router_id,
+            'binding:profile': {}}
+
+
+class TestTopicMap(unittest.TestCase):
+
+    def setUp(self):
+        self.map = topic_map.TopicMap()
+        self.plugin = mock.Mock()
+        self.plugin.get_ports.return_value = [
+            _port('10.0.0.1', 'net-1', ['sg-1']),
+            _port('10.0.0.2', 'net-2'),
+            _port('10.0.0.3', 'net-3'),
+            _port('10.0.0.4', 'net-4'),
+            _router_port('router-1', 'net-1'),
+            _router_port('router-1', 'net-2'),
+            _router_port('router-2', 'net-3'),
+            _router_port('router-2', 'net-4')]
+        self.routers = {
+            'router-1': {'admin_state_up': True, 'distributed': True},
+            'router-2': {'admin_state_up': False, 'distributed': True}}
+        self.l3_plugin = mock.Mock()
+        self.l3_plugin.get_router.side_effect = (
+            lambda ctx, router_id: self.routers[router_id])
+        for target, attr, value in (
+                (topic_map.TopicMap, '_plugin',
+                 mock.PropertyMock(return_value=self.plugin)),
+                (topic_map.TopicMap, '_l3_plugin',
+                 mock.PropertyMock(return_value=self.l3_plugin)),
+                (topic_map.n_context, 'get_admin_context',
+                 mock.MagicMock())):
+            patcher = mock.patch.object(target, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_refresh(self):
+        self.assertFalse(self.map.loaded())
+        self.map.refresh()
+        self.assertTrue(self.map.loaded())
+        # the vms reach the networks of the router, as they subscribe
+        self.assertEqual({'10.0.0.1', '10.0.0.2'}, self.map.vms(['net-1']))
+        self.assertEqual({'10.0.0.1', '10.0.0.2'}, self.map.vms(['net-2']))
+        self.assertEqual({'10.0.0.1'}, self.map.vms(['sg-1']))
+        # not through a router down
+        self.assertEqual({'10.0.0.3'}, self.map.vms(['net-3']))
+        self.assertEqual({'10.0.0.4'}, self.map.vms(['net-4']))
+        self.assertEqual(2, self.l3_plugin.get_router.call_count)
+
+    def test_add(self):
+        self.map.add('10.0.0.5', ['net-1'])
+        self.assertFalse(self.map.loaded())
+        self.map.refresh()
+        self.map.add('10.0.0.5', ['net-1'])
+        self.assertEqual({'10.0.0.1', '10.0.0.2', '10.0.0.5'},
+                         self.map.vms(['net-1']))
+
+
+class TestDistribute(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.publish.return_value = {'10.0.0.3'}
+        self.client.update.return_value.timed_out = []
+        self.client.delete.return_value.timed_out = []
+        self.action = update_actions.Action(None, self.client)
+        self.ports = [_port('10.0.0.1', 'net-1'), _port('10.0.0.2', 'net-1')]
+
+    def test_update_published(self):
+        self.action._distribute('update', {}, ['net-1'], self.ports)
+        self.client.publish.assert_called_once_with('update', {}, ['net-1'])
+        self.client.update.assert_called_once_with({}, {'10.0.0.3'})
+
+    def test_delete_unicast(self):
+        self.action._distribute('delete', {}, ['net-1'], self.ports,
+                                ['port-10.0.0.2'])
+        # the subscribers through a router keep the deleted entries
+        self.assertFalse(self.client.publish.called)
+        self.client.delete.assert_called_once_with({}, {'10.0.0.1'})
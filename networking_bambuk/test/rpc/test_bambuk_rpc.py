@@ -0,0 +1,886 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import eventlet
+import json
+import time
+import unittest
+
+import mock
+
+from oslo_config import cfg
+
+from networking_bambuk.common import outbox
+from networking_bambuk.rpc import bambuk_rpc
+from networking_bambuk.rpc import codec
+from networking_bambuk.rpc import delivery
+
+
+REPLY = codec.JSON.encode(True)
+
+
+class FakeSender(bambuk_rpc.BambukRpcSender):
+
+    def __init__(self, vm, sent, dead, slow=(), timeouts=None):
+        super(FakeSender, self).__init__(vm)
+        self._sent = sent
+        self._dead = dead
+        self._slow = slow
+        self._timeouts = timeouts if timeouts is not None else []
+
+    def send(self, message, send_id=None, timeout=None):
+        self._timeouts.append(timeout)
+        if self.destination in self._dead:
+            raise IOError('%s unreachable' % self.destination)
+        if self.destination in self._slow:
+            eventlet.sleep(1)
+        self._sent.append((self.destination, message))
+        return REPLY
+
+
+class FakeSenderPool(bambuk_rpc.BambukSenderPool):
+
+    def __init__(self, dead=(), slow=()):
+        self.sent = []
+        self.dead = set(dead)
+        self.slow = set(slow)
+        self.timeouts = []
+
+    def get_sender(self, vm, send_id=None):
+        return FakeSender(vm, self.sent, self.dead, self.slow,
+                          self.timeouts)
+
+
+def _connect_db(nb_entries):
+    return [{'table': 'lport',
+             'key': 'port-%d' % i,
+             'value': json.dumps({'id': 'port-%d' % i,
+                                  'macs': ['fa:16:3e:00:00:01'],
+                                  'ips': ['10.0.0.%d' % (i % 250)]})}
+            for i in range(nb_entries)]
+
+
+class TestBulkSend(unittest.TestCase):
+
+    def test_message_encoded_once(self):
+        pool = FakeSenderPool()
+        vms = ['10.0.1.%d' % i for i in range(50)]
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=_connect_db(10))
+        with mock.patch.object(codec.json, 'dumps',
+                               wraps=json.dumps) as dumps:
+            pool.bulk_send(message, vms)
+        self.assertEqual(1, dumps.call_count)
+        self.assertEqual(len(vms), len(pool.sent))
+        payloads = set(id(payload) for _, payload in pool.sent)
+        self.assertEqual(1, len(payloads))
+        decoded = json.loads(pool.sent[0][1])
+        self.assertEqual('update', decoded['method'])
+        self.assertEqual(10, len(decoded['connect_db_update']))
+
+    def test_encode_cost_does_not_scale_with_vms(self):
+        connect_db = _connect_db(1000)
+        for nb_vms in (10, 2000):
+            pool = FakeSenderPool()
+            vms = ['10.1.%d.%d' % (i // 250, i % 250) for i in range(nb_vms)]
+            with mock.patch.object(codec.json, 'dumps',
+                                   wraps=json.dumps) as dumps:
+                pool.bulk_send(
+                    bambuk_rpc.BambukMessage(
+                        'update', connect_db_update=connect_db),
+                    vms)
+            self.assertEqual(1, dumps.call_count)
+            self.assertEqual(set(vms), set(vm for vm, _ in pool.sent))
+            self.assertEqual(
+                1, len(set(id(payload) for _, payload in pool.sent)))
+
+
+class TestDelivery(unittest.TestCase):
+
+    def setUp(self):
+        cfg.CONF.set_override('retry_attempts', 3, 'bambuk')
+        cfg.CONF.set_override('retry_base_delay', 0.01, 'bambuk')
+        cfg.CONF.set_override('breaker_failure_threshold', 3, 'bambuk')
+        delivery._breakers.clear()
+
+    def tearDown(self):
+        cfg.CONF.clear_override('retry_attempts', 'bambuk')
+        cfg.CONF.clear_override('retry_base_delay', 'bambuk')
+        cfg.CONF.clear_override('breaker_failure_threshold', 'bambuk')
+        delivery._breakers.clear()
+
+    def test_results_by_vm(self):
+        pool = FakeSenderPool(dead=['10.0.0.2'])
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=_connect_db(1))
+        results = pool.bulk_send(message, ['10.0.0.1', '10.0.0.2'])
+        self.assertDictEqual({'10.0.0.1': delivery.DELIVERED,
+                              '10.0.0.2': delivery.FAILED}, results)
+        self.assertTrue(delivery.is_open('10.0.0.2'))
+
+        # the dead vm is now rejected without being tried
+        results = pool.bulk_send(message, ['10.0.0.1', '10.0.0.2'])
+        self.assertDictEqual({'10.0.0.1': delivery.DELIVERED,
+                              '10.0.0.2': delivery.REJECTED}, results)
+
+    def test_healthy_vms_do_not_wait(self):
+        cfg.CONF.set_override('retry_base_delay', 0.5, 'bambuk')
+        pool = FakeSenderPool(dead=['10.0.0.2'])
+        delivered_at = {}
+        message = bambuk_rpc.BambukMessage('update', connect_db_update=[])
+        ts = time.time()
+        send_id = pool.start_bulk_send()
+        for vm in ['10.0.0.1', '10.0.0.2']:
+            pool.get_sender(vm).send_message(message, send_id)
+        eventlet.sleep(0)
+        delivered_at['10.0.0.1'] = time.time() - ts
+        pool.loop(send_id)
+        self.assertEqual([('10.0.0.1', message.encode())], pool.sent)
+        self.assertLess(delivered_at['10.0.0.1'], 0.5)
+
+    def test_deadline(self):
+        pool = FakeSenderPool(slow=['10.0.0.2'])
+        message = bambuk_rpc.BambukMessage('update', connect_db_update=[])
+        ts = time.time()
+        report = pool.bulk_send(message, ['10.0.0.1', '10.0.0.2'],
+                                deadline=0.2)
+        self.assertLess(time.time() - ts, 0.5)
+        self.assertEqual(['10.0.0.1'], report.delivered)
+        self.assertEqual(['10.0.0.2'], report.timed_out)
+        self.assertEqual(['10.0.0.2'], report.stragglers)
+        self.assertEqual(set(['10.0.0.1', '10.0.0.2']),
+                         set(report.latencies))
+
+    def test_adaptive_concurrency(self):
+        cfg.CONF.set_override('bulk_concurrency', 100, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'bulk_concurrency',
+                        'bambuk')
+        self.addCleanup(setattr, bambuk_rpc.BulkSend, 'latency', None)
+        bambuk_rpc.BulkSend.latency = 0.01
+        bulk = bambuk_rpc.BulkSend(deadline=1)
+        self.assertEqual(bulk.MIN_CONCURRENCY, bulk._pool.size)
+        # 5000 deliveries of 10ms in 1s
+        bulk._count = 5000
+        self.assertEqual(50, bulk._concurrency())
+        bulk._count = 50000
+        self.assertEqual(100, bulk._concurrency())
+
+    def test_failing_vms_do_not_hold_the_slots(self):
+        self.addCleanup(setattr, bambuk_rpc.BulkSend, 'latency', None)
+        bambuk_rpc.BulkSend.latency = 0.001
+        failing = ['10.0.0.%d' % i for i in range(20)]
+        healthy = ['10.0.1.%d' % i for i in range(20)]
+        for vm in failing:
+            delivery.failure(vm)
+        pool = FakeSenderPool(slow=failing)
+        message = bambuk_rpc.BambukMessage('update', connect_db_update=[])
+        ts = time.time()
+        report = pool.bulk_send(message, failing + healthy, deadline=0.3)
+        self.assertLess(time.time() - ts, 0.6)
+        self.assertEqual(set(healthy), set(report.delivered))
+        self.assertEqual(set(failing), set(report.timed_out))
+
+    def test_spawn_within_deadline(self):
+        cfg.CONF.set_override('bulk_concurrency', 2, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'bulk_concurrency',
+                        'bambuk')
+        vms = ['10.0.0.%d' % i for i in range(6)]
+        pool = FakeSenderPool(slow=vms)
+        message = bambuk_rpc.BambukMessage('update', connect_db_update=[])
+        ts = time.time()
+        # the dead vms take the two slots until the deadline
+        report = pool.bulk_send(message, vms, deadline=0.2)
+        self.assertLess(time.time() - ts, 0.5)
+        self.assertEqual(set(vms), set(report.timed_out))
+
+    def test_adaptive_timeout(self):
+        self.addCleanup(delivery._estimators.clear)
+        sender = FakeSenderPool().get_sender('10.0.0.1')
+        sender.state({})
+        # twice rpc_timeout_min until the round trip time is known
+        self.assertEqual([1.0], sender._timeouts)
+        sender.state({})
+        self.assertEqual(cfg.CONF.bambuk.rpc_timeout_min,
+                         sender._timeouts[-1])
+        # the apply waits for the database to be written
+        sender.apply([])
+        self.assertEqual(5, sender._timeouts[-1])
+
+    def test_sync_timeout_capped(self):
+        self.addCleanup(delivery._estimators.clear)
+        for _ in range(10):
+            delivery.timed_out('10.0.0.2')
+        self.assertEqual(cfg.CONF.bambuk.rpc_timeout_max,
+                         delivery.timeout('10.0.0.2'))
+        pool = FakeSenderPool(dead=['10.0.0.2'])
+        self.assertRaises(IOError, pool.get_sender('10.0.0.2').state, {})
+        # each attempt gets its share of sync_deadline
+        self.assertEqual([5.0, 5.0], pool.timeouts)
+
+    def test_sync_send_raises(self):
+        cfg.CONF.set_override('sync_attempts', 3, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'sync_attempts', 'bambuk')
+        sender = FakeSenderPool(dead=['10.0.0.2']).get_sender('10.0.0.2')
+        self.assertRaises(IOError, sender.state, {})
+        self.assertRaises(delivery.CircuitOpen, sender.state, {})
+
+    def test_sync_send_bounded(self):
+        cfg.CONF.set_override('sync_deadline', 0.3, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'sync_deadline', 'bambuk')
+        self.addCleanup(delivery._estimators.clear)
+        pool = FakeSenderPool()
+        sender = pool.get_sender('10.0.0.2')
+
+        def send(message, send_id=None, timeout=None):
+            pool.timeouts.append(timeout)
+            eventlet.sleep(timeout)
+            raise bambuk_rpc.BambukRpcTimeout()
+
+        sender.send = send
+        ts = time.time()
+        # a port update waits for a dead vm at most sync_deadline
+        self.assertRaises(bambuk_rpc.BambukRpcTimeout, sender.apply, [])
+        self.assertLess(time.time() - ts, 0.5)
+        self.assertLessEqual(len(pool.timeouts), 2)
+        self.assertLessEqual(max(pool.timeouts), 0.3)
+
+
+class TestRequestOrdering(unittest.TestCase):
+
+    def setUp(self):
+        self.ordering = bambuk_rpc.RequestOrdering()
+
+    @staticmethod
+    def _update(*keys):
+        return {'method': 'update',
+                'connect_db_update': [{'table': 'lport', 'key': key,
+                                       'value': {}} for key in keys]}
+
+    def test_same_key_ordered(self):
+        waits1, done1 = self.ordering.enter(self._update('p1'))
+        waits2, done2 = self.ordering.enter(self._update('p2'))
+        waits3, done3 = self.ordering.enter(self._update('p1', 'p2'))
+        self.assertEqual([], waits1)
+        self.assertEqual([], waits2)
+        self.assertEqual(set([done1, done2]), set(waits3))
+        self.ordering.exit(done1)
+        self.ordering.exit(done2)
+        self.ordering.exit(done3)
+        self.assertEqual([], self.ordering.enter(self._update('p1'))[0])
+
+    def test_apply_barrier(self):
+        _, done1 = self.ordering.enter(self._update('p1'))
+        waits2, done2 = self.ordering.enter(
+            {'method': 'apply', 'connect_db': []})
+        waits3, _ = self.ordering.enter(self._update('p2'))
+        self.assertEqual([done1], waits2)
+        self.assertEqual([done2], waits3)
+
+    def test_state_does_not_wait(self):
+        self.ordering.enter({'method': 'apply', 'connect_db': []})
+        self.assertEqual(([], None), self.ordering.enter(
+            {'method': 'state', 'server_conf': {}}))
+
+
+class FakeOutbox(object):
+
+    def __init__(self, backlog=()):
+        self.backlog = set(backlog)
+        self.queued = []
+
+    def destinations(self):
+        return self.backlog
+
+    def add(self, method, connect_db, vms):
+        self.queued.append((method, connect_db, set(vms)))
+
+    def last_id(self, vm):
+        return len(self.queued)
+
+    def clear(self, vm, last_id):
+        self.cleared = (vm, last_id)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        cfg.CONF.set_override('retry_base_delay', 0.01, 'bambuk')
+        delivery._breakers.clear()
+
+    def tearDown(self):
+        cfg.CONF.clear_override('retry_base_delay', 'bambuk')
+        delivery._breakers.clear()
+
+    def _client(self, pool, outbox):
+        with mock.patch.object(bambuk_rpc.importutils, 'import_object',
+                               return_value=pool):
+            client = bambuk_rpc.BambukAgentClient()
+        client.outbox = outbox
+        return client
+
+    def test_undelivered_queued(self):
+        pool = FakeSenderPool(dead=['10.0.0.2'])
+        queue = FakeOutbox(backlog=['10.0.0.3'])
+        client = self._client(pool, queue)
+        connect_db = _connect_db(1)
+        results = client.update(connect_db, ['10.0.0.1', '10.0.0.2',
+                                             '10.0.0.3'])
+        self.assertDictEqual({'10.0.0.1': delivery.DELIVERED,
+                              '10.0.0.2': delivery.QUEUED,
+                              '10.0.0.3': delivery.QUEUED}, results)
+        # a single attempt to the dead vm, the vm with a backlog not tried
+        self.assertEqual(['10.0.0.1'], [vm for vm, _ in pool.sent])
+        self.assertEqual(
+            [('update', connect_db, set(['10.0.0.2', '10.0.0.3']))],
+            queue.queued)
+
+    def test_apply_clears_queued_before(self):
+        pool = FakeSenderPool()
+        queue = FakeOutbox()
+        client = self._client(pool, queue)
+        queue.add('update', _connect_db(1), ['10.0.0.1'])
+        send = FakeSender.send
+
+        def send_and_queue(sender, *args, **kwargs):
+            # a mutation queued while the vm is applied
+            queue.add('update', _connect_db(1), ['10.0.0.1'])
+            return send(sender, *args, **kwargs)
+
+        with mock.patch.object(FakeSender, 'send', autospec=True,
+                               side_effect=send_and_queue):
+            self.assertTrue(client.apply(_connect_db(2), '10.0.0.1'))
+        self.assertEqual(('10.0.0.1', 1), queue.cleared)
+
+    def test_drain(self):
+        pool = FakeSenderPool(dead=['10.0.0.2'])
+        client = self._client(pool, None)
+        box = outbox.Outbox(client)
+        entries = {}
+        for vm in ('10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4'):
+            entries[vm] = [
+                mock.Mock(action_type='update', table_name='lport',
+                          key='port-1', value='{"id": "%s"}' % vm),
+                mock.Mock(action_type='delete', table_name='lport',
+                          key='port-2', value=None)]
+        # a dead vm is not tried, its circuit is open
+        for _ in range(cfg.CONF.bambuk.breaker_failure_threshold):
+            delivery.failure('10.0.0.4')
+        deleted = []
+        with mock.patch.object(outbox, 'n_context'), \
+                mock.patch.object(outbox, 'bambuk_db') as db:
+            db.get_outbox_destinations.return_value = sorted(entries)
+            db.get_outbox_entries.side_effect = (
+                lambda ctx, vm: entries[vm])
+            db.delete_outbox_entry.side_effect = (
+                lambda ctx, entry: deleted.append(entry))
+            box.drain()
+        sent = {}
+        for vm, payload in pool.sent:
+            message = json.loads(payload)
+            sent[(vm, message['method'])] = message
+        self.assertEqual(
+            [('10.0.0.1', 'delete'), ('10.0.0.1', 'update'),
+             ('10.0.0.3', 'delete'), ('10.0.0.3', 'update')],
+            sorted(sent))
+        self.assertEqual(
+            [{'table': 'lport', 'key': 'port-1',
+              'value': '{"id": "10.0.0.3"}'}],
+            sent[('10.0.0.3', 'update')]['connect_db_update'])
+        # a single attempt to the unreachable vm, not sent the deletes
+        self.assertEqual(len(pool.sent) + 1, len(pool.timeouts))
+        # the entries of the vms not delivered are kept
+        self.assertEqual(
+            set(map(id, entries['10.0.0.1'] + entries['10.0.0.3'])),
+            set(map(id, deleted)))
+
+
+class TestShadowClient(unittest.TestCase):
+
+    def setUp(self):
+        delivery._breakers.clear()
+        self.pool = FakeSenderPool()
+        with mock.patch.object(bambuk_rpc.importutils, 'import_object',
+                               return_value=self.pool):
+            self.client = bambuk_rpc.BambukAgentClient()
+
+    def test_only_deltas_sent(self):
+        connect_db = _connect_db(3)
+        self.client.apply(connect_db, '10.0.0.1')
+        del self.pool.sent[:]
+        changed = dict(connect_db[2], value='{}')
+        report = self.client.update(connect_db[:2] + [changed],
+                                    ['10.0.0.1', '10.0.0.2'])
+        self.assertDictEqual({'10.0.0.1': delivery.DELIVERED,
+                              '10.0.0.2': delivery.DELIVERED}, report)
+        sent = dict((vm, json.loads(payload)['connect_db_update'])
+                    for vm, payload in self.pool.sent)
+        self.assertEqual([changed], sent['10.0.0.1'])
+        self.assertEqual(3, len(sent['10.0.0.2']))
+
+        # nothing left to send to the vm up to date
+        del self.pool.sent[:]
+        report = self.client.update(changed, ['10.0.0.1'])
+        self.assertEqual(['10.0.0.1'], report.unchanged)
+        self.assertEqual([], self.pool.sent)
+
+    def test_failure_forgets_vm(self):
+        self.client.apply(_connect_db(1), '10.0.0.1')
+        self.pool.dead.add('10.0.0.1')
+        cfg.CONF.set_override('retry_attempts', 1, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'retry_attempts', 'bambuk')
+        report = self.client.delete(_connect_db(1), ['10.0.0.1'])
+        self.assertEqual(['10.0.0.1'], report.failed)
+        self.assertNotIn('10.0.0.1', self.client.shadow)
+
+    def test_apply_since_revision(self):
+        connect_db = _connect_db(3)
+        for revision, entry in zip((10, 20, 0), connect_db):
+            entry['revision'] = revision
+        # the keys of the vm are not known, all the entries are sent
+        self.client.apply(connect_db, '10.0.0.1', since=15)
+        sent = json.loads(self.pool.sent[0][1])
+        self.assertEqual(3, len(sent['connect_db']))
+        self.assertNotIn('keys', sent)
+
+        self.client.apply(connect_db, '10.0.0.1', since=15)
+        sent = json.loads(self.pool.sent[1][1])
+        # the entries without revision are always sent
+        self.assertEqual(['port-1', 'port-2'],
+                         [entry['key'] for entry in sent['connect_db']])
+        self.assertEqual([['lport', 'port-%d' % i] for i in range(3)],
+                         sent['keys'])
+        # the vm holds all the entries
+        report = self.client.update(connect_db, ['10.0.0.1'])
+        self.assertEqual(['10.0.0.1'], report.unchanged)
+
+    def test_catch_up_router_attached(self):
+        connect_db = _connect_db(2)
+        for entry in connect_db:
+            entry['revision'] = 10
+        self.client.apply(connect_db, '10.0.0.1')
+        # the router attach brings the ports of another network, with
+        # their old revision, the vm misses it
+        peers = [{'table': 'lport', 'key': 'peer-%d' % i, 'value': '{}',
+                  'revision': 5} for i in range(2)]
+        self.pool.dead.add('10.0.0.1')
+        cfg.CONF.set_override('retry_attempts', 1, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'retry_attempts', 'bambuk')
+        self.client.update(peers, ['10.0.0.1'])
+        self.pool.dead.discard('10.0.0.1')
+        delivery._breakers.clear()
+        del self.pool.sent[:]
+
+        self.client.apply(connect_db + peers, '10.0.0.1', since=20)
+        sent = json.loads(self.pool.sent[0][1])
+        self.assertEqual(4, len(sent['connect_db']))
+        self.assertNotIn('keys', sent)
+
+        # the detach deletes them, they come back with the same keys
+        self.client.delete(peers, ['10.0.0.1'])
+        del self.pool.sent[:]
+        self.client.apply(connect_db + peers, '10.0.0.1', since=20)
+        sent = json.loads(self.pool.sent[0][1])
+        self.assertEqual(4, len(sent['connect_db']))
+
+        # nothing entered the view since
+        del self.pool.sent[:]
+        self.client.apply(connect_db + peers, '10.0.0.1', since=20)
+        sent = json.loads(self.pool.sent[0][1])
+        self.assertEqual([], sent['connect_db'])
+        self.assertEqual(4, len(sent['keys']))
+
+
+class FakePublisher(object):
+
+    address = 'tcp://10.1.0.1:5557'
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, message):
+        self.published.append((topic, message))
+
+
+class FakeTopicMap(object):
+
+    def __init__(self, vms):
+        self._vms = vms
+
+    def loaded(self):
+        return True
+
+    def vms(self, topics):
+        return set(vm for topic in topics for vm in self._vms.get(topic, ()))
+
+    def add(self, vm, topics):
+        for topic in topics:
+            self._vms.setdefault(topic, set()).add(vm)
+
+
+def _subscription(*topics):
+    return {'pubsub': True,
+            'subscription': {'publisher': FakePublisher.address,
+                             'topics': list(topics)}}
+
+
+class TestPublish(unittest.TestCase):
+
+    def setUp(self):
+        delivery._breakers.clear()
+        self.pool = FakeSenderPool()
+        with mock.patch.object(bambuk_rpc.importutils, 'import_object',
+                               return_value=self.pool):
+            self.client = bambuk_rpc.BambukAgentClient()
+        self.client.publisher = FakePublisher()
+        self.client.topic_map = FakeTopicMap({
+            'net1': set(['10.0.0.1', '10.0.0.3']),
+            'net2': set(['10.0.0.2'])})
+
+    def test_subscription_on_apply(self):
+        self.client._pubsub.add('10.0.0.1')
+        self.client.apply(_connect_db(1), '10.0.0.1', topics=['net3'])
+        self.client.apply(_connect_db(1), '10.0.0.2', topics=['net3'])
+        sent = dict((vm, json.loads(payload)) for vm, payload in
+                    self.pool.sent)
+        self.assertEqual({'publisher': FakePublisher.address,
+                          'topics': ['net3']},
+                         sent['10.0.0.1']['subscription'])
+        # the vm not able to subscribe
+        self.assertNotIn('subscription', sent['10.0.0.2'])
+        self.assertEqual(set(['10.0.0.1']),
+                         self.client.topic_map.vms(['net3']))
+        # not confirmed before its state reports the topic
+        self.assertEqual(['10.0.0.1'], self.client.publish(
+            'update', _connect_db(1), ['net3']))
+
+    def test_confirm(self):
+        self.client.apply(_connect_db(1), '10.0.0.1')
+        self.client._negotiate('10.0.0.1', _subscription('net1'))
+        self.assertEqual({'10.0.0.1': set(['net1'])},
+                         self.client._subscribed)
+        self.assertIn('10.0.0.1', self.client.shadow)
+        # another publisher
+        self.client._negotiate('10.0.0.1', {
+            'pubsub': True,
+            'subscription': {'publisher': 'tcp://10.1.0.2:5557',
+                             'topics': ['net1']}})
+        self.assertEqual({}, self.client._subscribed)
+        # the agent missed the published mutations
+        self.client.apply(_connect_db(1), '10.0.0.1')
+        self.client._negotiate('10.0.0.1', _subscription('net1'))
+        self.client._negotiate('10.0.0.1',
+                               dict(_subscription('net1'), resync=True))
+        self.assertEqual({}, self.client._subscribed)
+        self.assertNotIn('10.0.0.1', self.client.shadow)
+        self.assertEqual(set(['10.0.0.1']), self.client.resyncs)
+        self.client.apply(_connect_db(1), '10.0.0.1')
+        self.assertEqual(set(), self.client.resyncs)
+
+    def test_confirm_restart(self):
+        self.client.apply(_connect_db(1), '10.0.0.1')
+        self.client._negotiate('10.0.0.1', _subscription('net1'))
+        # the restarted agent received nothing yet
+        self.client._negotiate('10.0.0.1', {'pubsub': True})
+        self.assertEqual({}, self.client._subscribed)
+        self.assertNotIn('10.0.0.1', self.client.shadow)
+
+    def test_published_once(self):
+        self.client.apply(_connect_db(1), '10.0.0.1')
+        self.client._negotiate('10.0.0.1', _subscription('net1'))
+        # confirmed on a topic not published
+        self.client._negotiate('10.0.0.2', _subscription('net3'))
+        connect_db = [dict(_connect_db(1)[0], value='{}')]
+        unsubscribed = self.client.publish(
+            'update', connect_db, ['net1', 'net2'])
+        self.assertEqual(['10.0.0.2', '10.0.0.3'], sorted(unsubscribed))
+        self.assertEqual(['net1', 'net2'], [
+            topic for topic, _ in self.client.publisher.published])
+        # the subscribers are known to hold the update
+        report = self.client.update(connect_db, ['10.0.0.1', '10.0.0.3'])
+        self.assertEqual(['10.0.0.1'], report.unchanged)
+
+    def test_not_published_unloaded(self):
+        self.client.topic_map.loaded = lambda: False
+        self.assertIsNone(self.client.publish(
+            'update', _connect_db(1), ['net1']))
+        self.assertEqual([], self.client.publisher.published)
+
+
+class FakeZones(object):
+
+    def __init__(self, zones):
+        self._zones = zones
+
+    def zone(self, vm):
+        return self._zones.get(vm)
+
+    def group(self, vms):
+        groups = {}
+        for vm in vms:
+            groups.setdefault(self._zones.get(vm), []).append(vm)
+        return groups
+
+
+class RelaySender(FakeSender):
+    """Sender to an agent relaying to its peers, all delivered."""
+
+    # the result of the handler of the relay
+    result = True
+
+    def send(self, message, send_id=None, timeout=None):
+        reply = super(RelaySender, self).send(message, send_id, timeout)
+        decoded = json.loads(message)
+        if decoded['method'] != 'relay':
+            return reply
+        return codec.JSON.encode(
+            {'result': self.result,
+             'peers': dict((peer, delivery.DELIVERED)
+                           for peer in decoded['peers'])})
+
+
+class RelaySenderPool(FakeSenderPool):
+
+    def get_sender(self, vm, send_id=None):
+        return RelaySender(vm, self.sent, self.dead, self.slow,
+                           self.timeouts)
+
+
+class FakeReceiver(bambuk_rpc.BambukRpcReceiver):
+
+    def receive(self):
+        pass
+
+
+class FakeAgent(object):
+
+    def state(self, server_conf):
+        return {'active': True}
+
+    def update(self, connect_db_update):
+        return True
+
+
+class TestRelay(unittest.TestCase):
+
+    def setUp(self):
+        delivery._breakers.clear()
+        delivery._estimators.clear()
+        self.addCleanup(delivery._estimators.clear)
+        self.zone_a = ['10.0.0.%d' % i for i in range(10)]
+        self.zone_b = ['10.0.1.%d' % i for i in range(10)]
+        self.small = ['10.0.2.1', '10.0.2.2']
+        zones = dict([(vm, 'a') for vm in self.zone_a] +
+                     [(vm, 'b') for vm in self.zone_b] +
+                     [(vm, 'c') for vm in self.small])
+
+        self.pool = RelaySenderPool()
+        with mock.patch.object(bambuk_rpc.importutils, 'import_object',
+                               return_value=self.pool):
+            self.client = bambuk_rpc.BambukAgentClient()
+        self.client.zones = FakeZones(zones)
+
+    def test_one_send_by_zone(self):
+        vms = self.zone_a + self.zone_b + self.small + ['10.0.3.1']
+        report = self.client.update(_connect_db(1), vms)
+        self.assertEqual(sorted(vms), sorted(report.delivered))
+        # a relay by large zone, the others sent directly
+        sent = [(vm, json.loads(payload)['method'])
+                for vm, payload in self.pool.sent]
+        relayed = [vm for vm, method in sent if method == 'relay']
+        self.assertEqual(2, len(relayed))
+        self.assertEqual(5, len(sent))
+        self.assertEqual(set(['10.0.0.0', '10.0.1.0']), set(relayed))
+
+    def test_relay_handler_failed(self):
+        with mock.patch.object(RelaySender, 'result', False):
+            report = self.client.update(_connect_db(1), self.zone_a)
+        self.assertEqual(['10.0.0.0'], report.failed)
+        self.assertEqual(sorted(self.zone_a[1:]), sorted(report.delivered))
+        # the relay was told its zone
+        self.assertEqual(
+            'a', json.loads(self.pool.sent[0][1])['zone'])
+
+    def test_closest_relay(self):
+        delivery.record_rtt('10.0.0.5', 0.01)
+        self.client.update(_connect_db(1), self.zone_a)
+        self.assertEqual(['10.0.0.5'], [vm for vm, _ in self.pool.sent])
+
+    def test_old_relay(self):
+        # an agent not knowing relay replies None
+        self.pool = FakeSenderPool()
+        self.client._sender_pool = self.pool
+        report = self.client.update(_connect_db(1), self.zone_a)
+        self.assertEqual(sorted(self.zone_a), sorted(report.delivered))
+        self.assertEqual(11, len(self.pool.sent))
+
+    def test_relay_attempts(self):
+        cfg.CONF.set_override('retry_base_delay', 0.01, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'retry_base_delay',
+                        'bambuk')
+        self.pool.dead.add('10.0.0.0')
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=_connect_db(1))
+        report = self.client._fan_out(message, self.zone_a, 1)
+        # a single attempt to the relay then to every vm directly
+        self.assertEqual(1 + len(self.zone_a), len(self.pool.timeouts))
+        self.assertEqual(sorted(self.zone_a[1:]), sorted(report.delivered))
+        # the relay waited the share of the deadline left to its peers
+        self.assertLessEqual(
+            self.pool.timeouts[0],
+            cfg.CONF.bambuk.bulk_deadline * bambuk_rpc.RELAY_DEADLINE)
+
+    def test_relay_deadline(self):
+        self.pool.slow.add('10.0.0.0')
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=_connect_db(1))
+        ts = time.time()
+        with mock.patch.object(bambuk_rpc.config, 'bulk_deadline',
+                               return_value=0.2):
+            report = self.client._fan_out(
+                message, self.zone_a + self.small, 1)
+        self.assertLess(time.time() - ts, 0.8)
+        self.assertEqual(sorted(self.zone_a), sorted(report.timed_out))
+        self.assertEqual(sorted(self.small), sorted(report.delivered))
+
+    def test_receiver_relays(self):
+        receiver = FakeReceiver(FakeAgent())
+        receiver._relay_pool = FakeSenderPool(dead=['10.0.0.2'])
+        cfg.CONF.set_override('retry_attempts', 1, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'retry_attempts', 'bambuk')
+        receiver.state(server_conf={}, zone='a')
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=_connect_db(1)).relayed(
+                ['10.0.0.1', '10.0.0.2'], 1, zone='a')
+        reply = json.loads(receiver.call_agent(message.encode()))
+        self.assertEqual({'result': True,
+                          'peers': {'10.0.0.1': delivery.DELIVERED,
+                                    '10.0.0.2': delivery.FAILED}}, reply)
+        self.assertEqual('update',
+                         json.loads(receiver._relay_pool.sent[0][1])['method'])
+
+    def test_receiver_other_zone(self):
+        agent = FakeAgent()
+        receiver = FakeReceiver(agent)
+        receiver._relay_pool = FakeSenderPool()
+        receiver.state(server_conf={}, zone='a')
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=_connect_db(1)).relayed(
+                ['10.0.1.1'], 1, zone='b')
+        # not handled nor relayed, the server sends it directly
+        with mock.patch.object(agent, 'update') as update:
+            self.assertIsNone(
+                json.loads(receiver.call_agent(message.encode())))
+        self.assertFalse(update.called)
+        self.assertEqual([], receiver._relay_pool.sent)
+
+
+class StatefulAgent(FakeAgent):
+
+    def __init__(self):
+        self.revision = 10
+        self.applied = []
+
+    def state(self, server_conf):
+        return {'host': server_conf['device_id'], 'revision': self.revision}
+
+    def apply(self, connect_db, keys=None, since=None):
+        self.applied.append((connect_db, since))
+        self.revision = 42
+        return True
+
+
+class OldReceiver(FakeReceiver):
+
+    # an agent not knowing bootstrap
+    bootstrap = None
+
+
+class ReceiverSender(FakeSender):
+
+    def __init__(self, vm, sent, receiver):
+        super(ReceiverSender, self).__init__(vm, sent, ())
+        self._receiver = receiver
+
+    def send(self, message, send_id=None, timeout=None):
+        self._sent.append((self.destination, message))
+        # the receivers reply None to the unknown methods
+        return (self._receiver.call_agent(message) or
+                codec.JSON.encode(None))
+
+
+class ReceiverSenderPool(FakeSenderPool):
+
+    def __init__(self, receiver):
+        super(ReceiverSenderPool, self).__init__()
+        self.receiver = receiver
+
+    def get_sender(self, vm, send_id=None):
+        return ReceiverSender(vm, self.sent, self.receiver)
+
+
+class TestBootstrap(unittest.TestCase):
+
+    server_conf = {'device_id': 'host1', 'local_ip': '10.1.0.1'}
+
+    def setUp(self):
+        delivery._breakers.clear()
+        bambuk_rpc.BambukSenderPool.codecs.clear()
+        self.addCleanup(bambuk_rpc.BambukSenderPool.codecs.clear)
+        self.agent = StatefulAgent()
+
+    def _client(self, receiver_class):
+        self.pool = ReceiverSenderPool(receiver_class(self.agent))
+        with mock.patch.object(bambuk_rpc.importutils, 'import_object',
+                               return_value=self.pool):
+            return bambuk_rpc.BambukAgentClient()
+
+    def test_single_round_trip(self):
+        client = self._client(FakeReceiver)
+        connect_db = _connect_db(3)
+        state, applied = client.bootstrap(self.server_conf, connect_db,
+                                          '10.0.0.1')
+        self.assertTrue(applied)
+        # the state once applied
+        self.assertEqual({'host': 'host1', 'revision': 42}, state)
+        self.assertEqual(['bootstrap'], [
+            codec.decode(payload)['method'] for _, payload in self.pool.sent])
+        self.assertEqual([(connect_db, None)], self.agent.applied)
+        # the codecs are negotiated from the reply
+        self.assertIn('10.0.0.1', bambuk_rpc.BambukSenderPool.codecs)
+        # the vm holds connect_db
+        report = client.update(connect_db, ['10.0.0.1'])
+        self.assertEqual(['10.0.0.1'], report.unchanged)
+
+    def test_old_agent(self):
+        client = self._client(OldReceiver)
+        connect_db = _connect_db(3)
+        for entry in connect_db:
+            entry['revision'] = 20
+        state, applied = client.bootstrap(self.server_conf, connect_db,
+                                          '10.0.0.1')
+        self.assertTrue(applied)
+        self.assertEqual({'host': 'host1', 'revision': 10}, state)
+        self.assertEqual(['bootstrap', 'state', 'apply'], [
+            codec.decode(payload)['method'] for _, payload in self.pool.sent])
+        # its keys are not known yet, it is applied all
+        self.assertIsNone(self.agent.applied[0][1])
+
+        # then caught up from the revision of its state
+        state, _ = client.bootstrap(self.server_conf, connect_db,
+                                    '10.0.0.1')
+        self.assertEqual(state['revision'], self.agent.applied[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
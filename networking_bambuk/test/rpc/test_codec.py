@@ -0,0 +1,122 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import json
+import mock
+import unittest
+import zlib
+
+from networking_bambuk.rpc import codec
+
+
+def _message(nb_entries):
+    return {
+        'method': 'apply',
+        'connect_db': [{'table': 'lport',
+                        'key': 'port-%d' % i,
+                        'value': {'id': 'port-%d' % i,
+                                  'macs': ['fa:16:3e:00:00:01'],
+                                  'ips': ['10.0.0.%d' % (i % 250)],
+                                  'enabled': True}}
+                       for i in range(nb_entries)]
+    }
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_json_values_as_strings(self):
+        message = _message(3)
+        data = codec.JSON.encode(message)
+        self.assertIs(codec.JSON, codec.codec_of(data))
+        decoded = codec.decode(data)
+        for entry, sent in zip(decoded['connect_db'], message['connect_db']):
+            self.assertEqual(sent['value'], json.loads(entry['value']))
+        # the original message is left untouched
+        self.assertIsInstance(message['connect_db'][0]['value'], dict)
+
+    @unittest.skipUnless(codec.msgpack, 'msgpack not installed')
+    def test_msgpack_native_values(self):
+        message = _message(3)
+        msgpack_codec = codec.get('msgpack')
+        data = msgpack_codec.encode(message)
+        self.assertIs(msgpack_codec, codec.codec_of(data))
+        self.assertEqual(message, codec.decode(data))
+
+    @unittest.skipUnless(codec.msgpack, 'msgpack not installed')
+    def test_msgpack_size(self):
+        message = _message(5000)
+        json_data = codec.JSON.encode(message)
+        msgpack_data = codec.get('msgpack').encode(message)
+        # the values are not escaped twice as JSON strings
+        self.assertLess(len(msgpack_data), len(json_data))
+        self.assertEqual(message, codec.decode(msgpack_data))
+
+    def test_responses(self):
+        for response in (True, False, None, {'active': True}):
+            for name in codec.available():
+                msg_codec = codec.get(name)
+                self.assertEqual(response,
+                                 codec.decode(msg_codec.encode(response)))
+
+    def test_negotiate(self):
+        self.assertIs(codec.JSON, codec.negotiate('msgpack', None))
+        self.assertIs(codec.JSON, codec.negotiate('msgpack', ['json']))
+        self.assertIs(codec.JSON, codec.negotiate('unknown', ['unknown']))
+        if codec.msgpack:
+            self.assertIs(codec.get('msgpack'),
+                          codec.negotiate('msgpack', ['json', 'msgpack']))
+
+    def test_compression(self):
+        message = _message(5000)
+        for name in codec.available():
+            msg_codec = codec.get(name)
+            zlib_codec = codec.ZlibCodec(msg_codec, 16384)
+            data = zlib_codec.encode(message)
+            self.assertEqual(codec.MAGIC + codec.ZLIB_IDENT, data[:2])
+            self.assertLess(len(data), len(msg_codec.encode(message)) / 4)
+            # the replies use the codec of the compressed message
+            self.assertIs(msg_codec, codec.codec_of(codec.decompress(data)))
+            expected = msg_codec.decode(msg_codec.encode(message))
+            self.assertEqual(expected, codec.decode(data))
+            self.assertEqual(expected, zlib_codec.decode(data))
+        self.assertGreater(codec.compression_stats()['ratio'], 4)
+
+    def test_small_messages_not_compressed(self):
+        zlib_codec = codec.ZlibCodec(codec.JSON, 16384)
+        self.assertEqual(codec.JSON.encode(_message(3)),
+                         zlib_codec.encode(_message(3)))
+
+    def test_negotiate_compression(self):
+        self.assertIs(codec.JSON, codec.negotiate_compression(
+            codec.JSON, 'zlib', None, 1024))
+        self.assertIs(codec.JSON, codec.negotiate_compression(
+            codec.JSON, 'none', ['zlib'], 1024))
+        zlib_codec = codec.negotiate_compression(
+            codec.JSON, 'zlib', ['zlib'], 1024)
+        self.assertEqual('json+zlib', zlib_codec.name)
+        self.assertEqual(1024, zlib_codec.threshold)
+
+    def test_unknown_binary_codec(self):
+        self.assertRaises(ValueError, codec.codec_of, codec.MAGIC + b'?')
+
+    def test_decompress_once(self):
+        data = codec.ZlibCodec(codec.JSON, 16384).encode(_message(5000))
+        with mock.patch.object(codec.zlib, 'decompress',
+                               wraps=zlib.decompress) as decompress:
+            codec.decode(data)
+            self.assertEqual(1, decompress.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
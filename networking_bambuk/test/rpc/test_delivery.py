@@ -0,0 +1,111 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import unittest
+
+from oslo_config import cfg
+
+from networking_bambuk.rpc import delivery
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        cfg.CONF.set_override('breaker_failure_threshold', 2, 'bambuk')
+        cfg.CONF.set_override('breaker_reset_timeout', 10, 'bambuk')
+
+    def tearDown(self):
+        cfg.CONF.clear_override('breaker_failure_threshold', 'bambuk')
+        cfg.CONF.clear_override('breaker_reset_timeout', 'bambuk')
+
+    def test_open_after_threshold(self):
+        breaker = delivery.CircuitBreaker()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_single_probe(self):
+        breaker = delivery.CircuitBreaker()
+        breaker.failure()
+        breaker.failure()
+        breaker.opened_at -= 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        breaker.opened_at -= 10
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_bounds(self):
+        cfg.CONF.set_override('retry_base_delay', 1, 'bambuk')
+        cfg.CONF.set_override('retry_max_delay', 5, 'bambuk')
+        try:
+            for attempt in range(1, 10):
+                delay = delivery.backoff(attempt)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, min(5, 2 ** (attempt - 1)))
+        finally:
+            cfg.CONF.clear_override('retry_base_delay', 'bambuk')
+            cfg.CONF.clear_override('retry_max_delay', 'bambuk')
+
+
+class TestRttEstimator(unittest.TestCase):
+
+    def setUp(self):
+        cfg.CONF.set_override('rpc_timeout', 5, 'bambuk')
+        cfg.CONF.set_override('rpc_timeout_min', 0.2, 'bambuk')
+        cfg.CONF.set_override('rpc_timeout_max', 8, 'bambuk')
+        delivery._estimators.clear()
+
+    def tearDown(self):
+        cfg.CONF.clear_override('rpc_timeout', 'bambuk')
+        cfg.CONF.clear_override('rpc_timeout_min', 'bambuk')
+        cfg.CONF.clear_override('rpc_timeout_max', 'bambuk')
+
+    def test_timeout_follows_rtt(self):
+        estimator = delivery.RttEstimator()
+        # not the apply timeout before the first measure
+        self.assertAlmostEqual(0.4, estimator.timeout())
+        self.assertAlmostEqual(0.4, delivery.timeout('10.0.0.1'))
+        estimator.sample(1.0)
+        # 1 + 4 * 0.5
+        self.assertAlmostEqual(3.0, estimator.timeout())
+        for _ in range(100):
+            estimator.sample(0.01)
+        self.assertEqual(0.2, estimator.timeout())
+        for _ in range(100):
+            estimator.sample(4.0)
+        self.assertAlmostEqual(4.0, estimator.timeout(), places=2)
+
+    def test_backoff(self):
+        estimator = delivery.RttEstimator()
+        estimator.sample(1.0)
+        estimator.timed_out()
+        self.assertAlmostEqual(6.0, estimator.timeout())
+        estimator.timed_out()
+        self.assertEqual(8, estimator.timeout())
+        estimator.sample(1.0)
+        self.assertLess(estimator.timeout(), 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
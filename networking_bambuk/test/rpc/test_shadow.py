@@ -0,0 +1,76 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import unittest
+
+from oslo_config import cfg
+
+from networking_bambuk.rpc import shadow
+
+
+def _entry(key, value=None):
+    return {'table': 'lport', 'key': key, 'value': value}
+
+
+class TestShadowState(unittest.TestCase):
+
+    def setUp(self):
+        self.shadow = shadow.ShadowState()
+        self.shadow.reset('vm1', [_entry('p1', {'ips': ['10.0.0.1']}),
+                                  _entry('p2', {'ips': ['10.0.0.2']})])
+
+    def test_unchanged_update_suppressed(self):
+        entries = [_entry('p1', {'ips': ['10.0.0.1']}),
+                   _entry('p2', {'ips': ['10.0.0.3']})]
+        groups = self.shadow.group('update', entries, ['vm1', 'vm2'])
+        self.assertEqual([([entries[1]], ['vm1']), (entries, ['vm2'])],
+                         groups)
+
+    def test_hash_ignores_key_order(self):
+        self.shadow.reset('vm1', [_entry('p1', {'a': 1, 'b': 2})])
+        groups = self.shadow.group(
+            'update', [_entry('p1', {'b': 2, 'a': 1})], ['vm1'])
+        self.assertEqual([([], ['vm1'])], groups)
+
+    def test_delete_of_unknown_key_suppressed(self):
+        entries = [_entry('p2'), _entry('p3')]
+        groups = self.shadow.group('delete', entries, ['vm1', 'vm2'])
+        self.assertEqual([([entries[0]], ['vm1']), (entries, ['vm2'])],
+                         groups)
+
+    def test_record(self):
+        entry = _entry('p3', {'ips': ['10.0.0.3']})
+        self.shadow.record('update', [entry], ['vm1', 'vm2'])
+        self.assertEqual([([], ['vm1'])],
+                         self.shadow.group('update', [entry], ['vm1']))
+        # only the vms known from an apply are tracked
+        self.assertNotIn('vm2', self.shadow)
+        self.shadow.record('delete', [entry], ['vm1'])
+        self.assertEqual([([], ['vm1'])],
+                         self.shadow.group('delete', [entry], ['vm1']))
+
+    def test_bounded(self):
+        cfg.CONF.set_override('shadow_size', 2, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'shadow_size', 'bambuk')
+        self.shadow.reset('vm2', [])
+        # vm1 used last, vm2 is evicted
+        self.shadow.group('update', [], ['vm1'])
+        self.shadow.reset('vm3', [])
+        self.assertIn('vm1', self.shadow)
+        self.assertNotIn('vm2', self.shadow)
+        self.assertEqual(2, len(self.shadow))
+
+
+if __name__ == '__main__':
+    unittest.main()
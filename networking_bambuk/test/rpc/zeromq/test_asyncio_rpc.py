@@ -0,0 +1,187 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import eventlet
+import six
+import time
+import unittest
+
+from oslo_config import cfg
+
+from networking_bambuk.rpc import asynctcp_rpc
+from networking_bambuk.rpc import bambuk_rpc
+from networking_bambuk.rpc import delivery
+from networking_bambuk.rpc import zeromq_rpc
+from networking_bambuk.test.rpc.zeromq import test_zeromq_rpc
+
+if six.PY3:
+    # the asyncio transport does not even parse on python 2
+    from networking_bambuk.rpc import asyncio_rpc
+
+
+PORT = 5560
+# the vms of the benchmark, all reaching the loopback receivers
+NB_VMS = 200
+VMS = ['127.0.%d.%d' % (1 + i // 250, 1 + i % 250) for i in range(NB_VMS)]
+
+
+def _connect_db(nb_entries):
+    return [{'table': 'lport',
+             'key': 'port-%d' % i,
+             'value': {'id': 'port-%d' % i,
+                       'macs': ['fa:16:3e:00:00:01'],
+                       'ips': ['10.0.0.%d' % (i % 250)]}}
+            for i in range(nb_entries)]
+
+
+@unittest.skipIf(six.PY2, 'asyncio_rpc needs python 3')
+class TestAsyncioRpc(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cfg.CONF.set_override('listener_port', PORT, 'bambuk')
+        TestAsyncioRpc._receiver = asyncio_rpc.AsyncioReceiver(
+            test_zeromq_rpc.FakeBambukAgent())
+        TestAsyncioRpc._pool = asyncio_rpc.AsyncioSenderPool()
+        TestAsyncioRpc._sender = TestAsyncioRpc._pool.get_sender(
+            'localhost')
+
+    @classmethod
+    def tearDownClass(cls):
+        TestAsyncioRpc._receiver.close()
+        cfg.CONF.clear_override('listener_port', 'bambuk')
+
+    def setUp(self):
+        delivery._breakers.clear()
+
+    def test_state(self):
+        server_conf = {'server_ip': '10.10.10.10'}
+        state = TestAsyncioRpc._sender.state(server_conf)
+        agent = TestAsyncioRpc._receiver._bambuk_agent
+        self.assertIn('codecs', state.pop('rpc'))
+        self.assertDictEqual(agent.agent_state, state)
+        self.assertDictEqual(server_conf, agent.server_conf)
+
+    def test_update(self):
+        connect_db_update = {'port': 'xxx'}
+        self.assertTrue(TestAsyncioRpc._sender.update(connect_db_update))
+        self.assertDictEqual(
+            connect_db_update,
+            TestAsyncioRpc._receiver._bambuk_agent.connect_db_update)
+
+    def test_bulk_send(self):
+        cfg.CONF.set_override('retry_attempts', 1, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'retry_attempts', 'bambuk')
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=_connect_db(1))
+        report = TestAsyncioRpc._pool.bulk_send(
+            message, ['127.0.0.1', '127.0.0.2', '192.0.2.1'], deadline=1)
+        self.assertEqual(['127.0.0.1', '127.0.0.2'],
+                         sorted(report.delivered))
+        self.assertEqual(['192.0.2.1'], report.stragglers)
+
+
+class SlowBambukAgent(test_zeromq_rpc.FakeBambukAgent):
+
+    def __init__(self):
+        self.calls = []
+
+    def state(self, server_conf):
+        self.calls.append('state')
+        return {'active': True}
+
+    def apply(self, connect_db):
+        self.calls.append('apply')
+        eventlet.sleep(0.3)
+        self.calls.append('applied')
+        return True
+
+
+@unittest.skipIf(six.PY2, 'asyncio_rpc needs python 3')
+class TestAsyncioPipelining(unittest.TestCase):
+
+    def setUp(self):
+        cfg.CONF.set_override('listener_port', PORT + 1, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'listener_port', 'bambuk')
+        self.agent = SlowBambukAgent()
+        self.receiver = asyncio_rpc.AsyncioReceiver(self.agent)
+        self.addCleanup(self.receiver.close)
+        self.sender = asyncio_rpc.AsyncioSenderPool().get_sender(
+            'localhost')
+
+    def test_pipelined(self):
+        pool = eventlet.GreenPool()
+        apply = pool.spawn(self.sender.apply, _connect_db(1))
+        eventlet.sleep(0.1)
+        state = pool.spawn(self.sender.state, {})
+        self.assertTrue(apply.wait())
+        self.assertTrue(state.wait()['active'])
+        # the state was processed during the apply, on the same connection
+        self.assertEqual(['apply', 'state', 'applied'], self.agent.calls)
+
+
+@unittest.skipIf(six.PY2, 'asyncio_rpc needs python 3')
+class TestTransportsBenchmark(unittest.TestCase):
+    """Bulk send the same update to NB_VMS vms with each transport."""
+
+    def _bulk_send(self, port, receiver_cls, sender_pool):
+        cfg.CONF.set_override('listener_port', port, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'listener_port', 'bambuk')
+        receiver = receiver_cls(test_zeromq_rpc.FakeBambukAgent())
+        self.addCleanup(receiver.close)
+        delivery._breakers.clear()
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=_connect_db(100))
+        # warm up the connections
+        sender_pool.bulk_send(message, VMS)
+        ts = time.time()
+        report = sender_pool.bulk_send(message, VMS)
+        elapsed = time.time() - ts
+        self.assertEqual(NB_VMS, len(report.delivered))
+        return elapsed
+
+    def _close_asynctcp(self, port):
+        # the connections of the asynctcp senders are shared by the pools
+        connections = asynctcp_rpc.AsyncTCPSenderPool.connections
+        for address, conn in list(connections.items()):
+            if address[1] == port:
+                del connections[address]
+                conn.close()
+
+    def test_bulk_send(self):
+        asyncio_elapsed = self._bulk_send(
+            PORT + 2, asyncio_rpc.AsyncioReceiver,
+            asyncio_rpc.AsyncioSenderPool())
+        timings = {
+            'zeromq': self._bulk_send(
+                PORT + 3, zeromq_rpc.ZeroMQReceiver,
+                zeromq_rpc.ZeroMQSenderPool()),
+            'zeromq dealer': self._bulk_send(
+                PORT + 4, zeromq_rpc.ZeroMQReceiver,
+                zeromq_rpc.ZeroMQDealerSenderPool()),
+            'asynctcp': self._bulk_send(
+                PORT + 5, asynctcp_rpc.AsyncTCPReceiver,
+                asynctcp_rpc.AsyncTCPSenderPool()),
+        }
+        self._close_asynctcp(PORT + 5)
+        # the hops through the loop thread keep asyncio in the range of
+        # the green transports, the timings vary too much from run to
+        # run to rank them closer
+        slowest = max(timings, key=timings.get)
+        self.assertLess(asyncio_elapsed, 2 * timings[slowest],
+                        'asyncio %2.3fs, %s' % (asyncio_elapsed, timings))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import socket
+import threading
+import unittest
+
+from networking_bambuk.rpc import asynctcp_rpc
+
+
+KB = 1024
+MB = 1024 * KB
+
+SIZES = [KB, 64 * KB, MB, 20 * MB]
+
+
+def _receive(sock):
+    in_buffer = asynctcp_rpc.FrameBuffer()
+    frames = []
+    while not frames:
+        in_buffer.feed(sock.recv(asynctcp_rpc.BUFF_SIZE))
+        frames = in_buffer.pop_frames()
+    return frames[0]
+
+
+def _send(sock, data):
+    out_buffer = asynctcp_rpc.SendBuffer()
+    out_buffer.append(data)
+    while len(out_buffer):
+        out_buffer.consume(sock.send(out_buffer.peek()))
+
+
+def _transfer(message, send, receive):
+    """Send message over loopback and return the received one."""
+    sender, receiver = socket.socketpair()
+    try:
+        thread = threading.Thread(target=send, args=(sender, ))
+        thread.start()
+        received = receive(receiver)
+        thread.join()
+        return received
+    finally:
+        sender.close()
+        receiver.close()
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_frames_split_and_merged(self):
+        messages = [b'a' * 10, b'', b'\n.\n' * 5, b'b' * 100000]
+        stream = b''.join(asynctcp_rpc.frame(m) for m in messages)
+        in_buffer = asynctcp_rpc.FrameBuffer()
+        received = []
+        for i in range(0, len(stream), 7):
+            in_buffer.feed(stream[i:i + 7])
+            received.extend(in_buffer.pop_frames())
+        self.assertEqual(messages, received)
+        self.assertEqual(0, len(in_buffer))
+
+    def test_frame_too_large(self):
+        in_buffer = asynctcp_rpc.FrameBuffer(max_size=10)
+        in_buffer.feed(asynctcp_rpc.frame(b'a' * 10))
+        self.assertEqual([b'a' * 10], in_buffer.pop_frames())
+        # only the header of the frame is needed to refuse it
+        in_buffer.feed(asynctcp_rpc.frame(b'b' * 11)[:6])
+        self.assertRaises(asynctcp_rpc.FrameTooLarge, in_buffer.pop_frames)
+
+    def test_send_buffer(self):
+        out_buffer = asynctcp_rpc.SendBuffer()
+        out_buffer.append(b'abc')
+        out_buffer.append(b'')
+        out_buffer.append(b'def')
+        self.assertEqual(6, len(out_buffer))
+        sent = b''
+        while len(out_buffer):
+            chunk = out_buffer.peek()[:2]
+            sent += chunk.tobytes()
+            out_buffer.consume(len(chunk))
+        self.assertEqual(b'abcdef', sent)
+
+    def test_loopback(self):
+        for size in SIZES:
+            # a separator inside the message does not end the frame
+            message = b'\n.\n' + b'x' * size
+            received = _transfer(
+                message,
+                lambda s: _send(s, asynctcp_rpc.frame(message)),
+                _receive)
+            self.assertEqual(message, received)
+
+
+if __name__ == '__main__':
+    unittest.main()
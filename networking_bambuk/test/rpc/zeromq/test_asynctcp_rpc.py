@@ -12,19 +12,29 @@
 #    under the License.
 #
 
+import eventlet
 import logging
+import mock
 import unittest
 import sys
 
+from eventlet.green import asyncore
+from eventlet.green import socket
+from oslo_config import cfg
+
 from networking_bambuk.rpc import asynctcp_rpc
 from networking_bambuk.rpc import bambuk_rpc
 
 
+PORT = 5556
+
+
 logger = logging.getLogger()
 logger.level = logging.DEBUG
 stream_handler = logging.StreamHandler(sys.stdout)
 logger.addHandler(stream_handler)
 
+
 class FakeBambukAgent(bambuk_rpc.BambukRpc):
 
     def __init__(self):
@@ -53,17 +63,21 @@ class TestAsyncTCPRpc(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
+        cfg.CONF.set_override('listener_port', PORT, 'bambuk')
         bambuk_agent = FakeBambukAgent()
         TestAsyncTCPRpc._receiver = asynctcp_rpc.AsyncTCPReceiver(bambuk_agent)
-        TestAsyncTCPRpc._sender = asynctcp_rpc.AsyncTCPSender('localhost', {})
+        TestAsyncTCPRpc._sender = asynctcp_rpc.AsyncTCPSender(
+            'localhost', asynctcp_rpc.AsyncTCPSenderPool())
 
     @classmethod
     def tearDownClass(cls):
         TestAsyncTCPRpc._receiver.close()
+        cfg.CONF.clear_override('listener_port', 'bambuk')
 
     def test_state(self):
         server_conf = {'server_ip': '10.10.10.10'}
         state = TestAsyncTCPRpc._sender.state(server_conf)
+        self.assertIn('codecs', state.pop('rpc'))
         self.assertDictEqual(
             state,
             TestAsyncTCPRpc._receiver._bambuk_agent.agent_state)
@@ -89,6 +103,70 @@ class TestAsyncTCPRpc(unittest.TestCase):
             connect_db_update,
             TestAsyncTCPRpc._receiver._bambuk_agent.connect_db_delete)
 
+    def test_idle_connection_not_driven(self):
+        TestAsyncTCPRpc._sender.state({})
+        eventlet.sleep(0)
+        conn = asynctcp_rpc.AsyncTCPSenderPool.connections[
+            TestAsyncTCPRpc._sender.address]
+        # no green thread waits on the socket without pending requests
+        self.assertIsNone(conn._reader)
+        self.assertIsNone(conn._writer)
+
+    def test_frame_too_large(self):
+        sock = socket.create_connection(('127.0.0.1', PORT))
+        self.addCleanup(sock.close)
+        sock.settimeout(5)
+        sock.sendall(asynctcp_rpc.HEADER.pack(
+            cfg.CONF.bambuk.max_frame_size + 1))
+        # the receiver drops the connection
+        self.assertEqual(b'', sock.recv(1))
+
+    def test_connection_ready(self):
+        add_channel = asyncore.dispatcher.add_channel
+
+        def check_ready(conn, map=None):
+            # the map may be driven as soon as the connection is in it
+            self.assertEqual(0, len(conn.out_buffer))
+            self.assertFalse(conn._pending)
+            add_channel(conn, map)
+
+        with mock.patch.object(asynctcp_rpc.TCPConnection, 'add_channel',
+                               autospec=True, side_effect=check_ready):
+            conn = asynctcp_rpc.TCPConnection(('127.0.0.1', PORT), {})
+        conn.close()
+
+    def test_concurrent_connections(self):
+        pool = asynctcp_rpc.AsyncTCPSenderPool()
+        # a connection to each address, all opened together
+        senders = [asynctcp_rpc.AsyncTCPSender('127.0.%d.%d' % (
+            i // 200, i % 200 + 1), pool) for i in range(250)]
+        updates = eventlet.GreenPool().imap(
+            lambda sender: sender.update({'port': sender.destination}),
+            senders)
+        self.assertEqual([True] * 250, list(updates))
+
+
+class TestAsyncTCPReceiver(unittest.TestCase):
+
+    # apart from the ports of the zeromq tests
+    PORT = 5570
+
+    def test_close(self):
+        cfg.CONF.set_override('listener_port', self.PORT, 'bambuk')
+        self.addCleanup(cfg.CONF.clear_override, 'listener_port', 'bambuk')
+        receiver = asynctcp_rpc.AsyncTCPReceiver(FakeBambukAgent())
+        sender = asynctcp_rpc.AsyncTCPSender(
+            '127.0.0.1', asynctcp_rpc.AsyncTCPSenderPool())
+        self.assertTrue(sender.update({'port': 'xxx'}))
+        receiver.close()
+        eventlet.sleep(0)
+        # the server and its connections are closed
+        self.assertEqual({}, receiver._map)
+        self.assertRaises(socket.error, socket.create_connection,
+                          ('127.0.0.1', self.PORT))
+        asynctcp_rpc.AsyncTCPSenderPool.connections.pop(
+            ('127.0.0.1', self.PORT)).close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,65 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import eventlet
+import unittest
+
+from oslo_config import cfg
+
+from networking_bambuk.rpc import zeromq_rpc
+from networking_bambuk.test.rpc.zeromq import test_zeromq_rpc
+
+
+PORT = 5557
+
+
+class TestZeroMqDealerRpc(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cfg.CONF.set_override('listener_port', PORT, 'bambuk')
+        bambuk_agent = test_zeromq_rpc.FakeBambukAgent()
+        TestZeroMqDealerRpc._receiver = zeromq_rpc.ZeroMQReceiver(
+            bambuk_agent)
+        TestZeroMqDealerRpc._sender = zeromq_rpc.ZeroMQDealerSender(
+            'localhost', PORT)
+
+    @classmethod
+    def tearDownClass(cls):
+        TestZeroMqDealerRpc._receiver.close()
+        cfg.CONF.clear_override('listener_port', 'bambuk')
+
+    def test_state(self):
+        server_conf = {'server_ip': '10.10.10.10'}
+        state = TestZeroMqDealerRpc._sender.state(server_conf)
+        agent = TestZeroMqDealerRpc._receiver._bambuk_agent
+        self.assertEqual(agent.agent_state['active'], state['active'])
+        self.assertDictEqual(server_conf, agent.server_conf)
+
+    def test_pipelined_updates(self):
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(
+            lambda i: TestZeroMqDealerRpc._sender.update({'port': i}),
+            range(50)))
+        self.assertEqual([True] * 50, results)
+
+    def test_dealer_pool(self):
+        sender_pool = zeromq_rpc.ZeroMQDealerSenderPool()
+        sender = sender_pool.get_sender('localhost')
+        self.assertIsInstance(sender, zeromq_rpc.ZeroMQDealerSender)
+        self.assertIs(sender, sender_pool.get_sender('localhost'))
+
+
+if __name__ == '__main__':
+    unittest.main()
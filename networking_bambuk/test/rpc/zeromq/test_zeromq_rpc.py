@@ -12,12 +12,22 @@
 #    under the License.
 #
 
+import eventlet
+import itertools
+import mock
+import time
 import unittest
 
+from oslo_config import cfg
+
 from networking_bambuk.rpc import zeromq_rpc
 from networking_bambuk.rpc import bambuk_rpc
 
 
+# seconds taken by the SlowBambukAgent to apply
+APPLY_TIME = 0.5
+
+
 class FakeBambukAgent(bambuk_rpc.BambukRpc):
 
     def __init__(self):
@@ -57,6 +67,7 @@ class TestZeroMqRpc(unittest.TestCase):
     def test_state(self):
         server_conf = {'server_ip': '10.10.10.10'}
         state = TestZeroMqRpc._sender.state(server_conf)
+        self.assertIn('codecs', state.pop('rpc'))
         self.assertDictEqual(state,
                              TestZeroMqRpc._receiver._bambuk_agent.agent_state)
         self.assertDictEqual(server_conf,
@@ -80,5 +91,203 @@ class TestZeroMqRpc(unittest.TestCase):
             TestZeroMqRpc._receiver._bambuk_agent.connect_db_delete)
 
 
+class TestZeroMqSender(unittest.TestCase):
+
+    # no receiver listens on it
+    PORT = 5599
+
+    def test_close_in_flight(self):
+        sender = zeromq_rpc.ZeroMQSender('localhost', self.PORT)
+        eventlet.spawn_n(sender.close)
+        with mock.patch.object(sender, 'init') as init:
+            self.assertRaises(bambuk_rpc.BambukRpcTimeout,
+                              sender.send, b'message', timeout=0.2)
+        # closed during the request, not opened again on its timeout
+        self.assertFalse(init.called)
+        self.assertTrue(sender._socket.closed)
+
+
+class SlowBambukAgent(FakeBambukAgent):
+    """Agent taking a while to write an apply, yielding meanwhile."""
+
+    def apply(self, connect_db):
+        for _ in range(50):
+            eventlet.sleep(APPLY_TIME / 50)
+        return super(SlowBambukAgent, self).apply(connect_db)
+
+
+class TestReceiverLatency(unittest.TestCase):
+
+    PORT = 5558
+
+    def setUp(self):
+        cfg.CONF.set_override('listener_port', self.PORT, 'bambuk')
+        # do not let the updates waiting for the apply hold the pipeline
+        cfg.CONF.set_override('pipeline_depth', 64, 'bambuk')
+        self.receiver = zeromq_rpc.ZeroMQReceiver(SlowBambukAgent())
+        self.sender = zeromq_rpc.ZeroMQDealerSender('localhost', self.PORT)
+
+    def tearDown(self):
+        self.receiver.close()
+        self.sender.close()
+        cfg.CONF.clear_override('listener_port', 'bambuk')
+
+    def _timed(self, method, *args):
+        ts = time.time()
+        getattr(self.sender, method)(*args)
+        return method, time.time() - ts
+
+    def test_mixed_traffic_latency(self):
+        pool = eventlet.GreenPool()
+        calls = [('apply', [{'table': 'lport', 'key': 'p0', 'value': {}}])]
+        for i in range(50):
+            if i % 2:
+                calls.append(('state', {'server_ip': '10.10.10.10'}))
+            else:
+                calls.append(('update', {'table': 'lport',
+                                         'key': 'p%d' % i, 'value': {}}))
+        latencies = {}
+        for method, latency in pool.starmap(self._timed, calls):
+            latencies.setdefault(method, []).append(latency)
+        # the state calls do not wait for the apply, the updates do
+        self.assertLess(max(latencies['state']), APPLY_TIME / 2)
+        self.assertGreater(min(latencies['update']), APPLY_TIME / 2)
+
+
+class RecordingBambukAgent(FakeBambukAgent):
+
+    def __init__(self):
+        self.updates = []
+
+    def state(self, server_conf):
+        return {'active': True, 'revision': 10}
+
+    def apply(self, connect_db, keys=None, since=None):
+        return True
+
+    def update(self, connect_db_update):
+        self.updates.append(connect_db_update)
+        return True
+
+
+class TestPubSub(unittest.TestCase):
+
+    # the ports of the receiver and the publisher of each test, zeromq
+    # releases the ports of the closed sockets in the background
+    PORTS = itertools.count(5580, 2)
+
+    def setUp(self):
+        port = next(self.PORTS)
+        self.publisher_address = 'tcp://127.0.0.1:%d' % (port + 1)
+        cfg.CONF.set_override('listener_port', port, 'bambuk')
+        self.agent = RecordingBambukAgent()
+        self.receiver = zeromq_rpc.ZeroMQReceiver(self.agent)
+        self.publisher = zeromq_rpc.ZeroMQPublisher(self.publisher_address)
+        self.receiver.subscribe(self.publisher_address, ['net1', 'sg1'])
+        # let the subscriber connect
+        eventlet.sleep(0.3)
+
+    def tearDown(self):
+        self.receiver.close()
+        self.publisher.close()
+        cfg.CONF.clear_override('listener_port', 'bambuk')
+
+    def _publish(self, topic, key):
+        message = bambuk_rpc.BambukMessage(
+            'update', connect_db_update=[{'table': 'lport', 'key': key,
+                                          'value': {}}])
+        self.publisher.publish(topic, message.encode())
+
+    def _wait(self, nb_updates):
+        with eventlet.Timeout(2, False):
+            while len(self.agent.updates) < nb_updates:
+                eventlet.sleep(0.01)
+
+    def test_subscribed_topics_only(self):
+        # nothing received yet, the subscription is not confirmed
+        state = self.receiver.state(server_conf={})
+        self.assertTrue(state['rpc']['pubsub'])
+        self.assertNotIn('subscription', state['rpc'])
+        self._publish('net1', 'p1')
+        self._publish('net2', 'p2')
+        self._publish('sg1', 'p3')
+        self._wait(2)
+        eventlet.sleep(0.1)
+        self.assertEqual(['p1', 'p3'],
+                         [update[0]['key'] for update in self.agent.updates])
+        state = self.receiver.state(server_conf={})
+        self.assertEqual({'publisher': self.publisher_address,
+                          'topics': ['net1', 'sg1']},
+                         state['rpc']['subscription'])
+        self.assertEqual(10, state['revision'])
+
+    def test_first_message(self):
+        # the messages published before the subscriber connected
+        next(self.publisher._sequences['net1'])
+        next(self.publisher._sequences['net1'])
+        self._publish('net1', 'p3')
+        self._wait(1)
+        self.assertFalse(self.receiver._subscriber.resync)
+        self.assertEqual({'net1': 2}, self.receiver._subscriber._sequences)
+
+    def test_missed_messages(self):
+        self._publish('net1', 'p1')
+        # a message lost on the way
+        next(self.publisher._sequences['net1'])
+        self._publish('net1', 'p3')
+        self._wait(2)
+        self.assertTrue(self.receiver._subscriber.resync)
+        # asked for a full apply until it is done
+        for _ in range(2):
+            state = self.receiver.state(server_conf={})
+            self.assertTrue(state['rpc']['resync'])
+            self.assertNotIn('revision', state)
+        self.receiver.apply(connect_db=[], keys=[], since=5)
+        self.assertTrue(self.receiver._subscriber.resync)
+        self.receiver.apply(connect_db=[])
+        self.assertFalse(self.receiver._subscriber.resync)
+
+
+class FakeSender(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestSenderCache(unittest.TestCase):
+
+    def setUp(self):
+        cfg.CONF.set_override('sender_cache_size', 2, 'bambuk')
+        cfg.CONF.set_override('sender_idle_timeout', 600, 'bambuk')
+        self.cache = zeromq_rpc.SenderCache()
+
+    def tearDown(self):
+        cfg.CONF.clear_override('sender_cache_size', 'bambuk')
+        cfg.CONF.clear_override('sender_idle_timeout', 'bambuk')
+
+    def test_lru_eviction(self):
+        s1 = self.cache.get('vm1', FakeSender)
+        s2 = self.cache.get('vm2', FakeSender)
+        self.assertIs(s1, self.cache.get('vm1', FakeSender))
+        s3 = self.cache.get('vm3', FakeSender)
+        self.assertTrue(s2.closed)
+        self.assertFalse(s1.closed)
+        self.assertFalse(s3.closed)
+        self.assertDictEqual(
+            {'size': 2, 'hits': 1, 'misses': 3, 'evictions': 1},
+            self.cache.stats())
+
+    def test_idle_eviction(self):
+        s1 = self.cache.get('vm1', FakeSender)
+        s1.last_used -= 601
+        s2 = self.cache.get('vm2', FakeSender)
+        self.assertTrue(s1.closed)
+        self.assertFalse(s2.closed)
+        self.assertEqual(1, len(self.cache))
+
+
 if __name__ == '__main__':
     unittest.main()